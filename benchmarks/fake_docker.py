@@ -0,0 +1,192 @@
+"""Provide an in-memory stand-in for the docker client used by the benchmarks."""
+import threading
+import time
+import uuid
+
+import docker
+
+
+class FakeEventStream:
+    """Block like the docker events stream until it is closed."""
+
+    def __init__(self):
+        self._closed = threading.Event()
+
+    def __iter__(self):
+        self._closed.wait()
+        return iter(())
+
+    def close(self):
+        """Close the stream."""
+        self._closed.set()
+
+
+class FakeContainer:
+    """Hold the attributes of a container returned by `containers.run`."""
+
+    def __init__(self, container_id: str, status: str):
+        self.id = container_id
+        self.status = status
+
+
+class FakeAPIClient:
+    """Implement the low-level API calls used by the docker backend."""
+
+    def __init__(self, daemon):
+        self._daemon = daemon
+
+    def containers(self, all=False, filters=None):  # pylint: disable=redefined-builtin
+        """List the containers whose name contains the name filter."""
+        self._daemon.wait()
+        prefix = (filters or {}).get("name", "")
+        with self._daemon.lock:
+            return [
+                {"Id": c["id"], "Names": ["/" + name], "State": c["status"]}
+                for name, c in self._daemon.store.items()
+                if prefix in name and (all or c["status"] == "running")
+            ]
+
+    def stop(self, container_id: str, timeout=None):
+        """Stop a container."""
+        self._daemon.wait()
+        self._daemon.set_status(container_id, "exited")
+
+    def remove_container(self, container_id: str, force=False):
+        """Remove a container."""
+        self._daemon.wait()
+        self._daemon.remove(container_id)
+
+    def inspect_image(self, image: str) -> dict:
+        """Return the attributes of a local image."""
+        self._daemon.wait()
+        with self._daemon.lock:
+            if image not in self._daemon.images:
+                raise docker.errors.ImageNotFound(f"No such image: {image}")
+            return {"Id": image, "Size": self._daemon.image_size}
+
+    def pull(self, repository: str, tag: str = None, stream=False, decode=False):
+        """Pull an image, reporting the progress of a single layer."""
+        size = self._daemon.image_size
+        for current in (0, size // 2, size):
+            self._daemon.wait()
+            yield {
+                "status": "Downloading",
+                "id": "layer",
+                "progressDetail": {"current": current, "total": size},
+            }
+        with self._daemon.lock:
+            self._daemon.pulls += 1
+            self._daemon.images.add(f"{repository}:{tag or 'latest'}")
+        yield {"status": "Pull complete", "id": "layer"}
+
+    def remove_image(self, image: str):
+        """Remove a local image."""
+        self._daemon.wait()
+        with self._daemon.lock:
+            self._daemon.images.discard(image)
+
+    def logs(self, container_id: str, stream=False, **kwargs):
+        """Return the logs of a container."""
+        self._daemon.wait()
+        logs = b"hello\n" * self._daemon.log_lines
+        if stream:
+            return iter([logs])
+        return logs
+
+
+class FakeContainers:
+    """Implement the high-level container calls used by the docker backend."""
+
+    def __init__(self, daemon):
+        self._daemon = daemon
+
+    def run(self, image: str, command: str, detach=False, name=None, **kwargs):
+        """Create and start a container."""
+        self._daemon.wait()
+        container_id = self._daemon.add(name, "running" if detach else "exited")
+        if detach:
+            return FakeContainer(container_id, "running")
+        return b"hello\n"
+
+    def get(self, name: str):
+        """Return a container by name."""
+        self._daemon.wait()
+        with self._daemon.lock:
+            container = self._daemon.store.get(name)
+        if container is None:
+            raise docker.errors.NotFound(f"No such container: {name}")
+        return FakeContainer(container["id"], container["status"])
+
+
+class FakeDockerClient:
+    """Emulate a docker daemon with a fixed latency per API call.
+
+    `containers` are created up front with the names produced by `name_format`.
+    """
+
+    def __init__(
+        self,
+        latency: float = 0.0,
+        containers: int = 0,
+        name_format: str = "hypha-container-launcher-{}",
+        log_lines: int = 100,
+        images=("alpine:latest",),
+        image_size: int = 1024 * 1024,
+    ):
+        self.latency = latency
+        self.log_lines = log_lines
+        self.images = set(images)
+        self.image_size = image_size
+        self.pulls = 0
+        self.lock = threading.Lock()
+        self.store = {}
+        self._names = {}
+        self.calls = 0
+        self.api = FakeAPIClient(self)
+        self.containers = FakeContainers(self)
+        for i in range(containers):
+            self.add(name_format.format(i), "running")
+
+    def wait(self):
+        """Simulate the round trip of an API call."""
+        with self.lock:
+            self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def add(self, name: str, status: str) -> str:
+        """Add a container to the daemon."""
+        container_id = uuid.uuid4().hex
+        with self.lock:
+            if name in self.store:
+                raise docker.errors.APIError(f"Conflict: {name} is already in use")
+            self.store[name] = {"id": container_id, "status": status}
+            self._names[container_id] = name
+        return container_id
+
+    def set_status(self, container_id: str, status: str):
+        """Change the status of a container."""
+        with self.lock:
+            name = self._names.get(container_id)
+            if name is not None:
+                self.store[name]["status"] = status
+                return
+        raise docker.errors.NotFound(f"No such container: {container_id}")
+
+    def remove(self, container_id: str):
+        """Remove a container from the daemon."""
+        with self.lock:
+            name = self._names.pop(container_id, None)
+            if name is not None:
+                del self.store[name]
+                return
+        raise docker.errors.NotFound(f"No such container: {container_id}")
+
+    def events(self, **kwargs):
+        """Open an events stream, no events are emitted."""
+        return FakeEventStream()
+
+    def ping(self):
+        """Check that the daemon responds."""
+        self.wait()
+        return True
@@ -0,0 +1,150 @@
+"""Provide an in-memory stand-in for the kubernetes CoreV1Api."""
+import threading
+import time
+
+from kubernetes.client.exceptions import ApiException
+from kubernetes.client.models import (
+    V1ListMeta,
+    V1ObjectMeta,
+    V1Pod,
+    V1PodList,
+    V1PodStatus,
+)
+
+
+class FakeResponse:
+    """Emulate a raw urllib3 response streaming lines.
+
+    A watch response does not emit any event, it blocks until the watch
+    timeout instead.
+    """
+
+    def __init__(self, data: bytes = b"", timeout: float = None):
+        self._data = data
+        self._timeout = timeout
+        self._closed = threading.Event()
+
+    def stream(self, amt=None, decode_content=False):
+        """Yield the content of the response."""
+        if self._timeout is not None:
+            self._closed.wait(self._timeout)
+            return
+        for start in range(0, len(self._data), amt or len(self._data) or 1):
+            yield self._data[start : start + (amt or len(self._data))]
+
+    read_chunked = stream
+
+    def close(self):
+        """Close the response."""
+        self._closed.set()
+
+    def release_conn(self):
+        """Release the connection of the response."""
+
+
+class FakeCoreV1Api:
+    """Emulate the pod API of a cluster with a fixed latency per API call.
+
+    `pods` are created up front with the names produced by `name_format` and
+    the given labels.
+    """
+
+    def __init__(
+        self,
+        latency: float = 0.0,
+        pods: int = 0,
+        name_format: str = "hypha-container-launcher-{}",
+        labels: dict = None,
+        log_lines: int = 100,
+    ):
+        self.latency = latency
+        self.log_lines = log_lines
+        self.lock = threading.Lock()
+        self.store = {}
+        self.calls = 0
+        self._resource_version = 0
+        for i in range(pods):
+            self._add(
+                V1Pod(metadata=V1ObjectMeta(name=name_format.format(i), labels=labels))
+            )
+
+    def wait(self):
+        """Simulate the round trip of an API call."""
+        with self.lock:
+            self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _add(self, pod: V1Pod) -> V1Pod:
+        with self.lock:
+            if pod.metadata.name in self.store:
+                raise ApiException(status=409, reason="AlreadyExists")
+            self._resource_version += 1
+            pod.metadata.resource_version = str(self._resource_version)
+            pod.status = V1PodStatus(phase="Running")
+            self.store[pod.metadata.name] = pod
+        return pod
+
+    @staticmethod
+    def _matches(pod: V1Pod, label_selector: str = None) -> bool:
+        if not label_selector:
+            return True
+        labels = pod.metadata.labels or {}
+        return all(
+            labels.get(key) == value
+            for key, value in (item.split("=", 1) for item in label_selector.split(","))
+        )
+
+    def list_namespaced_pod(
+        self, namespace: str, label_selector: str = None, watch=False, **kwargs
+    ):
+        """List the pods of a namespace.
+
+        :return: V1PodList
+        """
+        self.wait()
+        if watch:
+            return FakeResponse(timeout=kwargs.get("timeout_seconds", 1))
+        with self.lock:
+            return V1PodList(
+                items=[
+                    p for p in self.store.values() if self._matches(p, label_selector)
+                ],
+                metadata=V1ListMeta(resource_version=str(self._resource_version)),
+            )
+
+    def create_namespaced_pod(self, namespace: str, body: V1Pod, **kwargs) -> V1Pod:
+        """Create a pod."""
+        self.wait()
+        return self._add(body)
+
+    def delete_namespaced_pod(self, name: str, namespace: str, **kwargs):
+        """Delete a pod."""
+        self.wait()
+        with self.lock:
+            if self.store.pop(name, None) is None:
+                raise ApiException(status=404, reason="NotFound")
+            self._resource_version += 1
+
+    def delete_collection_namespaced_pod(
+        self, namespace: str, label_selector: str = None, **kwargs
+    ):
+        """Delete all the pods matching a label selector."""
+        self.wait()
+        with self.lock:
+            for name, pod in list(self.store.items()):
+                if self._matches(pod, label_selector):
+                    del self.store[name]
+            self._resource_version += 1
+
+    def read_namespaced_pod_log(
+        self, name: str, namespace: str, _preload_content=True, **kwargs
+    ):
+        """Return the logs of a pod."""
+        self.wait()
+        if name not in self.store:
+            raise ApiException(status=404, reason="NotFound")
+        logs = b"hello\n" * self.log_lines
+        if not _preload_content:
+            return FakeResponse(logs)
+        return logs.decode("utf-8")
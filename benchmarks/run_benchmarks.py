@@ -0,0 +1,311 @@
+"""Benchmark the container and function launchers against local stand-ins.
+
+The docker daemon and the kubernetes API are replaced by in-memory fakes
+with a configurable latency per API call, and the functions run on a local
+Ray instance, so the benchmarks run on any Linux machine. For example:
+
+    python benchmarks/run_benchmarks.py --latency 0.005 --containers 1000 \
+        --output results.json --baseline previous.json
+"""
+import argparse
+import asyncio
+import json
+import platform
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+ROOT_DIR = Path(__file__).parent.parent.resolve()
+sys.path.insert(0, str(ROOT_DIR))
+sys.path.insert(0, str(ROOT_DIR / "benchmarks"))
+
+
+def summarize(latencies: list, elapsed: float) -> dict:
+    """Compute the throughput and latency percentiles of a benchmark."""
+    latencies = sorted(latencies)
+
+    def percentile(q):
+        return latencies[min(len(latencies) - 1, int(q * len(latencies)))]
+
+    return {
+        "count": len(latencies),
+        "throughput": len(latencies) / elapsed if elapsed else 0,
+        "mean": sum(latencies) / len(latencies),
+        "p50": percentile(0.5),
+        "p90": percentile(0.9),
+        "p99": percentile(0.99),
+        "max": latencies[-1],
+    }
+
+
+def measure(call, count: int, concurrency: int = 1) -> dict:
+    """Call `call(i)` for i in range(count) from `concurrency` threads."""
+    latencies = []
+
+    def timed(i):
+        start = time.perf_counter()
+        call(i)
+        latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    if concurrency <= 1:
+        for i in range(count):
+            timed(i)
+    else:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            list(executor.map(timed, range(count)))
+    return summarize(latencies, time.perf_counter() - start)
+
+
+async def measure_async(call, count: int, concurrency: int = 1) -> dict:
+    """Await `call(i)` for i in range(count) with up to `concurrency` in flight."""
+    latencies = []
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def timed(i):
+        async with semaphore:
+            start = time.perf_counter()
+            await call(i)
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(timed(i) for i in range(count)))
+    return summarize(latencies, time.perf_counter() - start)
+
+
+def bench_container_backend(backend, client, reset, opts) -> dict:
+    """Benchmark the operations of a container backend module."""
+    # The first call builds the container index from a single listing
+    start = time.perf_counter()
+    backend.list_containers(client)
+    results = {"first_list": {"duration": time.perf_counter() - start}}
+    names = [f"bench-{i}" for i in range(opts.iterations)]
+    results["list"] = measure(
+        lambda i: backend.list_containers(client), opts.iterations, opts.concurrency
+    )
+    results["exists"] = measure(
+        lambda i: backend.exists_container(client, str(i % max(opts.containers, 1))),
+        opts.iterations,
+        opts.concurrency,
+    )
+    results["run"] = measure(
+        lambda i: backend.run_container(
+            client, "alpine", "echo hello", name=names[i], detach=True
+        ),
+        opts.iterations,
+        opts.concurrency,
+    )
+    results["stop"] = measure(
+        lambda i: backend.stop_container(client, names[i], timeout=0),
+        opts.iterations,
+        opts.concurrency,
+    )
+    batches = []
+    for r in range(opts.rounds):
+        specs = [
+            {"image": "alpine", "command": "echo hello", "name": f"batch-{r}-{i}"}
+            for i in range(opts.iterations)
+        ]
+        start = time.perf_counter()
+        report = backend.run_many(client, specs)
+        batches.append(time.perf_counter() - start)
+        assert all(c["success"] for c in report), report
+    results["run_many"] = summarize(batches, sum(batches))
+    results["run_many"]["containers"] = opts.iterations
+    teardowns = []
+    for _ in range(opts.rounds):
+        reset()
+        start = time.perf_counter()
+        report = backend.stop_container(client, "all", timeout=0)
+        teardowns.append(time.perf_counter() - start)
+        assert all(c["success"] for c in report["containers"]), report
+    results["stop_all"] = summarize(teardowns, sum(teardowns))
+    results["stop_all"]["containers"] = opts.containers
+    return results
+
+
+def bench_docker(opts) -> dict:
+    """Benchmark the docker backend against a fake docker daemon."""
+    from fake_docker import FakeDockerClient
+    from hypha_services import docker_utils
+
+    client = FakeDockerClient(latency=opts.latency, containers=opts.containers)
+
+    def reset():
+        for i in range(opts.containers):
+            name = f"{docker_utils.DOCKER_CONTAINER_PREFIX}{i}"
+            if name not in client.store:
+                client.add(name, "running")
+        docker_utils.get_container_index(client).resync()
+
+    results = bench_container_backend(docker_utils, client, reset, opts)
+    results["api_calls"] = client.calls
+    docker_utils.get_container_index(client).close()
+    return results
+
+
+def bench_kubernetes(opts) -> dict:
+    """Benchmark the kubernetes backend against a fake CoreV1Api."""
+    from fake_kubernetes import FakeCoreV1Api
+    from kubernetes.client.models import V1ObjectMeta, V1Pod
+    from hypha_services import k8s_utils
+
+    client_api = FakeCoreV1Api(
+        latency=opts.latency,
+        pods=opts.containers,
+        labels=k8s_utils.K8S_POD_LABELS,
+    )
+
+    def reset():
+        for i in range(opts.containers):
+            name = f"{k8s_utils.K8S_POD_PREFIX}{i}"
+            if name not in client_api.store:
+                client_api.create_namespaced_pod(
+                    k8s_utils.NAMESPACE,
+                    V1Pod(
+                        metadata=V1ObjectMeta(
+                            name=name, labels=dict(k8s_utils.K8S_POD_LABELS)
+                        )
+                    ),
+                )
+        k8s_utils.get_pod_informer(client_api).relist()
+
+    results = bench_container_backend(k8s_utils, client_api, reset, opts)
+    results["api_calls"] = client_api.calls
+    k8s_utils.get_pod_informer(client_api).close()
+    return results
+
+
+class FakeServer:
+    """Capture the services registered by the function launcher."""
+
+    config = {"workspace": "benchmark", "public_base_url": "http://localhost"}
+
+    def __init__(self):
+        self.services = {}
+
+    async def register_service(self, service: dict):
+        """Register a service."""
+        self.services[service["id"]] = service
+
+
+async def bench_ray(opts) -> dict:
+    """Benchmark deploying and running functions on a local Ray instance."""
+    import cloudpickle
+    import ray
+    from hypha_services.ray_utils import register_function_launcher
+
+    ray.init(num_cpus=2, include_dashboard=False, log_to_driver=False)
+    server = FakeServer()
+    await register_function_launcher(server)
+    launcher = server.services["function-launcher"]
+
+    def add_one(x):
+        return x + 1
+
+    results = {}
+    for mode in ("task", "actor"):
+        loop = asyncio.get_running_loop()
+        deployments = []
+        for i in range(opts.rounds):
+            start = time.perf_counter()
+            await loop.run_in_executor(
+                None,
+                lambda: launcher["deploy"](
+                    f"bench-{mode}", cloudpickle.dumps(add_one), mode=mode
+                ),
+            )
+            deployments.append(time.perf_counter() - start)
+        results[f"deploy_{mode}"] = summarize(deployments, sum(deployments))
+        results[f"run_{mode}"] = await measure_async(
+            lambda i: launcher["run"](f"bench-{mode}", i),
+            opts.iterations,
+            opts.concurrency,
+        )
+    ray.shutdown()
+    return results
+
+
+def compare(results: dict, baseline: dict):
+    """Print the change of the throughput and median latency against a baseline."""
+    for backend, benchmarks in results["benchmarks"].items():
+        for name, result in benchmarks.items():
+            previous = baseline["benchmarks"].get(backend, {}).get(name)
+            if not isinstance(result, dict) or not previous or "p50" not in result:
+                continue
+            print(
+                f"{backend}.{name}: "
+                f"p50 {previous['p50'] * 1000:.2f}ms -> {result['p50'] * 1000:.2f}ms "
+                f"({(result['p50'] / previous['p50'] - 1) * 100:+.0f}%), "
+                f"throughput {previous['throughput']:.0f}/s -> "
+                f"{result['throughput']:.0f}/s"
+            )
+
+
+def git_revision() -> str:
+    """Return the commit of the benchmarked tree, if available."""
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], cwd=ROOT_DIR, text=True
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--backends", nargs="+", default=["docker", "kubernetes", "ray"]
+    )
+    parser.add_argument(
+        "--latency", type=float, default=0.002, help="seconds per fake API call"
+    )
+    parser.add_argument(
+        "--containers", type=int, default=500, help="containers present up front"
+    )
+    parser.add_argument("--iterations", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=1)
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument("--output", default="benchmark_results.json")
+    parser.add_argument("--baseline", help="results of a previous run to compare to")
+    opts = parser.parse_args()
+
+    version = json.loads((ROOT_DIR / "hypha_services" / "VERSION").read_text())
+    results = {
+        "version": version["version"],
+        "revision": git_revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "timestamp": time.time(),
+        "options": vars(opts),
+        "benchmarks": {},
+    }
+    for backend in opts.backends:
+        print(f"Benchmarking {backend}...")
+        if backend == "docker":
+            results["benchmarks"]["docker"] = bench_docker(opts)
+        elif backend == "kubernetes":
+            results["benchmarks"]["kubernetes"] = bench_kubernetes(opts)
+        elif backend == "ray":
+            results["benchmarks"]["ray"] = asyncio.run(bench_ray(opts))
+        else:
+            raise ValueError(f"Unknown backend: {backend}")
+
+    Path(opts.output).write_text(json.dumps(results, indent=2))
+    print(f"Results saved to {opts.output}")
+    for backend, benchmarks in results["benchmarks"].items():
+        for name, result in benchmarks.items():
+            if isinstance(result, dict) and "p50" in result:
+                print(
+                    f"{backend}.{name}: {result['throughput']:.0f}/s, "
+                    f"p50 {result['p50'] * 1000:.2f}ms, "
+                    f"p99 {result['p99'] * 1000:.2f}ms"
+                )
+    if opts.baseline:
+        compare(results, json.loads(Path(opts.baseline).read_text()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,553 @@
+"""Provide an asyncio-native docker backend for the container launcher."""
+import asyncio
+import json
+import random
+import shlex
+import string
+import struct
+import time
+from functools import partial
+
+import aiohttp
+
+from hypha_services.docker_utils import (
+    DOCKER_CONTAINER_PREFIX,
+    DOCKER_LOG_MAX_BYTES,
+    _container_options,
+    _log_positions,
+    _pool_key,
+    _warm_pools,
+    get_container_index,
+    get_image_manager,
+)
+from hypha_services.utils import (
+    LogCursor,
+    TimestampedLogReader,
+    parse_bytes,
+    run_batch_async,
+)
+
+DOCKER_SOCKET = "/var/run/docker.sock"
+DOCKER_CONNECTION_LIMIT = 64  # connections kept in the pool to the daemon
+DOCKER_REQUEST_TIMEOUT = 60  # seconds before a request to the daemon fails
+# Concurrent requests per kind of operation, slow operations get a small share
+# of the connection pool so they cannot starve fast reads like status and list
+DOCKER_OPERATION_LIMITS = {"read": 48, "run": 8, "stop": 8}
+
+
+class DockerAPIError(Exception):
+    """Raise when the docker daemon responds with an error."""
+
+    def __init__(self, status: int, message: str):
+        super().__init__(f"Docker API error ({status}): {message}")
+        self.status = status
+
+
+class AsyncDockerClient:
+    """Talk to the docker API over a pool of connections to the unix socket.
+
+    When a synchronous docker client is given, the reads are answered from
+    its container index and run_container claims containers from its warm
+    pools.
+    """
+
+    def __init__(
+        self,
+        sync_client: any = None,
+        socket_path: str = DOCKER_SOCKET,
+        connection_limit: int = DOCKER_CONNECTION_LIMIT,
+        operation_limits: dict = None,
+    ):
+        self.sync_client = sync_client
+        self.index = get_container_index(sync_client) if sync_client else None
+        self.socket_path = socket_path
+        self.connection_limit = connection_limit
+        self.operation_limits = operation_limits or DOCKER_OPERATION_LIMITS
+        self._session = None
+        self._semaphores = None
+
+    def _connect(self):
+        # The session and semaphores must be created in the running event loop
+        if self._session is None or self._session.closed:
+            connector = aiohttp.UnixConnector(
+                path=self.socket_path, limit=self.connection_limit
+            )
+            self._session = aiohttp.ClientSession(connector=connector)
+            self._semaphores = {
+                kind: asyncio.Semaphore(limit)
+                for kind, limit in self.operation_limits.items()
+            }
+        return self._session
+
+    def limit(self, kind: str) -> asyncio.Semaphore:
+        """Return the semaphore bounding the concurrency of an operation."""
+        self._connect()
+        return self._semaphores[kind]
+
+    async def request(
+        self,
+        method: str,
+        path: str,
+        params=None,
+        body=None,
+        timeout=DOCKER_REQUEST_TIMEOUT,
+    ):
+        """Send a request to the daemon and return the decoded response.
+
+        Set the timeout to None for operations which can take arbitrarily long.
+        """
+        async with self._connect().request(
+            method,
+            f"http://docker{path}",
+            params=params,
+            json=body,
+            timeout=aiohttp.ClientTimeout(total=timeout),
+        ) as response:
+            data = await response.read()
+            if response.status >= 400:
+                try:
+                    message = json.loads(data)["message"]
+                except (ValueError, KeyError):
+                    message = data.decode("utf-8", "replace")
+                raise DockerAPIError(response.status, message)
+            if response.content_type == "application/json" and data:
+                return json.loads(data)
+            return data
+
+    async def stream(self, path: str, params=None):
+        """Yield the payloads of a multiplexed log stream."""
+        async with self._connect().get(
+            f"http://docker{path}",
+            params=params,
+            timeout=aiohttp.ClientTimeout(total=None),
+        ) as response:
+            if response.status >= 400:
+                raise DockerAPIError(response.status, await response.text())
+            while True:
+                try:
+                    header = await response.content.readexactly(8)
+                except asyncio.IncompleteReadError:
+                    return
+                size = struct.unpack(">L", header[4:])[0]
+                yield await response.content.readexactly(size)
+
+    async def close(self):
+        """Close the pooled connections."""
+        if self._session is not None:
+            await self._session.close()
+
+
+def _demux(data: bytes, stdout=True, stderr=True) -> bytes:
+    """Extract the output of a multiplexed log response."""
+    output = []
+    position = 0
+    while position + 8 <= len(data):
+        stream_type = data[position]
+        size = struct.unpack(">L", data[position + 4 : position + 8])[0]
+        payload = data[position + 8 : position + 8 + size]
+        if (stream_type == 1 and stdout) or (stream_type == 2 and stderr):
+            output.append(payload)
+        position += 8 + size
+    return b"".join(output)
+
+
+def _split_image(image: str):
+    if "@" in image:
+        return image, None
+    name, _, tag = image.rpartition(":")
+    if name and "/" not in tag:
+        return name, tag
+    return image, "latest"
+
+
+def _create_body(image: str, command: str, options: dict) -> dict:
+    environment = options["environment"]
+    if isinstance(environment, dict):
+        environment = [f"{k}={v}" for k, v in environment.items()]
+    ulimits = [
+        {
+            "Name": u.get("Name", u.get("name")),
+            "Soft": u.get("Soft", u.get("soft")),
+            "Hard": u.get("Hard", u.get("hard")),
+        }
+        for u in options["ulimits"] or []
+    ]
+    device_requests = [
+        {
+            "Driver": r["driver"],
+            "Count": r["count"],
+            "Capabilities": r["capabilities"],
+        }
+        for r in options["device_requests"] or []
+    ]
+    return {
+        "Image": image,
+        "Cmd": shlex.split(command) if isinstance(command, str) else command,
+        "WorkingDir": options["working_dir"],
+        "Env": environment,
+        "Labels": options["labels"],
+        "HostConfig": {
+            "CpuCount": options["cpu_count"],
+            "DeviceRequests": device_requests or None,
+            "ShmSize": parse_bytes(options["shm_size"]),
+            "Ulimits": ulimits or None,
+            "Memory": parse_bytes(options["mem_limit"]),
+        },
+    }
+
+
+async def _inspect(client: AsyncDockerClient, name: str):
+    try:
+        return await client.request(
+            "GET", f"/containers/{DOCKER_CONTAINER_PREFIX}{name}/json"
+        )
+    except DockerAPIError as e:
+        if e.status == 404:
+            return None
+        raise
+
+
+async def _wait_output(client: AsyncDockerClient, container_id: str, command, image):
+    result = await client.request(
+        "POST", f"/containers/{container_id}/wait", timeout=None
+    )
+    logs = await client.request(
+        "GET",
+        f"/containers/{container_id}/logs",
+        params={"stdout": "1", "stderr": "1"},
+    )
+    if result["StatusCode"] != 0:
+        raise Exception(
+            f"Command '{command}' in image '{image}' returned non-zero exit status "
+            f"{result['StatusCode']}: {_demux(logs, stdout=False).decode('utf-8')}"
+        )
+    return _demux(logs, stderr=False).decode("utf-8")
+
+
+async def _claim_pooled(client: AsyncDockerClient, image, command, options, suffix):
+    pool = _warm_pools.get(_pool_key(client.sync_client, image, command, options))
+    if pool is None:
+        return None
+    loop = asyncio.get_running_loop()
+    container_id = await loop.run_in_executor(None, pool.claim)
+    if container_id is None:
+        pool.record(False)
+        return None
+    start = time.time()
+    try:
+        await client.request(
+            "POST",
+            f"/containers/{container_id}/rename",
+            params={"name": f"{DOCKER_CONTAINER_PREFIX}{suffix}"},
+        )
+        await client.request("POST", f"/containers/{container_id}/start")
+    except BaseException:
+        # The claimed container is not in the pool anymore, do not leak it
+        await loop.run_in_executor(None, pool.remove, container_id)
+        raise
+    pool.record(True, time.time() - start)
+    return container_id
+
+
+async def run_container(
+    client: AsyncDockerClient,
+    image: str,
+    command: str,
+    cpu_count: int = None,
+    gpu_count: int = None,
+    name: str = None,
+    working_dir: str = None,
+    environment=None,
+    detach=False,
+    shm_size="64M",
+    ulimits=None,
+    labels=None,
+    memory=None,
+):
+    """Launch a docker container."""
+    suffix = name or "".join(
+        random.choices(string.ascii_lowercase + string.digits, k=24)
+    )
+    container_name = f"{DOCKER_CONTAINER_PREFIX}{suffix}"
+
+    assert name != "all", "Container name cannot be 'all'"
+
+    if await exists_container(client, suffix):
+        raise RuntimeError(f"Container {suffix} already exists")
+
+    options = _container_options(
+        cpu_count,
+        gpu_count,
+        working_dir,
+        environment,
+        shm_size,
+        ulimits,
+        labels,
+        memory,
+    )
+    container_id = None
+    if client.sync_client is not None:
+        async with client.limit("run"):
+            container_id = await _claim_pooled(client, image, command, options, suffix)
+    if container_id is None:
+        body = _create_body(image, command, options)
+        params = {"name": container_name}
+
+        async def create():
+            # Only the daemon calls count against the limit, not the pulls
+            async with client.limit("run"):
+                created = await client.request(
+                    "POST", "/containers/create", params=params, body=body
+                )
+                await client.request("POST", f"/containers/{created['Id']}/start")
+                return created["Id"]
+
+        try:
+            container_id = await create()
+        except DockerAPIError as e:
+            if e.status != 404 or "no such image" not in str(e).lower():
+                raise
+            # Pull the missing image, the same as `docker run`
+            if client.sync_client is not None:
+                # Share the pull with the concurrent launches
+                await asyncio.get_running_loop().run_in_executor(
+                    None, get_image_manager(client.sync_client).ensure, image
+                )
+            else:
+                repository, tag = _split_image(image)
+                pull_params = {"fromImage": repository}
+                if tag:
+                    pull_params["tag"] = tag
+                await client.request(
+                    "POST", "/images/create", params=pull_params, timeout=None
+                )
+            container_id = await create()
+    if client.index is not None:
+        client.index.update(suffix, container_id, "running")
+    if detach:
+        return suffix
+    output = await _wait_output(client, container_id, command, image)
+    if client.index is not None:
+        client.index.update(suffix, container_id, "exited")
+    return output
+
+
+async def run_many(client: AsyncDockerClient, specs: list) -> list:
+    """Launch a batch of docker containers.
+
+    The same as `docker_utils.run_many`, the launches are bounded by the
+    "run" operation limit of the client.
+    """
+    return await run_batch_async(
+        partial(run_container, client),
+        specs,
+        await list_containers(client),
+        client.operation_limits["run"],
+    )
+
+
+async def exists_container(client: AsyncDockerClient, name: str) -> bool:
+    """Check if a docker container exists."""
+    if client.index is not None:
+        return client.index.get(name) is not None
+    async with client.limit("read"):
+        return await _inspect(client, name) is not None
+
+
+async def status_container(client: AsyncDockerClient, name: str) -> str:
+    """Get the status of a docker container."""
+    if client.index is not None:
+        entry = client.index.get(name)
+    else:
+        async with client.limit("read"):
+            info = await _inspect(client, name)
+        entry = info and {"status": info["State"]["Status"]}
+    if entry is None:
+        raise Exception(f"Container {name} does not exist")
+    return entry["status"]
+
+
+async def list_containers(client: AsyncDockerClient) -> list:
+    """List the names of all docker containers."""
+    if client.index is not None:
+        return client.index.names()
+    async with client.limit("read"):
+        containers = await client.request(
+            "GET",
+            "/containers/json",
+            params={
+                "all": "1",
+                "filters": json.dumps({"name": [DOCKER_CONTAINER_PREFIX]}),
+            },
+        )
+    names = []
+    for container in containers:
+        for container_name in container.get("Names") or []:
+            container_name = container_name.lstrip("/")
+            if container_name.startswith(DOCKER_CONTAINER_PREFIX):
+                names.append(container_name[len(DOCKER_CONTAINER_PREFIX) :])
+    return names
+
+
+async def logs_container(
+    client: AsyncDockerClient, container_name: str, tail: int = None, since=None
+) -> str:
+    """Fetch the logs of a docker container."""
+    params = {
+        "stdout": "1",
+        "stderr": "1",
+        "tail": "all" if tail is None else str(tail),
+    }
+    if since is not None:
+        params["since"] = str(since)
+    async with client.limit("read"):
+        try:
+            logs = await client.request(
+                "GET",
+                f"/containers/{DOCKER_CONTAINER_PREFIX}{container_name}/logs",
+                params=params,
+            )
+        except DockerAPIError as e:
+            if e.status == 404:
+                raise Exception(f"Container {container_name} does not exist")
+            raise
+    return _demux(logs).decode("utf-8")
+
+
+async def read_logs(
+    client: AsyncDockerClient,
+    name: str,
+    offset: int = 0,
+    tail: int = None,
+    since=None,
+    max_bytes: int = DOCKER_LOG_MAX_BYTES,
+) -> dict:
+    """Read the logs of a docker container from a byte offset.
+
+    A call continuing from the offset returned by the previous one only reads
+    the new logs.
+    """
+    if tail == 0:
+        return {"logs": "", "offset": offset, "complete": True}
+    params = {"stdout": "1", "stderr": "1", "follow": "0", "timestamps": "1"}
+    key = (id(client), name, tail, since, offset)
+    position = _log_positions.get(key)
+    if position is not None:
+        # Resume at the timestamp of the last line read, the daemon takes it
+        # with nanoseconds
+        (seconds, nanoseconds), _, _ = position
+        params.update(tail="all", since=f"{seconds}.{nanoseconds:09d}")
+    else:
+        params["tail"] = "all" if tail is None else str(tail)
+        if since is not None:
+            params["since"] = str(since)
+    reader = TimestampedLogReader(offset, max_bytes, position)
+    chunks = client.stream(
+        f"/containers/{DOCKER_CONTAINER_PREFIX}{name}/logs", params=params
+    )
+    try:
+        async for payload in chunks:
+            if reader.feed(payload):
+                break
+    except DockerAPIError as e:
+        if e.status == 404:
+            raise Exception(f"Container {name} does not exist")
+        raise
+    finally:
+        await chunks.aclose()
+    result, position = reader.result()
+    _log_positions.put((id(client), name, tail, since, result["offset"]), position)
+    return result
+
+
+async def stream_logs(
+    client: AsyncDockerClient,
+    name: str,
+    offset: int = 0,
+    tail: int = None,
+    since=None,
+    follow=True,
+):
+    """Stream the logs of a docker container as chunks from a byte offset."""
+    params = {
+        "stdout": "1",
+        "stderr": "1",
+        "follow": "1" if follow else "0",
+        "tail": "all" if tail is None else str(tail),
+    }
+    if since is not None:
+        params["since"] = str(since)
+    cursor = LogCursor(offset)
+    try:
+        async for payload in client.stream(
+            f"/containers/{DOCKER_CONTAINER_PREFIX}{name}/logs", params=params
+        ):
+            chunk = cursor.feed(payload)
+            if chunk is not None:
+                yield chunk
+    except DockerAPIError as e:
+        if e.status == 404:
+            raise Exception(f"Container {name} does not exist")
+        raise
+
+
+async def _teardown_container(
+    client: AsyncDockerClient, name: str, container_id: str, timeout: int = None
+):
+    start = time.time()
+    result = {"name": name, "success": True, "error": None}
+    async with client.limit("stop"):
+        try:
+            if timeout == 0:
+                # A forced removal kills the container instead of stopping it
+                await client.request(
+                    "DELETE", f"/containers/{container_id}", params={"force": "1"}
+                )
+            else:
+                params = {"t": str(timeout)} if timeout is not None else None
+                await client.request(
+                    "POST",
+                    f"/containers/{container_id}/stop",
+                    params=params,
+                    timeout=None,
+                )
+                await client.request("DELETE", f"/containers/{container_id}")
+        except DockerAPIError as e:
+            if e.status != 404:
+                result["success"] = False
+                result["error"] = str(e)
+    if result["success"] and client.index is not None:
+        client.index.discard(name)
+    result["duration"] = time.time() - start
+    return result
+
+
+async def stop_container(client: AsyncDockerClient, name: str, timeout: int = None):
+    """Stop a docker container or all containers.
+
+    Stopping all containers tears them down concurrently, bounded by the
+    limit of the stop operations, and returns a report.
+    """
+    if name == "all":
+        start = time.time()
+        names = await list_containers(client)
+        results = await asyncio.gather(
+            *(
+                _teardown_container(client, n, f"{DOCKER_CONTAINER_PREFIX}{n}", timeout)
+                for n in names
+            )
+        )
+        return {"containers": list(results), "duration": time.time() - start}
+    if not await exists_container(client, name):
+        raise Exception(f"Container {name} does not exist")
+    result = await _teardown_container(
+        client, name, f"{DOCKER_CONTAINER_PREFIX}{name}", timeout
+    )
+    if not result["success"]:
+        raise Exception(f"Failed to stop container {name}: {result['error']}")
+
+
+async def ping_backend(client: AsyncDockerClient):
+    """Check that the docker daemon responds."""
+    async with client.limit("read"):
+        return await client.request("GET", "/_ping")
@@ -1,8 +1,736 @@
+import asyncio
+import collections
 import docker
+import json
 import random
 import string
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from hypha_services.utils import (
+    LogPositions,
+    iter_log_chunks,
+    iterate_in_executor,
+    read_timestamped_logs,
+    run_batch,
+)
 
 DOCKER_CONTAINER_PREFIX = "hypha-container-launcher-"
+DOCKER_INDEX_RESYNC_INTERVAL = 60  # seconds between consistency checks
+# Parallel teardowns, matching the size of the docker client connection pool
+DOCKER_STOP_WORKERS = 10
+DOCKER_RUN_WORKERS = 10
+DOCKER_LOG_MAX_BYTES = 1024 * 1024  # bytes returned by a single read_logs call
+DOCKER_LOG_POSITIONS = 1024  # log reads remembered to resume from
+DOCKER_POOL_PREFIX = "hypha-container-pool-"
+DOCKER_POOL_MAX_IDLE_AGE = 600  # seconds before an idle container is replaced
+DOCKER_POOL_CHECK_INTERVAL = 30  # seconds between checks for expired containers
+DOCKER_POOL_RETRY_INTERVAL = 10  # seconds before retrying a failed refill
+# Bytes of launcher images kept locally, None keeps all of them
+DOCKER_IMAGE_DISK_BUDGET = None
+DOCKER_IMAGE_MIN_AGE = 300  # seconds an ensured image is kept from eviction
+
+# Map docker container events to the resulting container status
+_EVENT_STATUS = {
+    "create": "created",
+    "start": "running",
+    "restart": "running",
+    "unpause": "running",
+    "pause": "paused",
+    "die": "exited",
+    "stop": "exited",
+}
+
+_container_indexes = {}
+_container_indexes_lock = threading.Lock()
+_log_positions = LogPositions(DOCKER_LOG_POSITIONS)
+_warm_pools = {}
+_warm_pools_lock = threading.Lock()
+_image_managers = {}
+_image_managers_lock = threading.Lock()
+
+
+class ContainerIndex:
+    """Keep an in-memory index of the launcher containers.
+
+    The index is seeded with a single listing and then kept current from the
+    docker events stream, a background thread periodically resyncs it against
+    the daemon to recover from missed events.
+    """
+
+    def __init__(self, client: any, resync_interval=DOCKER_INDEX_RESYNC_INTERVAL):
+        self.client = client
+        self.resync_interval = resync_interval
+        self._containers = {}
+        self._listeners = []
+        self._lock = threading.Lock()
+        # Updates and discards are numbered so that a resync does not undo the
+        # changes made while its listing was in flight
+        self._generation = 0
+        self._changed = {}
+        self._resync_lock = threading.Lock()
+        self._closed = threading.Event()
+        self._events = None
+        # Replay the events emitted while seeding the index
+        self._since = int(time.time())
+        self.resync()
+        self._event_thread = threading.Thread(target=self._watch_events, daemon=True)
+        self._event_thread.start()
+        self._resync_thread = threading.Thread(target=self._resync_loop, daemon=True)
+        self._resync_thread.start()
+
+    def resync(self):
+        """Rebuild the index from a listing of the launcher containers."""
+        with self._resync_lock:
+            with self._lock:
+                start = self._generation
+            # The low-level listing avoids one inspect round trip per container
+            containers = self.client.api.containers(
+                all=True, filters={"name": DOCKER_CONTAINER_PREFIX}
+            )
+            self._swap(start, containers)
+
+    def _swap(self, start: int, containers: list):
+        index = {}
+        for container in containers:
+            for name in container.get("Names") or []:
+                name = name.lstrip("/")
+                if name.startswith(DOCKER_CONTAINER_PREFIX):
+                    index[name[len(DOCKER_CONTAINER_PREFIX) :]] = {
+                        "id": container["Id"],
+                        "status": container["State"],
+                    }
+        with self._lock:
+            # The entries changed since the listing started are more recent
+            for name, generation in self._changed.items():
+                if generation <= start:
+                    continue
+                if name in self._containers:
+                    index[name] = self._containers[name]
+                else:
+                    index.pop(name, None)
+            self._changed.clear()
+            previous, self._containers = self._containers, index
+        changes = [(name, None) for name in previous if name not in index]
+        changes += [
+            (name, entry["status"])
+            for name, entry in index.items()
+            if previous.get(name, {}).get("status") != entry["status"]
+        ]
+        self._notify(changes)
+
+    def refresh(self, name: str):
+        """Update a single entry of the index from the daemon."""
+        try:
+            container = self.client.containers.get(f"{DOCKER_CONTAINER_PREFIX}{name}")
+        except docker.errors.NotFound:
+            self.discard(name)
+            return None
+        return self.update(name, container.id, container.status)
+
+    def update(self, name: str, container_id: str, status: str):
+        """Insert or update an entry of the index."""
+        entry = {"id": container_id, "status": status}
+        with self._lock:
+            self._generation += 1
+            self._changed[name] = self._generation
+            previous = self._containers.get(name)
+            self._containers[name] = entry
+        if previous is None or previous["status"] != status:
+            self._notify([(name, status)])
+        return entry
+
+    def discard(self, name: str):
+        """Remove an entry from the index."""
+        with self._lock:
+            self._generation += 1
+            self._changed[name] = self._generation
+            previous = self._containers.pop(name, None)
+        if previous is not None:
+            self._notify([(name, None)])
+
+    def add_listener(self, listener):
+        """Call `listener(name, status)` when the status of a container changes.
+
+        The status is None when the container has been removed.
+        """
+        self._listeners.append(listener)
+
+    def get(self, name: str):
+        """Return the entry of a container, or None if it is not indexed."""
+        with self._lock:
+            return self._containers.get(name)
+
+    def names(self) -> list:
+        """Return the names of all the indexed containers."""
+        with self._lock:
+            return list(self._containers.keys())
+
+    def close(self):
+        """Stop following the docker events stream."""
+        self._closed.set()
+        if self._events is not None:
+            self._events.close()
+
+    def _notify(self, changes):
+        for name, status in changes:
+            for listener in self._listeners:
+                try:
+                    listener(name, status)
+                except Exception as e:  # pylint: disable=broad-except
+                    print("Container listener failed:", e)
+
+    def _handle_event(self, event):
+        action = event.get("Action") or event.get("status") or ""
+        actor = event.get("Actor") or {}
+        attributes = actor.get("Attributes") or {}
+        container_name = attributes.get("name", "")
+        container_id = actor.get("ID") or event.get("id")
+        if event.get("time"):
+            self._since = max(self._since, event["time"])
+
+        if action == "rename":
+            old_name = attributes.get("oldName", "").lstrip("/")
+            if old_name.startswith(DOCKER_CONTAINER_PREFIX):
+                self.discard(old_name[len(DOCKER_CONTAINER_PREFIX) :])
+            if container_name.startswith(DOCKER_CONTAINER_PREFIX):
+                self.refresh(container_name[len(DOCKER_CONTAINER_PREFIX) :])
+            return
+
+        if not container_name.startswith(DOCKER_CONTAINER_PREFIX):
+            return
+        name = container_name[len(DOCKER_CONTAINER_PREFIX) :]
+        if action == "destroy":
+            self.discard(name)
+        elif action in _EVENT_STATUS:
+            self.update(name, container_id, _EVENT_STATUS[action])
+
+    def _watch_events(self):
+        while not self._closed.is_set():
+            try:
+                self._events = self.client.events(
+                    since=self._since, filters={"type": "container"}, decode=True
+                )
+                for event in self._events:
+                    self._handle_event(event)
+            except Exception as e:  # pylint: disable=broad-except
+                if self._closed.is_set():
+                    break
+                print("Docker events stream interrupted:", e)
+                self._closed.wait(1)
+                try:
+                    self.resync()
+                except Exception as e:  # pylint: disable=broad-except
+                    print("Failed to resync the container index:", e)
+
+    def _resync_loop(self):
+        while not self._closed.wait(self.resync_interval):
+            try:
+                self.resync()
+            except Exception as e:  # pylint: disable=broad-except
+                print("Failed to resync the container index:", e)
+
+
+def get_container_index(client: any) -> ContainerIndex:
+    """Return the container index of a docker client, creating it on first use."""
+    with _container_indexes_lock:
+        index = _container_indexes.get(id(client))
+        if index is None:
+            index = ContainerIndex(client)
+            _container_indexes[id(client)] = index
+        return index
+
+
+def _normalize_image(image: str) -> str:
+    _, tag = docker.utils.parse_repository_tag(image)
+    return image if tag else f"{image}:latest"
+
+
+class ImageManager:
+    """Pull the images of the launcher once and keep the most used ones local.
+
+    Concurrent requests for a missing image share a single pull. The images
+    used by the launcher are tracked in least-recently-used order, and the
+    oldest ones are removed when their total size exceeds `disk_budget`
+    bytes. The sizes include the layers shared between images, so the usage
+    is an upper bound. An image being ensured, or ensured less than `min_age`
+    seconds ago, is not removed: its container may not be created yet.
+    """
+
+    def __init__(
+        self,
+        client: any,
+        disk_budget: int = DOCKER_IMAGE_DISK_BUDGET,
+        min_age: float = DOCKER_IMAGE_MIN_AGE,
+    ):
+        self.client = client
+        self.disk_budget = disk_budget
+        self.min_age = min_age
+        self._images = collections.OrderedDict()
+        self._pulls = {}
+        self._ensuring = collections.Counter()
+        self._ensured_at = {}
+        self._lock = threading.Lock()
+
+    def ensure(self, image: str):
+        """Make sure an image is available locally, pulling it if needed."""
+        image = _normalize_image(image)
+        with self._lock:
+            self._ensuring[image] += 1
+        try:
+            pull, owner = self._request(image)
+            if pull is None:
+                return
+            if owner:
+                self._fetch(image, pull)
+            else:
+                pull["done"].wait()
+            if pull["status"] == "failed":
+                raise Exception(f"Failed to pull image {image}: {pull['error']}")
+        finally:
+            with self._lock:
+                self._ensuring[image] -= 1
+                if not self._ensuring[image]:
+                    del self._ensuring[image]
+                self._ensured_at[image] = time.time()
+
+    def invalidate(self, image: str):
+        """Forget that an image is local, e.g. after it was removed outside."""
+        with self._lock:
+            self._images.pop(_normalize_image(image), None)
+
+    def prefetch(self, image: str) -> dict:
+        """Start pulling an image in the background, return its pull status."""
+        image = _normalize_image(image)
+        pull, owner = self._request(image)
+        if owner:
+            threading.Thread(
+                target=self._fetch, args=(image, pull), daemon=True
+            ).start()
+        return self.status(image)
+
+    def status(self, image: str = None):
+        """Report the pull progress of an image, or of all images."""
+        if image is not None:
+            image = _normalize_image(image)
+            pull = self._pulls.get(image)
+            if pull is None:
+                raise Exception(f"Image {image} has not been requested")
+            return self._pull_status(image, pull)
+        with self._lock:
+            images = dict(self._images)
+            pulls = dict(self._pulls)
+        return {
+            "pulls": [self._pull_status(image, pull) for image, pull in pulls.items()],
+            "images": [{"image": k, "size": v} for k, v in images.items()],
+            "disk_usage": sum(images.values()),
+            "disk_budget": self.disk_budget,
+        }
+
+    def _request(self, image: str):
+        # Return the pull of an image and whether the caller has to run it,
+        # or None if the image is already local
+        with self._lock:
+            if image in self._images:
+                self._images.move_to_end(image)
+                return None, False
+            pull = self._pulls.get(image)
+            if pull is not None and pull["status"] == "pulling":
+                return pull, False
+            pull = self._pulls[image] = {
+                "status": "pulling",
+                "layers": {},
+                "error": None,
+                "started_at": time.time(),
+                "finished_at": None,
+                "done": threading.Event(),
+            }
+            return pull, True
+
+    @staticmethod
+    def _pull_status(image: str, pull: dict) -> dict:
+        layers = list(pull["layers"].values())
+        total = sum(layer[1] for layer in layers)
+        downloaded = sum(layer[0] for layer in layers)
+        return {
+            "image": image,
+            "status": pull["status"],
+            "downloaded": downloaded,
+            "total": total,
+            "progress": downloaded / total if total else None,
+            "error": pull["error"],
+            "duration": (pull["finished_at"] or time.time()) - pull["started_at"],
+        }
+
+    def _fetch(self, image: str, pull: dict):
+        try:
+            try:
+                info = self.client.api.inspect_image(image)
+            except docker.errors.ImageNotFound:
+                repository, tag = docker.utils.parse_repository_tag(image)
+                for event in self.client.api.pull(
+                    repository, tag=tag, stream=True, decode=True
+                ):
+                    if event.get("error"):
+                        raise Exception(event["error"])
+                    layer, detail = event.get("id"), event.get("progressDetail")
+                    if layer and detail and detail.get("total"):
+                        pull["layers"][layer] = (
+                            detail.get("current", 0),
+                            detail["total"],
+                        )
+                    elif layer in pull["layers"] and event.get("status") in (
+                        "Download complete",
+                        "Pull complete",
+                    ):
+                        total = pull["layers"][layer][1]
+                        pull["layers"][layer] = (total, total)
+                info = self.client.api.inspect_image(image)
+            with self._lock:
+                self._images[image] = info.get("Size") or 0
+                self._images.move_to_end(image)
+            pull["status"] = "ready"
+        except Exception as e:  # pylint: disable=broad-except
+            pull["status"] = "failed"
+            pull["error"] = str(e)
+        finally:
+            pull["finished_at"] = time.time()
+            pull["done"].set()
+        if pull["status"] == "ready":
+            self._evict(keep=image)
+
+    def _evict(self, keep: str):
+        if not self.disk_budget:
+            return
+        with self._lock:
+            usage = sum(self._images.values())
+            candidates = [image for image in self._images if image != keep]
+        # Oldest first, the images used by containers cannot be removed
+        for image in candidates:
+            if usage <= self.disk_budget:
+                break
+            with self._lock:
+                if image not in self._images or not self._evictable(image):
+                    continue
+                # Dropped before the removal, so a concurrent ensure pulls it
+                # again instead of finding it local
+                size = self._images.pop(image)
+                self._pulls.pop(image, None)
+                self._ensured_at.pop(image, None)
+            try:
+                self.client.api.remove_image(image)
+            except docker.errors.NotFound:
+                pass
+            except docker.errors.APIError as e:
+                print(f"Failed to evict image {image}:", e)
+                with self._lock:
+                    if image not in self._images:
+                        self._images[image] = size
+                        self._images.move_to_end(image, last=False)
+                continue
+            usage -= size
+
+    def _evictable(self, image: str) -> bool:
+        # Called with the lock held
+        if self._ensuring.get(image):
+            return False
+        return time.time() - self._ensured_at.get(image, 0) >= self.min_age
+
+
+def get_image_manager(client: any) -> ImageManager:
+    """Return the image manager of a docker client, creating it on first use."""
+    with _image_managers_lock:
+        manager = _image_managers.get(id(client))
+        if manager is None:
+            manager = ImageManager(client)
+            _image_managers[id(client)] = manager
+        return manager
+
+
+def prefetch_images(client: any, images: list, wait=False) -> list:
+    """Pull images ahead of the launches which need them.
+
+    The pulls run in the background unless `wait` is set, their progress is
+    reported by `image_status`.
+    """
+    manager = get_image_manager(client)
+    for image in images:
+        manager.prefetch(image)
+    if wait:
+        for image in images:
+            try:
+                manager.ensure(image)
+            except Exception as e:  # pylint: disable=broad-except
+                print(e)
+    return [manager.status(image) for image in images]
+
+
+def image_status(client: any, image: str = None):
+    """Report the pull progress of an image, or of all the launcher images."""
+    return get_image_manager(client).status(image)
+
+
+class WarmPool:
+    """Keep pre-created containers of a launch profile ready to be claimed.
+
+    The containers are created but not started, so they are idle until they
+    are claimed by run_container, which renames and starts them. A background
+    thread refills the pool to its target size and replaces the containers
+    older than `max_idle_age` seconds.
+    """
+
+    def __init__(
+        self,
+        client: any,
+        image: str,
+        command: str,
+        options: dict,
+        size: int = 1,
+        max_idle_age: float = DOCKER_POOL_MAX_IDLE_AGE,
+    ):
+        self.client = client
+        self.image = image
+        self.command = command
+        self.options = options
+        self.size = size
+        self.max_idle_age = max_idle_age
+        self.hits = 0
+        self.misses = 0
+        self._claim_times = collections.deque(maxlen=1000)
+        self._idle = collections.deque()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._closed = threading.Event()
+        self._thread = threading.Thread(target=self._refill_loop, daemon=True)
+        self._thread.start()
+
+    def claim(self):
+        """Take an idle container out of the pool, or None if it is empty."""
+        now = time.time()
+        claimed = None
+        expired = []
+        with self._lock:
+            while self._idle:
+                container_id, created_at = self._idle.popleft()
+                if now - created_at < self.max_idle_age:
+                    claimed = container_id
+                    break
+                expired.append(container_id)
+        self._wakeup.set()
+        # The daemon calls are made out of the lock, not to hold up other claims
+        for container_id in expired:
+            self.remove(container_id)
+        return claimed
+
+    def record(self, hit: bool, claim_time: float = None):
+        """Record the outcome of a claim."""
+        with self._lock:
+            if hit:
+                self.hits += 1
+                self._claim_times.append(claim_time)
+            else:
+                self.misses += 1
+
+    def stats(self) -> dict:
+        """Report the pool size, hit/miss counts and claim latency."""
+        with self._lock:
+            claim_times = sorted(self._claim_times)
+            idle = len(self._idle)
+        latency = {}
+        if claim_times:
+            latency = {
+                "mean": sum(claim_times) / len(claim_times),
+                "p50": claim_times[len(claim_times) // 2],
+                "p95": claim_times[int(len(claim_times) * 0.95)],
+                "max": claim_times[-1],
+            }
+        return {
+            "image": self.image,
+            "command": self.command,
+            "size": self.size,
+            "idle": idle,
+            "hits": self.hits,
+            "misses": self.misses,
+            "claim_latency": latency,
+        }
+
+    def close(self):
+        """Stop refilling the pool and remove the idle containers."""
+        self._closed.set()
+        self._wakeup.set()
+        with self._lock:
+            idle, self._idle = list(self._idle), collections.deque()
+        for container_id, _ in idle:
+            self.remove(container_id)
+
+    def remove(self, container_id: str):
+        """Remove a container taken out of the pool."""
+        try:
+            self.client.api.remove_container(container_id, force=True)
+        except docker.errors.APIError as e:
+            print("Failed to remove pooled container:", e)
+
+    def _create(self, retry: bool = True):
+        suffix = "".join(random.choices(string.ascii_lowercase + string.digits, k=24))
+        try:
+            container = self.client.containers.create(
+                self.image,
+                self.command,
+                name=f"{DOCKER_POOL_PREFIX}{suffix}",
+                **self.options,
+            )
+        except docker.errors.ImageNotFound:
+            if not retry:
+                raise
+            # The image may have been removed since the manager pulled it
+            manager = get_image_manager(self.client)
+            manager.invalidate(self.image)
+            manager.ensure(self.image)
+            return self._create(retry=False)
+        with self._lock:
+            closed = self._closed.is_set()
+            if not closed:
+                self._idle.append((container.id, time.time()))
+        if closed:
+            self.remove(container.id)
+
+    def _refill_loop(self):
+        while not self._closed.is_set():
+            self._wakeup.clear()
+            now = time.time()
+            with self._lock:
+                expired = [
+                    entry for entry in self._idle if now - entry[1] >= self.max_idle_age
+                ]
+                for entry in expired:
+                    self._idle.remove(entry)
+                missing = self.size - len(self._idle)
+            for container_id, _ in expired:
+                self.remove(container_id)
+            try:
+                for _ in range(missing):
+                    if self._closed.is_set():
+                        break
+                    self._create()
+            except Exception as e:  # pylint: disable=broad-except
+                print(f"Failed to refill the warm pool of {self.image}:", e)
+                self._closed.wait(DOCKER_POOL_RETRY_INTERVAL)
+                continue
+            self._wakeup.wait(min(self.max_idle_age, DOCKER_POOL_CHECK_INTERVAL))
+
+
+def _container_options(
+    cpu_count: int = None,
+    gpu_count: int = None,
+    working_dir: str = None,
+    environment=None,
+    shm_size="64M",
+    ulimits=None,
+    labels=None,
+    memory=None,
+) -> dict:
+    return {
+        "cpu_count": cpu_count,
+        "device_requests": [
+            {"driver": "nvidia", "count": gpu_count, "capabilities": [["gpu"]]}
+        ]
+        if gpu_count
+        else None,
+        "working_dir": working_dir,
+        "environment": environment,
+        "shm_size": shm_size,
+        "ulimits": ulimits,
+        "labels": labels,
+        "mem_limit": memory,
+    }
+
+
+def _pool_key(client: any, image: str, command: str, options: dict):
+    return (
+        id(client),
+        json.dumps([image, command, options], sort_keys=True, default=str),
+    )
+
+
+def configure_pool(
+    client: any,
+    image: str,
+    command: str,
+    size: int = 1,
+    max_idle_age: float = DOCKER_POOL_MAX_IDLE_AGE,
+    cpu_count: int = None,
+    gpu_count: int = None,
+    working_dir: str = None,
+    environment=None,
+    shm_size="64M",
+    ulimits=None,
+    labels=None,
+    memory=None,
+):
+    """Keep a warm pool of containers for a launch profile, size 0 removes it.
+
+    run_container claims a container from the pool when it is called with the
+    same image, command and options.
+    """
+    options = _container_options(
+        cpu_count,
+        gpu_count,
+        working_dir,
+        environment,
+        shm_size,
+        ulimits,
+        labels,
+        memory,
+    )
+    key = _pool_key(client, image, command, options)
+    with _warm_pools_lock:
+        if not any(k[0] == id(client) for k in _warm_pools):
+            # Clean up the idle containers left over by a previous process
+            for container in client.api.containers(
+                all=True, filters={"name": DOCKER_POOL_PREFIX}
+            ):
+                client.api.remove_container(container["Id"], force=True)
+        pool = _warm_pools.pop(key, None)
+        if pool is not None:
+            pool.close()
+        if size > 0:
+            _warm_pools[key] = WarmPool(
+                client, image, command, options, size=size, max_idle_age=max_idle_age
+            )
+
+
+def pool_stats(client: any) -> list:
+    """Report the statistics of the warm pools."""
+    with _warm_pools_lock:
+        pools = [pool for key, pool in _warm_pools.items() if key[0] == id(client)]
+    return [pool.stats() for pool in pools]
+
+
+def _run_pooled_container(
+    client: any, pool: WarmPool, container_id: str, suffix: str, detach: bool
+):
+    start = time.time()
+    try:
+        client.api.rename(container_id, f"{DOCKER_CONTAINER_PREFIX}{suffix}")
+        client.api.start(container_id)
+    except Exception:
+        # The claimed container is not in the pool anymore, do not leak it
+        pool.remove(container_id)
+        raise
+    pool.record(True, time.time() - start)
+    get_container_index(client).update(suffix, container_id, "running")
+    if detach:
+        return suffix
+    exit_status = client.api.wait(container_id)["StatusCode"]
+    if exit_status != 0:
+        stderr = client.api.logs(container_id, stdout=False, stderr=True)
+        raise docker.errors.ContainerError(
+            container_id, exit_status, pool.command, pool.image, stderr
+        )
+    get_container_index(client).refresh(suffix)
+    return client.api.logs(container_id, stdout=True, stderr=False).decode("utf-8")
 
 
 def run_container(
@@ -18,6 +746,7 @@ def run_container(
     shm_size="64M",
     ulimits=None,
     labels=None,
+    memory=None,
 ):
     """Launch a docker container."""
 
@@ -33,106 +762,262 @@ def run_container(
     if exists_container(client, suffix):
         raise RuntimeError(f"Container {suffix} already exists")
 
+    options = _container_options(
+        cpu_count,
+        gpu_count,
+        working_dir,
+        environment,
+        shm_size,
+        ulimits,
+        labels,
+        memory,
+    )
+    pool = _warm_pools.get(_pool_key(client, image, command, options))
+    if pool is not None:
+        container_id = pool.claim()
+        if container_id is not None:
+            return _run_pooled_container(client, pool, container_id, suffix, detach)
+        pool.record(False)
+
+    # Share the pull of a missing image with the concurrent launches
+    get_image_manager(client).ensure(image)
     ret = client.containers.run(
         image,
         command,
         detach=detach,
         name=container_name,
-        cpu_count=cpu_count,
-        device_requests=[
-            {"driver": "nvidia", "count": gpu_count, "capabilities": [["gpu"]]}
-        ]
-        if gpu_count
-        else None,
-        working_dir=working_dir,
-        environment=environment,
-        shm_size=shm_size,
-        ulimits=ulimits,
-        labels=labels,
+        **options,
     )
     if detach:
         assert ret.status in ["created", "running", "removing", "exited", "dead"], (
             "Failed to create the container, invalid status: " + ret.status
         )
+        get_container_index(client).update(suffix, ret.id, ret.status)
         return suffix
     else:
+        # The container has already exited, make it visible to the next reads
+        get_container_index(client).refresh(suffix)
         return ret.decode("utf-8")
 
 
+def run_many(client: any, specs: list, max_workers=DOCKER_RUN_WORKERS) -> list:
+    """Launch a batch of docker containers.
+
+    Each spec holds the arguments of `run_container`, the containers are
+    launched detached unless the spec sets `detach`. The names are validated
+    against a single listing and up to `max_workers` containers are created
+    concurrently. Returns the `name`, `success` and `error` of every spec.
+    """
+    return run_batch(
+        partial(run_container, client),
+        specs,
+        get_container_index(client).names(),
+        max_workers,
+    )
+
+
 def exists_container(client: any, name: str) -> bool:
-    container_name = f"{DOCKER_CONTAINER_PREFIX}{name}"
+    """Check if a docker container exists."""
+    return get_container_index(client).get(name) is not None
 
-    # Check if the container already exists
-    try:
-        client.containers.get(container_name)
-        return True
-    except docker.errors.NotFound:
-        return False
 
+def status_container(client: any, name: str) -> str:
+    """Get the status of a docker container."""
+    entry = get_container_index(client).get(name)
+    if entry is None:
+        raise Exception(f"Container {name} does not exist")
+    return entry["status"]
 
-def status_container(client: any, name: str) -> bool:
-    container_name = f"{DOCKER_CONTAINER_PREFIX}{name}"
-    container = client.containers.get(container_name)
-    return container.status
 
+def logs_container(
+    client: any, container_name: str, tail: int = None, since: float = None
+) -> str:
+    """Fetch the logs of a docker container.
 
-def logs_container(client: any, container_name: str) -> str:
-    """Fetch the logs of a docker container."""
+    `tail` limits the output to the last lines and `since` to the lines
+    written after a UNIX timestamp.
+    """
     try:
-        container = client.containers.get(f"{DOCKER_CONTAINER_PREFIX}{container_name}")
-        logs = container.logs()
+        logs = client.api.logs(
+            f"{DOCKER_CONTAINER_PREFIX}{container_name}",
+            tail="all" if tail is None else tail,
+            since=since,
+        )
         return logs.decode("utf-8")
     except docker.errors.NotFound:
         raise Exception(f"Container {container_name} does not exist")
 
 
+def _open_log_stream(
+    client: any,
+    name: str,
+    tail: int = None,
+    since: float = None,
+    follow=False,
+    timestamps=False,
+):
+    try:
+        return client.api.logs(
+            f"{DOCKER_CONTAINER_PREFIX}{name}",
+            stream=True,
+            follow=follow,
+            timestamps=timestamps,
+            tail="all" if tail is None else tail,
+            since=since,
+        )
+    except docker.errors.NotFound:
+        raise Exception(f"Container {name} does not exist")
+
+
+def read_logs(
+    client: any,
+    name: str,
+    offset: int = 0,
+    tail: int = None,
+    since: float = None,
+    max_bytes: int = DOCKER_LOG_MAX_BYTES,
+) -> dict:
+    """Read the logs of a docker container from a byte offset.
+
+    Returns the decoded `logs`, the `offset` to pass to the next call and
+    whether the end of the logs was reached (`complete`). The offset is
+    relative to the logs selected by `tail` and `since`. A call continuing
+    from the offset returned by the previous one only reads the new logs.
+    """
+    if tail == 0:
+        return {"logs": "", "offset": offset, "complete": True}
+    key = (id(client), name, tail, since, offset)
+    position = _log_positions.get(key)
+    if position is not None:
+        # Resume after the last line read, the logs before it are not read again
+        stream = _open_log_stream(
+            client, name, since=LogPositions.since(position), timestamps=True
+        )
+    else:
+        stream = _open_log_stream(client, name, tail=tail, since=since, timestamps=True)
+    try:
+        result, position = read_timestamped_logs(
+            stream, offset=offset, max_bytes=max_bytes, position=position
+        )
+    finally:
+        stream.close()
+    _log_positions.put((id(client), name, tail, since, result["offset"]), position)
+    return result
+
+
+async def stream_logs(
+    client: any,
+    name: str,
+    offset: int = 0,
+    tail: int = None,
+    since: float = None,
+    follow=True,
+):
+    """Stream the logs of a docker container as chunks from a byte offset.
+
+    Each chunk contains the decoded `logs` and the `offset` to resume from,
+    new output is followed until the container stops if `follow` is set.
+    """
+    loop = asyncio.get_running_loop()
+    stream = await loop.run_in_executor(
+        None, partial(_open_log_stream, client, name, tail, since, follow)
+    )
+    async for chunk in iterate_in_executor(
+        iter_log_chunks(stream, offset=offset), close=stream.close
+    ):
+        yield chunk
+
+
 def list_containers(client: any) -> list:
     """List the names of all docker containers."""
+    return get_container_index(client).names()
 
-    # Fetch all containers
-    containers = client.containers.list(all=True)
 
-    # Filter containers whose names start with errors
-    matching_containers = [
-        container.name[len(DOCKER_CONTAINER_PREFIX) :]
-        for container in containers
-        if container.name.startswith(DOCKER_CONTAINER_PREFIX)
-    ]
-    return matching_containers
+def _teardown_container(client: any, name: str, entry: dict, timeout: int = None):
+    """Stop and remove a single container, reporting the outcome."""
+    start = time.time()
+    result = {"name": name, "success": True, "error": None}
+    try:
+        if timeout == 0:
+            # A forced removal kills the container instead of stopping it
+            client.api.remove_container(entry["id"], force=True)
+        else:
+            if entry["status"] in ("running", "paused", "restarting"):
+                client.api.stop(entry["id"], timeout=timeout)
+            client.api.remove_container(entry["id"])
+    except docker.errors.NotFound:
+        pass
+    except Exception as e:  # pylint: disable=broad-except
+        result["success"] = False
+        result["error"] = str(e)
+    result["duration"] = time.time() - start
+    return result
 
 
-def stop_container(client: any, name: str):
-    """Stop a docker container or all containers."""
+def stop_container(
+    client: any, name: str, timeout: int = None, max_workers=DOCKER_STOP_WORKERS
+):
+    """Stop a docker container or all containers.
 
-    if name == "all":
-        containers = client.containers.list(all=True)
-        matching_containers = [
-            container
-            for container in containers
-            if container.name.startswith(DOCKER_CONTAINER_PREFIX)
-        ]
+    The timeout is the grace period in seconds before the container is killed,
+    the docker default is used if not specified and a timeout of 0 kills the
+    containers right away. When stopping all containers, they are torn down
+    concurrently by up to `max_workers` threads and a report is returned.
+    """
+    index = get_container_index(client)
 
-        for container in matching_containers:
-            container.stop()
-            container.remove()
+    if name == "all":
+        start = time.time()
+        entries = {}
+        for container_name in index.names():
+            entry = index.get(container_name)
+            if entry is not None:
+                entries[container_name] = entry
+        results = []
+        if entries:
+            with ThreadPoolExecutor(
+                max_workers=max(1, min(max_workers, len(entries)))
+            ) as executor:
+                futures = [
+                    executor.submit(
+                        _teardown_container, client, container_name, entry, timeout
+                    )
+                    for container_name, entry in entries.items()
+                ]
+                for future in futures:
+                    result = future.result()
+                    if result["success"]:
+                        index.discard(result["name"])
+                    results.append(result)
+        return {"containers": results, "duration": time.time() - start}
     else:
-        try:
-            container = client.containers.get(f"{DOCKER_CONTAINER_PREFIX}{name}")
-            if container.status == "running":
-                container.stop()
-            container.remove()
-        except docker.errors.NotFound:
+        # Fall back to the daemon in case the index has not caught up yet
+        entry = index.get(name) or index.refresh(name)
+        if entry is None:
             raise Exception(f"Container {name} does not exist")
+        result = _teardown_container(client, name, entry, timeout)
+        if not result["success"]:
+            raise Exception(f"Failed to stop container {name}: {result['error']}")
+        index.discard(name)
+
+
+def watch_containers(client: any, listener):
+    """Call `listener(name, status)` when a launcher container changes status."""
+    get_container_index(client).add_listener(listener)
+
+
+def ping_backend(client: any):
+    """Check that the docker daemon responds."""
+    return client.ping()
 
 
 def run_container_tests(client: any):
+    # Only the container of the test is stopped, not the running launches
     if exists_container(client, "test"):
         stop_container(client, "test")
     image: str = "alpine"
     command: str = "echo hello"
 
-    stop_container(client, "all")
-
     # Test run_container function
     print("Running test container...")
     ret = run_container(client, image, command, name="test", detach=False)
@@ -0,0 +1,91 @@
+"""Run background readiness probes for the hypha services."""
+import asyncio
+import socket
+import time
+
+HEALTH_CHECK_INTERVAL = 30  # seconds between two rounds of probes
+HEALTH_PROBE_TIMEOUT = 5  # seconds before a probe is considered failed
+
+
+class HealthMonitor:
+    """Periodically run lightweight probes and cache their results.
+
+    Probes are blocking callables run in the default executor, they are
+    considered healthy if they return without raising within the timeout.
+    """
+
+    def __init__(
+        self, interval: float = HEALTH_CHECK_INTERVAL, timeout=HEALTH_PROBE_TIMEOUT
+    ):
+        self.interval = interval
+        self.timeout = timeout
+        self._probes = {}
+        self._results = {}
+        self._task = None
+
+    def add_probe(self, name: str, probe):
+        """Register a probe under a name."""
+        self._probes[name] = probe
+
+    def start(self):
+        """Start running the probes in the background."""
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._run_forever())
+
+    def stop(self):
+        """Stop running the probes."""
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    async def check(self) -> dict:
+        """Run all the probes once and return the health status."""
+        await asyncio.gather(
+            *(self._run_probe(name, probe) for name, probe in self._probes.items())
+        )
+        return self.status()
+
+    def result(self, name: str):
+        """Return the last result of a probe, or None if it has not run yet."""
+        return self._results.get(name)
+
+    def status(self, context=None) -> dict:
+        """Return the cached health status with the latency of each probe."""
+        results = dict(self._results)
+        if len(results) < len(self._probes):
+            status = "starting"
+        elif all(result["ok"] for result in results.values()):
+            status = "ready"
+        else:
+            status = "degraded"
+        return {"status": status, "probes": results}
+
+    async def _run_probe(self, name: str, probe):
+        loop = asyncio.get_running_loop()
+        start = time.time()
+        try:
+            await asyncio.wait_for(
+                loop.run_in_executor(None, probe), timeout=self.timeout
+            )
+            error = None
+        except asyncio.TimeoutError:
+            error = f"Timed out after {self.timeout}s"
+        except Exception as e:  # pylint: disable=broad-except
+            error = str(e)
+        self._results[name] = {
+            "ok": error is None,
+            "error": error,
+            "latency": time.time() - start,
+            "checked_at": time.time(),
+        }
+
+    async def _run_forever(self):
+        while True:
+            await self.check()
+            await asyncio.sleep(self.interval)
+
+
+def probe_tcp(host: str, port: int, timeout=HEALTH_PROBE_TIMEOUT):
+    """Check that a TCP port accepts connections."""
+    with socket.create_connection((host, int(port)), timeout=timeout):
+        pass
@@ -1,6 +1,10 @@
+import asyncio
 import random
 import string
-from kubernetes import config, client
+import threading
+import time
+from functools import partial
+from kubernetes import config, client, watch
 from kubernetes.client.models import (
     V1Pod,
     V1ObjectMeta,
@@ -9,8 +13,182 @@ from kubernetes.client.models import (
     V1ResourceRequirements,
 )
 
+from hypha_services.utils import (
+    LogPositions,
+    iter_log_chunks,
+    iterate_in_executor,
+    parse_bytes,
+    read_timestamped_logs,
+    run_batch,
+)
+
 K8S_POD_PREFIX = "hypha-container-launcher-"
 NAMESPACE = "default"  # global namespace variable
+K8S_POD_LABELS = {"app.kubernetes.io/managed-by": "hypha-container-launcher"}
+K8S_LABEL_SELECTOR = ",".join(f"{k}={v}" for k, v in K8S_POD_LABELS.items())
+K8S_WATCH_TIMEOUT = 300  # seconds before a watch request is renewed
+K8S_LOG_MAX_BYTES = 1024 * 1024  # bytes returned by a single read_logs call
+K8S_LOG_CHUNK_SIZE = 64 * 1024
+K8S_LOG_POSITIONS = 1024  # log reads remembered to resume from
+K8S_RUN_WORKERS = 16  # pods created concurrently by run_many
+
+_pod_informers = {}
+_pod_informers_lock = threading.Lock()
+_log_positions = LogPositions(K8S_LOG_POSITIONS)
+
+
+def pod_phase(pod: V1Pod) -> str:
+    """Return the phase of a pod."""
+    return pod.status.phase if pod.status and pod.status.phase else "Pending"
+
+
+class PodInformer:
+    """Keep an in-memory cache of the launcher pods.
+
+    The cache is filled with a single labelled list request and then kept
+    current by watching from the returned resourceVersion, the watch resumes
+    from the last seen resourceVersion and relists when it has expired.
+    """
+
+    def __init__(self, client_api, namespace: str = NAMESPACE):
+        self.client_api = client_api
+        self.namespace = namespace
+        self._pods = {}
+        self._listeners = []
+        self._lock = threading.Lock()
+        self._closed = threading.Event()
+        self._watch = None
+        self._resource_version = None
+        self.relist()
+        self._thread = threading.Thread(target=self._watch_pods, daemon=True)
+        self._thread.start()
+
+    def relist(self):
+        """Rebuild the cache from a list of the launcher pods."""
+        pods = self.client_api.list_namespaced_pod(
+            namespace=self.namespace, label_selector=K8S_LABEL_SELECTOR
+        )
+        cache = {}
+        for pod in pods.items:
+            if self._is_active(pod):
+                cache[pod.metadata.name[len(K8S_POD_PREFIX) :]] = pod
+        with self._lock:
+            previous, self._pods = self._pods, cache
+            self._resource_version = pods.metadata.resource_version
+        changes = [(name, None) for name in previous if name not in cache]
+        changes += [
+            (name, pod_phase(pod))
+            for name, pod in cache.items()
+            if name not in previous or pod_phase(previous[name]) != pod_phase(pod)
+        ]
+        self._notify(changes)
+
+    def update(self, pod: V1Pod):
+        """Insert, update or remove a pod of the cache."""
+        name = pod.metadata.name
+        if not name.startswith(K8S_POD_PREFIX):
+            return
+        name = name[len(K8S_POD_PREFIX) :]
+        if not self._is_active(pod):
+            self.discard(name)
+            return
+        with self._lock:
+            previous = self._pods.get(name)
+            self._pods[name] = pod
+        if previous is None or pod_phase(previous) != pod_phase(pod):
+            self._notify([(name, pod_phase(pod))])
+
+    def discard(self, name: str):
+        """Remove a pod from the cache."""
+        with self._lock:
+            previous = self._pods.pop(name, None)
+        if previous is not None:
+            self._notify([(name, None)])
+
+    def add_listener(self, listener):
+        """Call `listener(name, phase)` when the phase of a pod changes.
+
+        The phase is None when the pod has been deleted.
+        """
+        self._listeners.append(listener)
+
+    def get(self, name: str):
+        """Return the cached pod, or None if it is not known."""
+        with self._lock:
+            return self._pods.get(name)
+
+    def names(self) -> list:
+        """Return the names of all the cached pods."""
+        with self._lock:
+            return list(self._pods.keys())
+
+    def close(self):
+        """Stop watching the launcher pods."""
+        self._closed.set()
+        if self._watch is not None:
+            self._watch.stop()
+
+    def _notify(self, changes):
+        for name, phase in changes:
+            for listener in self._listeners:
+                try:
+                    listener(name, phase)
+                except Exception as e:  # pylint: disable=broad-except
+                    print("Pod listener failed:", e)
+
+    @staticmethod
+    def _is_active(pod: V1Pod) -> bool:
+        # Pods being deleted are no longer reported as launcher containers
+        return pod.metadata.deletion_timestamp is None
+
+    def _watch_pods(self):
+        while not self._closed.is_set():
+            self._watch = watch.Watch()
+            try:
+                for event in self._watch.stream(
+                    self.client_api.list_namespaced_pod,
+                    namespace=self.namespace,
+                    label_selector=K8S_LABEL_SELECTOR,
+                    resource_version=self._resource_version,
+                    timeout_seconds=K8S_WATCH_TIMEOUT,
+                    allow_watch_bookmarks=True,
+                ):
+                    pod = event["object"]
+                    self._resource_version = pod.metadata.resource_version
+                    if event["type"] in ("ADDED", "MODIFIED"):
+                        self.update(pod)
+                    elif event["type"] == "DELETED":
+                        self.discard(pod.metadata.name[len(K8S_POD_PREFIX) :])
+            except client.exceptions.ApiException as e:
+                if self._closed.is_set():
+                    break
+                if e.status != 410:
+                    print("Pod watch interrupted:", e)
+                    self._closed.wait(1)
+                # The resourceVersion is too old or unknown, start from a new list
+                self._relist_safely()
+            except Exception as e:  # pylint: disable=broad-except
+                if self._closed.is_set():
+                    break
+                print("Pod watch interrupted:", e)
+                self._closed.wait(1)
+                self._relist_safely()
+
+    def _relist_safely(self):
+        try:
+            self.relist()
+        except Exception as e:  # pylint: disable=broad-except
+            print("Failed to relist the launcher pods:", e)
+
+
+def get_pod_informer(client_api) -> PodInformer:
+    """Return the pod informer of a kubernetes client, creating it on first use."""
+    with _pod_informers_lock:
+        informer = _pod_informers.get(id(client_api))
+        if informer is None:
+            informer = PodInformer(client_api)
+            _pod_informers[id(client_api)] = informer
+        return informer
 
 
 def run_container(
@@ -25,6 +203,7 @@ def run_container(
     shm_size="64M",
     ulimits=None,
     labels=None,
+    memory=None,
 ):
     # Generate a random suffix for the pod name
     suffix = name or "".join(
@@ -32,44 +211,107 @@ def run_container(
     )
     pod_name = f"{K8S_POD_PREFIX}{suffix}"
 
+    assert name != "all", "Container name cannot be 'all'"
+
+    # The sizes are given the docker way (64g), which is not a kubernetes
+    # quantity, the limit is set in bytes instead
+    memory = str(parse_bytes(memory)) if memory is not None else None
+    limits = {"cpu": cpu_count, "nvidia.com/gpu": gpu_count, "memory": memory}
+    limits = {k: v for k, v in limits.items() if v is not None}
+
     pod = V1Pod(
-        metadata=V1ObjectMeta(name=pod_name),
+        metadata=V1ObjectMeta(
+            name=pod_name, labels={**(labels or {}), **K8S_POD_LABELS}
+        ),
         spec=V1PodSpec(
             containers=[
                 V1Container(
                     name=pod_name,
                     image=image,
                     command=command.split(" "),
-                    resources=V1ResourceRequirements(
-                        limits={"cpu": cpu_count, "nvidia.com/gpu": gpu_count}
-                        if cpu_count or gpu_count
-                        else None
-                    ),
+                    resources=V1ResourceRequirements(limits=limits or None),
                 )
             ]
         ),
     )
-    client_api.create_namespaced_pod(namespace=NAMESPACE, body=pod)
+    created = client_api.create_namespaced_pod(namespace=NAMESPACE, body=pod)
+    get_pod_informer(client_api).update(created)
     return suffix
 
 
+def run_many(client_api, specs: list, max_workers=K8S_RUN_WORKERS) -> list:
+    """Launch a batch of pods.
+
+    Each spec holds the arguments of `run_container`. The names are
+    validated against the informer cache and up to `max_workers` pods are
+    created concurrently. Returns the `name`, `success` and `error` of
+    every spec.
+    """
+    return run_batch(
+        partial(run_container, client_api),
+        specs,
+        get_pod_informer(client_api).names(),
+        max_workers,
+    )
+
+
 def exists_container(client_api, name: str) -> bool:
+    return get_pod_informer(client_api).get(name) is not None
+
+
+def status_container(client_api, name: str) -> str:
+    pod = get_pod_informer(client_api).get(name)
+    if pod is None:
+        raise Exception(f"Pod {name} does not exist")
+    return pod_phase(pod)
+
+
+def _since_seconds(since: float = None):
+    # The API server takes a relative duration instead of a timestamp
+    if since is None:
+        return None
+    return max(1, int(time.time() - since))
+
+
+def logs_container(client_api, name: str, tail: int = None, since: float = None) -> str:
     pod_name = f"{K8S_POD_PREFIX}{name}"
     try:
-        client_api.read_namespaced_pod(name=pod_name, namespace=NAMESPACE)
-        return True
+        logs = client_api.read_namespaced_pod_log(
+            name=pod_name,
+            namespace=NAMESPACE,
+            tail_lines=tail,
+            since_seconds=_since_seconds(since),
+        )
+        return logs
     except client.exceptions.ApiException as e:
         if e.status == 404:
-            return False
+            raise Exception(f"Pod {name} does not exist")
         else:
             raise
 
 
-def logs_container(client_api, name: str) -> str:
+def _open_log_stream(
+    client_api,
+    name: str,
+    tail: int = None,
+    since: float = None,
+    follow=False,
+    timestamps=False,
+    since_seconds: int = None,
+):
     pod_name = f"{K8S_POD_PREFIX}{name}"
+    if since_seconds is None:
+        since_seconds = _since_seconds(since)
     try:
-        logs = client_api.read_namespaced_pod_log(name=pod_name, namespace=NAMESPACE)
-        return logs
+        return client_api.read_namespaced_pod_log(
+            name=pod_name,
+            namespace=NAMESPACE,
+            follow=follow,
+            tail_lines=tail,
+            since_seconds=since_seconds,
+            timestamps=timestamps,
+            _preload_content=False,
+        )
     except client.exceptions.ApiException as e:
         if e.status == 404:
             raise Exception(f"Pod {name} does not exist")
@@ -77,38 +319,124 @@ def logs_container(client_api, name: str) -> str:
             raise
 
 
+def read_logs(
+    client_api,
+    name: str,
+    offset: int = 0,
+    tail: int = None,
+    since: float = None,
+    max_bytes: int = K8S_LOG_MAX_BYTES,
+) -> dict:
+    if tail == 0:
+        return {"logs": "", "offset": offset, "complete": True}
+    key = (id(client_api), name, tail, since, offset)
+    position = _log_positions.get(key)
+    if position is not None:
+        # Resume after the last line read, rounding the duration up as the
+        # lines before the position are skipped anyway
+        since_seconds = int(time.time() - LogPositions.since(position)) + 1
+        response = _open_log_stream(
+            client_api, name, timestamps=True, since_seconds=since_seconds
+        )
+    else:
+        response = _open_log_stream(
+            client_api, name, tail=tail, since=since, timestamps=True
+        )
+    try:
+        result, position = read_timestamped_logs(
+            response.stream(K8S_LOG_CHUNK_SIZE),
+            offset=offset,
+            max_bytes=max_bytes,
+            position=position,
+        )
+    finally:
+        response.release_conn()
+    _log_positions.put((id(client_api), name, tail, since, result["offset"]), position)
+    return result
+
+
+async def stream_logs(
+    client_api,
+    name: str,
+    offset: int = 0,
+    tail: int = None,
+    since: float = None,
+    follow=True,
+):
+    loop = asyncio.get_running_loop()
+    response = await loop.run_in_executor(
+        None, partial(_open_log_stream, client_api, name, tail, since, follow)
+    )
+    async for chunk in iterate_in_executor(
+        iter_log_chunks(response.stream(K8S_LOG_CHUNK_SIZE), offset=offset),
+        close=response.close,
+    ):
+        yield chunk
+
+
 def list_containers(client_api) -> list:
-    pods = client_api.list_namespaced_pod(namespace=NAMESPACE)
-    matching_pods = [
-        pod.metadata.name[len(K8S_POD_PREFIX) :]
-        for pod in pods.items
-        if pod.metadata.name.startswith(K8S_POD_PREFIX)
-    ]
-    return matching_pods
+    return get_pod_informer(client_api).names()
 
 
-def stop_container(client_api, name: str):
-    if name == "all":
-        pods = client_api.list_namespaced_pod(namespace=NAMESPACE)
-        matching_pods = [
-            pod for pod in pods.items if pod.metadata.name.startswith(K8S_POD_PREFIX)
-        ]
+def stop_container(client_api, name: str, timeout: int = 0):
+    """Delete a pod or all the launcher pods.
 
-        for pod in matching_pods:
-            client_api.delete_namespaced_pod(
-                name=pod.metadata.name, namespace=NAMESPACE, grace_period_seconds=0
+    The timeout is the grace period in seconds given to the pods. All the
+    launcher pods are deleted with a single request by label and a report
+    is returned.
+    """
+    informer = get_pod_informer(client_api)
+    if name == "all":
+        start = time.time()
+        pod_suffixes = informer.names()
+        error = None
+        try:
+            client_api.delete_collection_namespaced_pod(
+                namespace=NAMESPACE,
+                label_selector=K8S_LABEL_SELECTOR,
+                grace_period_seconds=timeout,
             )
+        except client.exceptions.ApiException as e:
+            error = str(e)
+        duration = time.time() - start
+        if error is None:
+            for pod_suffix in pod_suffixes:
+                informer.discard(pod_suffix)
+        return {
+            "containers": [
+                {
+                    "name": pod_suffix,
+                    "success": error is None,
+                    "error": error,
+                    "duration": duration,
+                }
+                for pod_suffix in pod_suffixes
+            ],
+            "duration": duration,
+        }
     else:
         pod_name = f"{K8S_POD_PREFIX}{name}"
         try:
             client_api.delete_namespaced_pod(
-                name=pod_name, namespace=NAMESPACE, grace_period_seconds=0
+                name=pod_name, namespace=NAMESPACE, grace_period_seconds=timeout
             )
         except client.exceptions.ApiException as e:
             if e.status == 404:
+                informer.discard(name)
                 raise Exception(f"Pod {name} does not exist")
             else:
                 raise
+        informer.discard(name)
+
+
+def watch_containers(client_api, listener):
+    """Call `listener(name, phase)` when a launcher pod changes phase."""
+    get_pod_informer(client_api).add_listener(listener)
+
+
+def ping_backend(client_api):
+    """Check that the API server responds with its version."""
+    return client.VersionApi(client_api.api_client).get_code()
 
 
 def run_container_tests(client_api: any):
@@ -119,7 +447,7 @@ def run_container_tests(client_api: any):
     print("Running test pod...")
     if exists_container(client_api, "test"):
         stop_container(client_api, "test")
-    run_container(client_api, "test", image, command)
+    run_container(client_api, image, command, name="test")
     print("Test pod running.")
 
     # Test logs_pod function
@@ -130,7 +458,7 @@ def run_container_tests(client_api: any):
 
     # Test list_pod function
     print("Listing pods...")
-    pod_list = list_containers()
+    pod_list = list_containers(client_api)
     assert any("test" in s for s in pod_list), "Failed to list the test pod"
     print("Pods listed.")
 
@@ -1,28 +1,54 @@
 import asyncio
 import base64
+import collections
 import hashlib
 import hmac
+import json
 import os
-import socket
 import time
 from functools import partial
 
+IMPORT_START_TIME = time.time()
+
 from imjoy_rpc.hypha import connect_to_server
 
-from hypha_services.utils import pip_install
+from hypha_services.health import HealthMonitor, probe_tcp
+from hypha_services.metrics import registry
+from hypha_services.scheduler import ContainerScheduler
+from hypha_services.utils import install_requirements, parse_bytes
 
 
 COTURN_SECRET = os.getenv("COTURN_SECRET")
 assert COTURN_SECRET, "COTURN_SECRET is not set"
 COTURN_PORT = os.getenv("COTURN_PORT", "3478")
+# Comma separated host:port list, defaults to the host of the public base url
+COTURN_ENDPOINTS = os.getenv("COTURN_ENDPOINTS")
+COTURN_STATUS_TTL = 90  # seconds before a coturn probe result is stale
+COTURN_CREDENTIAL_MIN_REMAINING = 3600  # seconds left before renewal
+COTURN_CREDENTIAL_CACHE_SIZE = 10000
+USE_KUBERNETES = bool(os.getenv("KUBERNETES_SERVICE_HOST"))
+DOCKER_ASYNC_BACKEND = os.getenv("DOCKER_ASYNC_BACKEND", "0") == "1"
+# JSON resources available to the launched containers, e.g.
+# {"cpu": 16, "gpu": 2, "memory": "64g"}, launches are queued when set
+CONTAINER_CAPACITY = os.getenv("CONTAINER_CAPACITY")
+# Disk space for the launcher images, e.g. "50g", the least recently used
+# images are removed beyond it
+IMAGE_DISK_BUDGET = os.getenv("IMAGE_DISK_BUDGET")
+# Comma separated Ray cluster addresses the functions are routed across, the
+# extra ones must be Ray client (ray://) addresses
+RAY_ADDRESSES = os.getenv("RAY_ADDRESSES", "ray://ray-head:10001")
+# GPUs serving cellpose, defaults to the GPUs of the Ray cluster at startup
+CELLPOSE_GPUS = int(os.getenv("CELLPOSE_GPUS", "0"))
 
-pip_install("ray[default]")
-pip_install("cloudpickle")
+# Only call pip for the requirements which are not installed yet
+installed = install_requirements(
+    ["ray[default]", "cloudpickle", "kubernetes" if USE_KUBERNETES else "docker"]
+    + (["aiohttp"] if DOCKER_ASYNC_BACKEND else [])
+)
 from hypha_services.ray_utils import register_function_launcher
 
 
-if os.getenv("KUBERNETES_SERVICE_HOST"):
-    pip_install("kubernetes")
+if USE_KUBERNETES:
     from kubernetes import client as k8s_client
 
     from hypha_services.k8s_utils import *
@@ -31,45 +57,79 @@ if os.getenv("KUBERNETES_SERVICE_HOST"):
 
     client = k8s_client.CoreV1Api()
 else:
-    pip_install("docker")
     import docker
 
     from hypha_services.docker_utils import *
 
     client = docker.from_env()
+    if IMAGE_DISK_BUDGET:
+        get_image_manager(client).disk_budget = parse_bytes(IMAGE_DISK_BUDGET)
 
+health_monitor = HealthMonitor()
+coturn_credentials = collections.OrderedDict()
 
-def get_rtc_ice_servers(public_base_url, ttl=12 * 3600, context=None):
-    """Get the RTC ice servers."""
-    # TTL is the time to live in seconds
-    user_name = context["user"]["id"]
-    secret = COTURN_SECRET
-    timestamp = int(time.time()) + ttl
+IMPORT_TIME = time.time() - IMPORT_START_TIME
+print(f"Imported hypha services in {IMPORT_TIME:.2f}s, installed: {installed}")
+
+
+def get_coturn_endpoints(public_base_url):
+    """Get the coturn endpoints from COTURN_ENDPOINTS or the public base url."""
+    if COTURN_ENDPOINTS:
+        endpoints = [e.strip().rsplit(":", 1) for e in COTURN_ENDPOINTS.split(",")]
+        return [(host, int(port)) for host, port in endpoints]
+    return [(public_base_url.split("://")[1], int(COTURN_PORT))]
+
+
+def get_coturn_credential(user_name, ttl):
+    """Get the coturn credential of a user, reusing it until close to expiry."""
+    now = time.time()
+    cached = coturn_credentials.get((user_name, ttl))
+    # Renew the credential when less than a quarter of its lifetime is left
+    if cached and cached[2] - now > min(COTURN_CREDENTIAL_MIN_REMAINING, ttl / 4):
+        coturn_credentials.move_to_end((user_name, ttl))
+        return cached[0], cached[1]
+    # Drop the least recently used credentials beyond the size of the cache
+    coturn_credentials.pop((user_name, ttl), None)
+    while len(coturn_credentials) >= COTURN_CREDENTIAL_CACHE_SIZE:
+        coturn_credentials.popitem(last=False)
+    timestamp = int(now) + ttl
     username = str(timestamp) + ":" + user_name
-    dig = hmac.new(secret.encode(), username.encode(), hashlib.sha1).digest()
+    dig = hmac.new(COTURN_SECRET.encode(), username.encode(), hashlib.sha1).digest()
     credential = base64.b64encode(dig).decode()
-    hostname = public_base_url.split("://")[1]
+    coturn_credentials[(user_name, ttl)] = (username, credential, timestamp)
+    return username, credential
 
-    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    sock.settimeout(5)  # Timeout for the connect operation
 
-    try:
-        sock.connect((hostname, int(COTURN_PORT)))
-    except socket.error as error:
-        raise Exception(f"The coturn server ({hostname}:{COTURN_PORT}) is down")
+def get_rtc_ice_servers(endpoints, ttl=12 * 3600, context=None):
+    """Get the RTC ice servers."""
+    # TTL is the time to live in seconds
+    username, credential = get_coturn_credential(context["user"]["id"], ttl)
 
-    finally:
-        sock.close()
+    # Order the endpoints by the latency of their last health probe, endpoints
+    # which have not been probed recently are tried last
+    now = time.time()
+    healthy, unknown = [], []
+    for hostname, port in endpoints:
+        result = health_monitor.result(f"coturn:{hostname}:{port}")
+        if result is None or now - result["checked_at"] > COTURN_STATUS_TTL:
+            unknown.append((hostname, port))
+        elif result["ok"]:
+            healthy.append((result["latency"], hostname, port))
+    available = [(h, p) for _, h, p in sorted(healthy)] + unknown
+    if not available:
+        down = ", ".join(f"{h}:{p}" for h, p in endpoints)
+        raise Exception(f"The coturn server ({down}) is down")
 
     return [
         {
             "username": username,
             "credential": credential,
             "urls": [
-                f"turn:{hostname}:{COTURN_PORT}",
-                f"stun:{hostname}:{COTURN_PORT}",
+                f"turn:{hostname}:{port}",
+                f"stun:{hostname}:{port}",
             ],
         }
+        for hostname, port in available
     ]
 
 
@@ -77,69 +137,137 @@ async def hypha_startup(server):
     """Hypha startup function for registering additional services."""
     # The server object is the same as the one in the client script
     # You can register more functions or call other functions in the server object
-    loop = asyncio.get_running_loop()
-    try:
-        await loop.run_in_executor(None, run_container_tests, client)
-    except Exception as e:
-        print("Failed to run docker tests:", e)
-        loop.stop()
+    start_time = time.time()
+    # Probe the backend in the background instead of blocking the registration,
+    # the end-to-end self-test is only run on demand with `run_tests`
+    health_monitor.add_probe("container-backend", partial(ping_backend, client))
 
-    await server.register_service(
-        {
-            "name": "Container Launcher",
-            "id": "container-launcher",
-            "config": {
-                "visibility": "public",
-                "require_context": False,
-                "run_in_executor": True,
-            },
-            "run": partial(run_container, client),
-            "exists": partial(exists_container, client),
-            "logs": partial(logs_container, client),
-            "list": partial(list_containers, client),
-            "stop": partial(stop_container, client),
-            "status": partial(status_container, client),
-            "run_tests": partial(run_container_tests, client),
-        }
-    )
+    container_launcher = {
+        "name": "Container Launcher",
+        "id": "container-launcher",
+        "config": {
+            "visibility": "public",
+            "require_context": False,
+            "run_in_executor": True,
+        },
+        "run": partial(run_container, client),
+        "run_many": partial(run_many, client),
+        "exists": partial(exists_container, client),
+        "logs": partial(logs_container, client),
+        "read_logs": partial(read_logs, client),
+        "list": partial(list_containers, client),
+        "stop": partial(stop_container, client),
+        "status": partial(status_container, client),
+        "run_tests": partial(run_container_tests, client),
+        "health": health_monitor.status,
+    }
+    if not USE_KUBERNETES:
+        # Warm pools and image prefetching are only supported by the docker backend
+        container_launcher["configure_pool"] = partial(configure_pool, client)
+        container_launcher["pool_stats"] = partial(pool_stats, client)
+        container_launcher["prefetch"] = partial(prefetch_images, client)
+        container_launcher["image_status"] = partial(image_status, client)
+    if not USE_KUBERNETES and DOCKER_ASYNC_BACKEND:
+        from hypha_services import docker_async_utils
+
+        # Serve the container operations as coroutines instead of executor threads
+        async_client = docker_async_utils.AsyncDockerClient(client)
+        container_launcher.update(
+            {
+                "run": partial(docker_async_utils.run_container, async_client),
+                "run_many": partial(docker_async_utils.run_many, async_client),
+                "exists": partial(docker_async_utils.exists_container, async_client),
+                "logs": partial(docker_async_utils.logs_container, async_client),
+                "read_logs": partial(docker_async_utils.read_logs, async_client),
+                "stream_logs": partial(docker_async_utils.stream_logs, async_client),
+                "list": partial(docker_async_utils.list_containers, async_client),
+                "stop": partial(docker_async_utils.stop_container, async_client),
+                "status": partial(docker_async_utils.status_container, async_client),
+            }
+        )
+    if CONTAINER_CAPACITY:
+        # Queue the launches which do not fit in the remaining capacity
+        scheduler = ContainerScheduler(
+            container_launcher["run"], json.loads(CONTAINER_CAPACITY)
+        )
+        watch_containers(client, scheduler.container_changed)
+        container_launcher["run"] = scheduler.run
+        container_launcher["run_many"] = scheduler.run_many
+        container_launcher["queue"] = scheduler.queue_status
+        container_launcher["scheduler_stats"] = scheduler.stats
+    container_launcher = registry.instrument_service(container_launcher)
+    container_launcher["get_metrics"] = registry.get_metrics
+    container_launcher["get_prometheus_metrics"] = registry.get_prometheus_metrics
+    await server.register_service(container_launcher)
     print("Registered container launcher service")
 
+    coturn_endpoints = get_coturn_endpoints(server.config["public_base_url"])
+    for hostname, port in coturn_endpoints:
+        health_monitor.add_probe(
+            f"coturn:{hostname}:{port}", partial(probe_tcp, hostname, port)
+        )
+    health_monitor.start()
+
     await server.register_service(
-        {
-            "id": "coturn",
-            "config": {
-                "visibility": "public",
-                "require_context": True,
-            },
-            "get_rtc_ice_servers": partial(get_rtc_ice_servers, server.config['public_base_url']),
-        }
+        registry.instrument_service(
+            {
+                "id": "coturn",
+                "config": {
+                    "visibility": "public",
+                    "require_context": True,
+                },
+                "get_rtc_ice_servers": partial(get_rtc_ice_servers, coturn_endpoints),
+            }
+        )
     )
     print("Registered coturn service")
 
-    await register_function_launcher(server, ray_address="ray://ray-head:10001")
-    
+    await register_function_launcher(server, ray_address=RAY_ADDRESSES)
+
     import cloudpickle
+    import ray
 
     launcher = await server.get_service("function-launcher")
 
-    def run_cellpose(imgs_2D, channels):
+    def load_cellpose():
         from cellpose import models, core
 
         use_GPU = core.use_gpu()
         print(">>> GPU activated? %d" % use_GPU)
-        model = models.Cellpose(gpu=use_GPU, model_type="cyto")
+        return models.Cellpose(gpu=use_GPU, model_type="cyto")
+
+    def run_cellpose(model, imgs_2D, channels):
         masks, flows, styles, diams = model.eval(
             imgs_2D, diameter=None, flow_threshold=None, channels=channels
         )
         return masks
 
+    # Keep the model loaded in one actor per GPU instead of rebuilding it on
+    # every call, the actors are started on demand and stopped when idle
+    cellpose_gpus = CELLPOSE_GPUS or max(1, int(ray.cluster_resources().get("GPU", 0)))
     await launcher.deploy(
         "cellpose_predict",
         cloudpickle.dumps(run_cellpose),
+        mode="actor",
+        serialized_init=cloudpickle.dumps(load_cellpose),
+        min_actors=0,
+        max_actors=cellpose_gpus,
         runtime_env={"pip": ["opencv-python-headless<4.3", "cellpose"]},
         num_gpus=1,
+        # Install cellpose and load the model before the first request
+        warmup=True,
+        # One call per actor at a time, a burst of requests waits in the
+        # launcher (up to 64 calls) instead of queueing up on the GPUs
+        actor_queue_depth=1,
+        timeout=600,
+        max_in_flight=cellpose_gpus,
+        max_queue=64,
     )
     print("Registered ray function launcher service")
+    print(
+        f"Startup timings: import {IMPORT_TIME:.2f}s, "
+        f"service registration {time.time() - start_time:.2f}s"
+    )
 
 
 async def start_server(server_url):
@@ -0,0 +1,191 @@
+"""Collect latency histograms, in-flight gauges and error counters."""
+import bisect
+import functools
+import inspect
+import threading
+import time
+
+# Upper bounds in seconds of the latency histogram buckets
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300)
+
+# Keys of a service definition which are not service functions
+_SERVICE_KEYS = ("id", "name", "config", "description", "type", "docs")
+
+
+class Histogram:
+    """Count observations in fixed buckets, the same as a Prometheus histogram."""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        """Record an observation."""
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class MetricsRegistry:
+    """Hold the metrics of the services, keyed by name and labels."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._histograms = {}
+        self._gauges = {}
+        self._counters = {}
+
+    def observe(self, name: str, value: float, **labels):
+        """Record an observation of a histogram."""
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def inc(self, name: str, value: float = 1, **labels):
+        """Increment a counter."""
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def add(self, name: str, value: float, **labels):
+        """Add a (possibly negative) value to a gauge."""
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._gauges[key] = self._gauges.get(key, 0) + value
+
+    def get_metrics(self, context=None) -> dict:
+        """Return a snapshot of all the metrics."""
+        with self._lock:
+            histograms = [
+                {
+                    "name": name,
+                    "labels": dict(labels),
+                    "count": h.count,
+                    "sum": h.sum,
+                    "buckets": dict(zip(h.buckets + ("+Inf",), h.counts)),
+                }
+                for (name, labels), h in self._histograms.items()
+            ]
+            gauges = [
+                {"name": name, "labels": dict(labels), "value": value}
+                for (name, labels), value in self._gauges.items()
+            ]
+            counters = [
+                {"name": name, "labels": dict(labels), "value": value}
+                for (name, labels), value in self._counters.items()
+            ]
+        return {"histograms": histograms, "gauges": gauges, "counters": counters}
+
+    def get_prometheus_metrics(self, context=None) -> str:
+        """Return all the metrics in the Prometheus text exposition format."""
+        lines = []
+        typed = set()
+
+        def add_type(name, kind):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} {kind}")
+
+        snapshot = self.get_metrics()
+        for h in sorted(snapshot["histograms"], key=lambda m: m["name"]):
+            add_type(h["name"], "histogram")
+            cumulative = 0
+            for bound, count in h["buckets"].items():
+                cumulative += count
+                labels = _format_labels(h["labels"], le=bound)
+                lines.append(f"{h['name']}_bucket{labels} {cumulative}")
+            labels = _format_labels(h["labels"])
+            lines.append(f"{h['name']}_sum{labels} {h['sum']}")
+            lines.append(f"{h['name']}_count{labels} {h['count']}")
+        for kind in ("gauges", "counters"):
+            for metric in sorted(snapshot[kind], key=lambda m: m["name"]):
+                add_type(metric["name"], "gauge" if kind == "gauges" else "counter")
+                labels = _format_labels(metric["labels"])
+                lines.append(f"{metric['name']}{labels} {metric['value']}")
+        return "\n".join(lines) + "\n"
+
+    def instrument(self, service: str, operation: str, func):
+        """Wrap a service function to record its latency, in-flight calls and errors."""
+        labels = {"service": service, "operation": operation}
+
+        def start():
+            self.add("hypha_service_calls_in_flight", 1, **labels)
+            return time.perf_counter()
+
+        def finish(started, error):
+            self.add("hypha_service_calls_in_flight", -1, **labels)
+            self.observe(
+                "hypha_service_call_seconds", time.perf_counter() - started, **labels
+            )
+            if error:
+                self.inc("hypha_service_call_errors_total", **labels)
+
+        if inspect.isasyncgenfunction(func):
+
+            @functools.wraps(func)
+            async def wrapped_generator(*args, **kwargs):
+                started, error = start(), True
+                try:
+                    async for item in func(*args, **kwargs):
+                        yield item
+                    error = False
+                finally:
+                    finish(started, error)
+
+            return wrapped_generator
+
+        if inspect.iscoroutinefunction(func):
+
+            @functools.wraps(func)
+            async def wrapped_coroutine(*args, **kwargs):
+                started, error = start(), True
+                try:
+                    result = await func(*args, **kwargs)
+                    error = False
+                    return result
+                finally:
+                    finish(started, error)
+
+            return wrapped_coroutine
+
+        @functools.wraps(func)
+        def wrapped(*args, **kwargs):
+            started, error = start(), True
+            try:
+                result = func(*args, **kwargs)
+                error = False
+                return result
+            finally:
+                finish(started, error)
+
+        return wrapped
+
+    def instrument_service(self, service: dict) -> dict:
+        """Instrument all the functions of a service definition."""
+        return {
+            key: self.instrument(service["id"], key, value)
+            if callable(value) and key not in _SERVICE_KEYS
+            else value
+            for key, value in service.items()
+        }
+
+
+def _format_labels(labels: dict, **extra) -> str:
+    labels = {**labels, **extra}
+    if not labels:
+        return ""
+    values = ",".join(
+        '{}="{}"'.format(
+            k, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        )
+        for k, v in labels.items()
+    )
+    return "{" + values + "}"
+
+
+registry = MetricsRegistry()
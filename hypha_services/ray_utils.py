@@ -1,25 +1,1764 @@
 from imjoy_rpc.hypha import connect_to_server
 import asyncio
 import argparse
+import collections
+import concurrent.futures
+import hashlib
+import json
+import os
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 import cloudpickle
+import numpy as np
 import ray
 
+from hypha_services.metrics import registry
+from hypha_services.utils import iterate_in_executor
+
+# Ship the function wrappers and actor class to the Ray workers by value,
+# the workers do not need to have this package installed
+ray.cloudpickle.register_pickle_by_value(sys.modules[__name__])
+
+OBJECT_HANDLE_KEY = "__ray_object__"
+OBJECT_CHUNK_SIZE = 16 * 1024 * 1024  # bytes per uploaded/downloaded chunk
+OBJECT_IDLE_TIMEOUT = 3600  # seconds before an unused object handle is released
+UPLOAD_IDLE_TIMEOUT = 600  # seconds before an unfinished upload is discarded
+DOWNLOAD_CACHE_SIZE = 4  # objects kept in memory for their chunked download
+ACTOR_REAP_INTERVAL = 30  # seconds between the checks for idle actors
+# Directory of the persistent function registry
+FUNCTION_STORE_DIR = os.getenv(
+    "FUNCTION_STORE_DIR", os.path.join(os.path.expanduser("~"), ".hypha", "functions")
+)
+FUNCTION_STORE_MAX_UNUSED = 100  # payloads kept when no deployment uses them
+
+# A dict yielded by a streamed function with this key reports progress
+PROGRESS_KEY = "__progress__"
+# Items a streaming generator may produce ahead of the launcher reading them
+STREAM_BACKPRESSURE = int(os.getenv("RAY_STREAM_BACKPRESSURE", "2"))
+STREAM_IDLE_TIMEOUT = 300  # seconds before an unread stream is closed
+RAY_RESOURCE_REFRESH = 5  # seconds between the checks of the cluster resources
+LOCAL_MAX_WORKERS = 4  # threads running a function in the launcher process
+
 function_registry = {}
+object_registry = {}
+_uploads = {}
+_downloads = collections.OrderedDict()
+_streams = {}
+
+
+def _register_object(ref) -> dict:
+    now = time.time()
+    for handle_id, entry in list(object_registry.items()):
+        if now - entry["last_used"] > OBJECT_IDLE_TIMEOUT:
+            release_object(handle_id)
+    handle_id = uuid.uuid4().hex
+    object_registry[handle_id] = {"ref": ref, "last_used": now}
+    return {OBJECT_HANDLE_KEY: handle_id}
+
+
+def _get_object_ref(handle):
+    handle_id = handle[OBJECT_HANDLE_KEY] if isinstance(handle, dict) else handle
+    try:
+        entry = object_registry[handle_id]
+    except KeyError:
+        raise KeyError(f"Object {handle_id} does not exist, was released or expired")
+    entry["last_used"] = time.time()
+    return entry["ref"]
+
+
+def _is_object_handle(obj) -> bool:
+    return isinstance(obj, dict) and len(obj) == 1 and OBJECT_HANDLE_KEY in obj
+
+
+def resolve_object_handles(args, kwargs):
+    """Replace the object handles in the arguments with their Ray object refs.
+
+    Only top-level arguments are resolved, Ray passes them to the function as
+    values read from the object store without copying them through the launcher.
+    """
+    args = [_get_object_ref(a) if _is_object_handle(a) else a for a in args]
+    kwargs = {
+        k: _get_object_ref(v) if _is_object_handle(v) else v for k, v in kwargs.items()
+    }
+    return args, kwargs
+
+
+def put_object(data, context=None) -> dict:
+    """Put a value into the Ray object store and return a handle to it."""
+    return _register_object(ray.put(data))
+
+
+def get_object(handle, context=None):
+    """Get the value of an object handle in a single message."""
+    return ray.get(_get_object_ref(handle))
+
+
+def release_object(handle, context=None):
+    """Release an object handle so the object store can free the value."""
+    handle_id = handle[OBJECT_HANDLE_KEY] if isinstance(handle, dict) else handle
+    object_registry.pop(handle_id, None)
+    _downloads.pop(handle_id, None)
+
+
+def start_upload(nbytes: int, dtype: str = None, shape=None, context=None) -> str:
+    """Start a chunked upload, as a numpy array if dtype and shape are given."""
+    if dtype is not None:
+        buffer = np.empty(shape, dtype=dtype)
+        if buffer.nbytes != nbytes:
+            raise ValueError(
+                f"Expected {buffer.nbytes} bytes for an array of shape {shape} "
+                f"and type {dtype}, got {nbytes}"
+            )
+    else:
+        buffer = bytearray(nbytes)
+    now = time.time()
+    for upload_id, upload in list(_uploads.items()):
+        if now - upload["last_used"] > UPLOAD_IDLE_TIMEOUT:
+            del _uploads[upload_id]
+    upload_id = uuid.uuid4().hex
+    _uploads[upload_id] = {"buffer": buffer, "last_used": now}
+    return upload_id
+
+
+def _get_upload(upload_id: str):
+    try:
+        upload = _uploads[upload_id]
+    except KeyError:
+        raise KeyError(f"Upload {upload_id} does not exist or expired")
+    upload["last_used"] = time.time()
+    return upload["buffer"]
+
+
+def upload_chunk(upload_id: str, offset: int, chunk: bytes, context=None):
+    """Write a chunk of an upload at a byte offset."""
+    view = memoryview(_get_upload(upload_id)).cast("B")
+    if offset + len(chunk) > len(view):
+        raise ValueError("The chunk exceeds the size of the upload")
+    view[offset : offset + len(chunk)] = chunk
+
+
+def finish_upload(upload_id: str, context=None) -> dict:
+    """Put an uploaded value into the Ray object store and return its handle."""
+    buffer = _get_upload(upload_id)
+    del _uploads[upload_id]
+    # A bytearray is serialized out-of-band, without copying it to bytes first
+    return _register_object(ray.put(buffer))
+
+
+def _object_buffer(handle):
+    # The value is read once per download instead of once per chunk
+    handle_id = handle[OBJECT_HANDLE_KEY] if isinstance(handle, dict) else handle
+    ref = _get_object_ref(handle_id)
+    if handle_id in _downloads:
+        _downloads.move_to_end(handle_id)
+        return _downloads[handle_id]
+    value = ray.get(ref)
+    if isinstance(value, np.ndarray):
+        view = memoryview(np.ascontiguousarray(value)).cast("B")
+    elif isinstance(value, (bytes, bytearray, memoryview)):
+        view = memoryview(value).cast("B")
+    else:
+        raise TypeError(f"Object of type {type(value).__name__} cannot be downloaded")
+    _downloads[handle_id] = value, view
+    while len(_downloads) > DOWNLOAD_CACHE_SIZE:
+        _downloads.popitem(last=False)
+    return value, view
+
+
+def object_info(handle, context=None) -> dict:
+    """Describe an array or bytes object for a chunked download."""
+    value, view = _object_buffer(handle)
+    info = {"nbytes": len(view), "chunk_size": OBJECT_CHUNK_SIZE}
+    if isinstance(value, np.ndarray):
+        info.update({"dtype": value.dtype.str, "shape": list(value.shape)})
+    return info
+
+
+def download_chunk(handle, offset: int, size: int = OBJECT_CHUNK_SIZE, context=None):
+    """Read a chunk of an array or bytes object at a byte offset."""
+    _, view = _object_buffer(handle)
+    return view[offset : offset + size].tobytes()
+
+
+async def _stream_events(items):
+    """Turn the items yielded by a function into result and progress events."""
+    start = time.time()
+    results = 0
+    try:
+        async for item in items:
+            if isinstance(item, dict) and PROGRESS_KEY in item:
+                yield {
+                    "type": "progress",
+                    "progress": item[PROGRESS_KEY],
+                    "results": results,
+                    "elapsed": time.time() - start,
+                }
+            else:
+                yield {"type": "result", "index": results, "value": item}
+                results += 1
+    finally:
+        # Close the nested generators now, down to the Ray generator
+        await items.aclose()
+    yield {"type": "done", "results": results, "elapsed": time.time() - start}
+
+
+def _register_stream(items) -> str:
+    now = time.time()
+    for stream_id, stream in list(_streams.items()):
+        if now - stream["last_used"] > STREAM_IDLE_TIMEOUT:
+            asyncio.ensure_future(close_stream(stream_id))
+    stream_id = uuid.uuid4().hex
+    _streams[stream_id] = {
+        "events": _stream_events(items),
+        "lock": asyncio.Lock(),
+        "last_used": now,
+    }
+    return stream_id
+
+
+async def read_stream(stream_id: str, max_events: int = 1, context=None) -> list:
+    """Read the next events of a stream, waiting until `max_events` are available.
+
+    The last event has the type "done", the stream is closed once it is read.
+    """
+    try:
+        stream = _streams[stream_id]
+    except KeyError:
+        raise KeyError(f"Stream {stream_id} does not exist or was closed")
+    events = []
+    async with stream["lock"]:
+        try:
+            while len(events) < max_events:
+                event = await stream["events"].__anext__()
+                events.append(event)
+                if event["type"] == "done":
+                    _streams.pop(stream_id, None)
+                    break
+        except BaseException:
+            await close_stream(stream_id)
+            raise
+        finally:
+            stream["last_used"] = time.time()
+    return events
+
+
+async def close_stream(stream_id: str, context=None):
+    """Close a stream before its end, cancelling the function producing it."""
+    stream = _streams.pop(stream_id, None)
+    if stream is not None:
+        await stream["events"].aclose()
+
+
+def _hash_value(hasher, obj):
+    """Feed the content of an argument into a hash."""
+    if isinstance(obj, dict):
+        hasher.update(b"d%d" % len(obj))
+        for key, value in sorted(obj.items(), key=lambda item: repr(item[0])):
+            _hash_value(hasher, key)
+            _hash_value(hasher, value)
+    elif isinstance(obj, (list, tuple)):
+        hasher.update(b"l" if isinstance(obj, list) else b"t")
+        hasher.update(b"%d" % len(obj))
+        for item in obj:
+            _hash_value(hasher, item)
+    elif isinstance(obj, (bytes, bytearray, memoryview)):
+        hasher.update(b"b%d" % len(obj))
+        hasher.update(obj)
+    elif hasattr(obj, "__array_interface__"):
+        # Hash numpy arrays from their buffer instead of pickling them
+        hasher.update(f"a{obj.dtype.str}{obj.shape}".encode())
+        try:
+            hasher.update(memoryview(obj))
+        except (BufferError, TypeError, ValueError):
+            hasher.update(obj.tobytes())
+    elif obj is None or isinstance(obj, (bool, int, float, complex, str)):
+        hasher.update(f"{type(obj).__name__}:{obj!r}".encode())
+    else:
+        hasher.update(cloudpickle.dumps(obj))
+
+
+def hash_arguments(args, kwargs) -> str:
+    """Compute a content hash of the arguments of a function call."""
+    hasher = hashlib.blake2b(digest_size=32)
+    _hash_value(hasher, args)
+    _hash_value(hasher, kwargs)
+    return hasher.hexdigest()
+
+
+class ResultCache:
+    """Cache the results of a deployed function with LRU eviction and a TTL.
+
+    Identical calls that are still in flight are de-duplicated, the callers
+    wait for the result of the first call instead of dispatching a new task.
+    """
+
+    def __init__(self, max_size: int = 128, ttl: float = None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._results = collections.OrderedDict()
+        self._inflight = {}
+
+    def get(self, key: str):
+        """Return a cached result and whether it was found."""
+        entry = self._results.get(key)
+        if entry is None:
+            return None, False
+        result, expires_at = entry
+        if expires_at is not None and expires_at < time.time():
+            del self._results[key]
+            return None, False
+        self._results.move_to_end(key)
+        return result, True
+
+    def put(self, key: str, result):
+        """Store a result, evicting the least recently used ones."""
+        expires_at = time.time() + self.ttl if self.ttl else None
+        self._results[key] = (result, expires_at)
+        self._results.move_to_end(key)
+        while len(self._results) > self.max_size:
+            self._results.popitem(last=False)
+
+    async def get_or_call(self, key: str, call):
+        """Return the cached result for a key, awaiting `call()` on a miss.
+
+        The call runs in its own task shared by the identical calls, a caller
+        which is cancelled stops waiting without failing the others. The call
+        is only cancelled when none of the callers waits for it anymore.
+        """
+        result, found = self.get(key)
+        if found:
+            self.hits += 1
+            return result
+        inflight = self._inflight.get(key)
+        if inflight is None:
+            self.misses += 1
+            task = asyncio.ensure_future(call())
+            inflight = self._inflight[key] = [task, 0]
+            task.add_done_callback(partial(self._call_done, key))
+        else:
+            self.hits += 1
+        task = inflight[0]
+        inflight[1] += 1
+        try:
+            return await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if not task.done() and inflight[1] == 1:
+                task.cancel()
+            raise
+        finally:
+            inflight[1] -= 1
+
+    def _call_done(self, key: str, task):
+        del self._inflight[key]
+        if not task.cancelled() and task.exception() is None:
+            self.put(key, task.result())
+
+    def stats(self) -> dict:
+        """Report the size and hit/miss counts of the cache."""
+        return {"size": len(self._results), "hits": self.hits, "misses": self.misses}
+
+
+class BatchQueue:
+    """Coalesce concurrent calls of a deployed function into batched calls.
+
+    The function must take a list as its first argument and return a list of
+    results of the same length. Calls with the same remaining arguments are
+    queued for up to `max_wait` seconds or until `max_batch_size` items are
+    pending, their lists are then concatenated into a single Ray task and the
+    results are scattered back to the callers.
+    """
+
+    def __init__(self, f_remote, max_batch_size: int, max_wait: float = 0.01):
+        self.f_remote = f_remote
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.batches = 0
+        self.items = 0
+        self._pending = {}
+
+    async def submit(self, args, kwargs):
+        """Queue a call and wait for its share of the batched result."""
+        items = list(args[0])
+        key = hash_arguments(args[1:], kwargs)
+        batch = self._pending.get(key)
+        if batch is not None and batch["size"] + len(items) > self.max_batch_size:
+            self._flush(key)
+            batch = None
+        if batch is None:
+            batch = {"args": args[1:], "kwargs": kwargs, "calls": [], "size": 0}
+            batch["timer"] = asyncio.get_running_loop().call_later(
+                self.max_wait, self._flush, key
+            )
+            self._pending[key] = batch
+        future = asyncio.get_running_loop().create_future()
+        batch["calls"].append((items, future))
+        batch["size"] += len(items)
+        if batch["size"] >= self.max_batch_size:
+            self._flush(key)
+        return await future
+
+    def stats(self) -> dict:
+        """Report the number of batches and their mean size."""
+        return {
+            "batches": self.batches,
+            "mean_batch_size": self.items / self.batches if self.batches else 0,
+        }
+
+    def _flush(self, key: str):
+        batch = self._pending.pop(key, None)
+        if batch is None:
+            return
+        batch["timer"].cancel()
+        asyncio.ensure_future(self._dispatch(batch))
+
+    async def _dispatch(self, batch):
+        items = [item for call_items, _ in batch["calls"] for item in call_items]
+        self.batches += 1
+        self.items += len(items)
+        try:
+            results = await self.f_remote.remote(
+                items, *batch["args"], **batch["kwargs"]
+            )
+            if len(results) != len(items):
+                raise ValueError(
+                    f"Batched function returned {len(results)} results "
+                    f"for {len(items)} inputs"
+                )
+        except Exception as e:  # pylint: disable=broad-except
+            for _, future in batch["calls"]:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        start = 0
+        for call_items, future in batch["calls"]:
+            if not future.done():
+                future.set_result(results[start : start + len(call_items)])
+            start += len(call_items)
+
+
+class ConcurrencyLimit:
+    """Bound the calls in flight of a deployed function.
+
+    Up to `max_in_flight` calls run at once, the next ones wait in a FIFO
+    queue of at most `max_queue` calls (unbounded if None) and the calls
+    arriving when the queue is full are rejected at once.
+    """
+
+    def __init__(self, function_id: str, max_in_flight: int, max_queue: int = None):
+        self.function_id = function_id
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self.in_flight = 0
+        self.rejected = 0
+        self._waiters = collections.deque()
+
+    async def acquire(self):
+        """Wait for a slot, raise a RuntimeError if the queue is full."""
+        start = time.perf_counter()
+        if self.in_flight < self.max_in_flight and not self._waiters:
+            self.in_flight += 1
+        else:
+            if self.max_queue is not None and len(self._waiters) >= self.max_queue:
+                self.rejected += 1
+                registry.inc("hypha_function_rejected_total", function=self.function_id)
+                raise RuntimeError(
+                    f"Too many calls to {self.function_id}: "
+                    f"{self.in_flight} running and {len(self._waiters)} queued"
+                )
+            future = asyncio.get_running_loop().create_future()
+            self._waiters.append(future)
+            registry.add("hypha_function_queued", 1, function=self.function_id)
+            try:
+                # The slot of a finished call is handed over to the first waiter
+                await future
+            except asyncio.CancelledError:
+                if future.cancelled():
+                    self._waiters.remove(future)
+                else:
+                    self.release()
+                raise
+            finally:
+                registry.add("hypha_function_queued", -1, function=self.function_id)
+        registry.observe(
+            "hypha_function_queue_wait_seconds",
+            time.perf_counter() - start,
+            function=self.function_id,
+        )
+
+    def release(self):
+        """Free the slot of a finished call."""
+        while self._waiters:
+            future = self._waiters.popleft()
+            if not future.done():
+                future.set_result(None)
+                return
+        self.in_flight -= 1
+
+    def stats(self) -> dict:
+        """Report the calls running, queued and rejected."""
+        return {
+            "in_flight": self.in_flight,
+            "queued": len(self._waiters),
+            "rejected": self.rejected,
+        }
+
+
+def _timed(f):
+    """Wrap a function to also return its execution time on the worker."""
+
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        result = f(*args, **kwargs)
+        return result, time.perf_counter() - start
+
+    return wrapper
+
+
+def _record_timing(function_id: str, total: float, exec_time: float):
+    # The time not spent executing was spent queued for a worker or moving data
+    registry.observe(
+        "hypha_ray_queue_seconds", max(total - exec_time, 0), function=function_id
+    )
+    registry.observe("hypha_ray_exec_seconds", exec_time, function=function_id)
+
+
+def _noop():
+    return None
+
+
+async def _call(cluster, f, *args, **kwargs):
+    # Make Ray calls on a cluster, from the thread holding its Ray client
+    if cluster is None or cluster.executor is None:
+        return f(*args, **kwargs)
+    return await asyncio.get_running_loop().run_in_executor(
+        cluster.executor, partial(f, *args, **kwargs)
+    )
+
+
+def _post(cluster, f, *args, **kwargs):
+    # Make Ray calls on a cluster without waiting for the ones sent through
+    # its Ray client, those return a concurrent future
+    if cluster is None or cluster.executor is None:
+        return f(*args, **kwargs)
+    return cluster.executor.submit(f, *args, **kwargs)
+
+
+def _resolve(handle):
+    # The handle of an actor started through a Ray client, the calls made
+    # after the start on the same thread find it done
+    if isinstance(handle, concurrent.futures.Future):
+        return handle.result()
+    return handle
+
+
+def _kill(handle):
+    ray.kill(_resolve(handle))
+
+
+def _cancel(ref, cluster=None):
+    # Queued actor tasks are dropped but the running ones of sync actors cannot
+    # be interrupted, and older Ray versions only cancel tasks
+    def cancel():
+        try:
+            ray.cancel(ref)
+        except Exception as e:  # pylint: disable=broad-except
+            print("Failed to cancel a Ray task:", e)
+
+    _post(cluster, cancel)
+
+
+async def _iterate_generator(function_id: str, generator, cluster=None):
+    # Read the items of a Ray streaming generator one at a time, only the
+    # current item is held by the launcher
+    start = time.perf_counter()
+    exhausted = False
+    try:
+        async for ref in generator:
+            item = await ref
+            if start is not None:
+                registry.observe(
+                    "hypha_ray_stream_first_item_seconds",
+                    time.perf_counter() - start,
+                    function=function_id,
+                )
+                start = None
+            del ref
+            yield item
+        exhausted = True
+    finally:
+        if not exhausted:
+            _cancel(generator, cluster)
+
+
+class RemoteTask:
+    """Run a deployed function as Ray tasks and record their timings."""
+
+    def __init__(self, function_id: str, f, cluster=None, **options):
+        self.function_id = function_id
+        self.f = f
+        self.cluster = cluster
+        self.options = options
+        self.f_remote = ray.remote(num_returns=2, **options)(_timed(f))
+        self._stream_remote = None
+
+    def remote(self, *args, **kwargs):
+        """Run the function in a Ray task."""
+        return self._run(args, kwargs)
+
+    def remote_to_object(self, *args, **kwargs):
+        """Run the function in a Ray task, return the ref of its result."""
+        return self._run(args, kwargs, to_object=True)
+
+    async def ready(self):
+        """Wait until a worker with the runtime environment of the tasks is up."""
+        ref = await _call(
+            self.cluster, ray.remote(_noop).options(**self.options).remote
+        )
+        await ref
+
+    async def stream(self, *args, **kwargs):
+        """Run a generator function in a Ray task, yielding its items as they come."""
+        if self._stream_remote is None:
+            self._stream_remote = ray.remote(
+                num_returns="streaming",
+                _generator_backpressure_num_objects=STREAM_BACKPRESSURE,
+                **self.options,
+            )(self.f)
+        generator = await _call(
+            self.cluster, self._stream_remote.remote, *args, **kwargs
+        )
+        items = _iterate_generator(self.function_id, generator, self.cluster)
+        try:
+            async for item in items:
+                yield item
+        finally:
+            await items.aclose()
+
+    async def _run(self, args, kwargs, to_object=False):
+        start = time.perf_counter()
+        ref, exec_time = await _call(
+            self.cluster, self.f_remote.remote, *args, **kwargs
+        )
+        try:
+            # The execution time is returned once the call has completed,
+            # without copying the result into the launcher
+            exec_time = await exec_time
+        except asyncio.CancelledError:
+            # The caller timed out or disconnected, stop the task as well
+            _cancel(ref, self.cluster)
+            raise
+        _record_timing(self.function_id, time.perf_counter() - start, exec_time)
+        return ref if to_object else await ref
+
+
+class FunctionActor:
+    """Run a deployed function in an actor which keeps the state of its init hook.
+
+    When an init hook is given, its return value (e.g. a loaded model) is
+    passed to the function as the first argument of every call.
+    """
+
+    def __init__(self, f, init=None):
+        self.f = f
+        self.state = init() if init is not None else None
+        self.has_state = init is not None
+
+    @ray.method(num_returns=2)
+    def run(self, *args, **kwargs):
+        """Run the function with the actor state, also return its execution time."""
+        start = time.perf_counter()
+        if self.has_state:
+            result = self.f(self.state, *args, **kwargs)
+        else:
+            result = self.f(*args, **kwargs)
+        return result, time.perf_counter() - start
+
+    def run_stream(self, *args, **kwargs):
+        """Run a generator function with the actor state, yielding its items."""
+        if self.has_state:
+            yield from self.f(self.state, *args, **kwargs)
+        else:
+            yield from self.f(*args, **kwargs)
+
+    def ready(self):
+        """Return once the actor is started and its init hook has run."""
+        return True
+
+
+class ActorPool:
+    """Route calls of a deployed function to a pool of stateful actors.
+
+    Calls go to the least-loaded actor. A new actor is started, up to
+    `max_actors`, when every actor already has `queue_depth` calls in flight,
+    and actors idle for more than `idle_timeout` seconds are stopped down to
+    `min_actors`. An actor which died is replaced.
+    """
+
+    def __init__(
+        self,
+        function_id: str,
+        actor_class,
+        f,
+        init=None,
+        min_actors: int = 1,
+        max_actors: int = 1,
+        queue_depth: int = 1,
+        idle_timeout: float = 300,
+        cluster=None,
+    ):
+        self.function_id = function_id
+        self.cluster = cluster
+        self.actor_class = actor_class
+        self.f = f
+        self.init = init
+        self.min_actors = min_actors
+        self.max_actors = max(min_actors, max_actors)
+        self.queue_depth = queue_depth
+        self.idle_timeout = idle_timeout
+        self._actors = []
+        self._reaper = None
+        for _ in range(min_actors):
+            self._start_actor()
+
+    def remote(self, *args, **kwargs):
+        """Run the function on the least-loaded actor."""
+        return self._run(args, kwargs)
+
+    def remote_to_object(self, *args, **kwargs):
+        """Run the function on the least-loaded actor, return the ref of its result."""
+        return self._run(args, kwargs, to_object=True)
+
+    def stats(self) -> dict:
+        """Report the number of actors and the calls in flight on each of them."""
+        return {
+            "actors": len(self._actors),
+            "in_flight": [actor["in_flight"] for actor in self._actors],
+        }
+
+    async def ready(self):
+        """Wait until all the actors are started."""
+        handles = [actor["handle"] for actor in self._actors]
+        refs = await _call(
+            self.cluster, lambda: [_resolve(h).ready.remote() for h in handles]
+        )
+        await asyncio.gather(*refs)
+
+    def close(self):
+        """Stop all the actors."""
+        if self._reaper is not None:
+            self._reaper.cancel()
+            self._reaper = None
+        actors, self._actors = self._actors, []
+        for actor in actors:
+            _post(self.cluster, _kill, actor["handle"])
+
+    def _start_actor(self):
+        actor = {
+            "handle": _post(self.cluster, self.actor_class.remote, self.f, self.init),
+            "in_flight": 0,
+            "last_used": time.time(),
+        }
+        self._actors.append(actor)
+        return actor
+
+    async def stream(self, *args, **kwargs):
+        """Run a generator function on the least-loaded actor, yielding its items."""
+        actor = self._acquire()
+        try:
+            generator = await _call(
+                self.cluster,
+                lambda: _resolve(actor["handle"])
+                .run_stream.options(
+                    num_returns="streaming",
+                    _generator_backpressure_num_objects=STREAM_BACKPRESSURE,
+                )
+                .remote(*args, **kwargs),
+            )
+            items = _iterate_generator(self.function_id, generator, self.cluster)
+            try:
+                async for item in items:
+                    yield item
+            finally:
+                await items.aclose()
+        except ray.exceptions.RayActorError:
+            self._replace(actor)
+            raise
+        finally:
+            self._release(actor)
+
+    def _acquire(self):
+        if self._reaper is None:
+            # Idle actors are also stopped when no call releases an actor
+            self._reaper = asyncio.ensure_future(self._reap())
+        actor = min(self._actors, key=lambda a: a["in_flight"], default=None)
+        if actor is None or (
+            actor["in_flight"] >= self.queue_depth
+            and len(self._actors) < self.max_actors
+        ):
+            actor = self._start_actor()
+        actor["in_flight"] += 1
+        return actor
+
+    def _release(self, actor):
+        actor["in_flight"] -= 1
+        actor["last_used"] = time.time()
+        self._scale_down()
+
+    async def _run(self, args, kwargs, to_object=False):
+        actor = self._acquire()
+        start = time.perf_counter()
+        try:
+            ref, exec_time = await _call(
+                self.cluster,
+                lambda: _resolve(actor["handle"]).run.remote(*args, **kwargs),
+            )
+            try:
+                exec_time = await exec_time
+            except asyncio.CancelledError:
+                _cancel(ref, self.cluster)
+                raise
+        except ray.exceptions.RayActorError:
+            self._replace(actor)
+            raise
+        finally:
+            self._release(actor)
+        _record_timing(self.function_id, time.perf_counter() - start, exec_time)
+        return ref if to_object else await ref
+
+    def _replace(self, actor):
+        # Drop an actor which died, starting a new one if the pool is too small
+        if actor not in self._actors:
+            return
+        self._actors.remove(actor)
+        print(f"Replacing a dead actor of {self.function_id}")
+        _post(self.cluster, _kill, actor["handle"])
+        if len(self._actors) < self.min_actors:
+            self._start_actor()
 
-async def register_function_launcher(server, ray_address=None):
-    if ray_address:
-        ray.init(address=ray_address)
+    async def _reap(self):
+        while True:
+            await asyncio.sleep(ACTOR_REAP_INTERVAL)
+            self._scale_down()
+
+    def _scale_down(self):
+        now = time.time()
+        for actor in list(self._actors):
+            if len(self._actors) <= self.min_actors:
+                break
+            if actor["in_flight"] == 0 and now - actor["last_used"] > self.idle_timeout:
+                self._actors.remove(actor)
+                _post(self.cluster, _kill, actor["handle"])
+
+
+def _requirements(ray_options: dict) -> dict:
+    """Compute the resources a call needs, keyed like `ray.cluster_resources()`."""
+    requirements = dict(ray_options.get("resources") or {})
+    requirements["CPU"] = ray_options.get("num_cpus", 1)
+    requirements["GPU"] = ray_options.get("num_gpus", 0)
+    requirements["memory"] = ray_options.get("memory", 0)
+    return {name: amount for name, amount in requirements.items() if amount}
+
+
+def _read_resources():
+    return ray.cluster_resources(), ray.available_resources()
+
+
+class RayCluster:
+    """A Ray cluster the functions run on, with its load and resources.
+
+    The default connection is used without a client context, the other
+    clusters are reached through their Ray client.
+    """
+
+    def __init__(self, address: str = None, context=None):
+        self.address = address
+        self.in_flight = 0
+        self.healthy = True
+        self.total = {}
+        self.available = {}
+        self.checked_at = None
+        # The Ray client of a ClientContext returned by ray.init(...,
+        # allow_multiple=True) is set per thread, the calls to the cluster are
+        # made on a thread which enters the context once and never leaves it
+        self.executor = (
+            ThreadPoolExecutor(
+                max_workers=1,
+                thread_name_prefix="ray-client",
+                initializer=context.__enter__,
+            )
+            if context is not None
+            else None
+        )
+
+    @property
+    def default(self) -> bool:
+        """Whether this is the default connection, holding the launcher objects."""
+        return self.executor is None
+
+    async def refresh(self):
+        """Read the total and available resources, to check the cluster is up."""
+        loop = asyncio.get_running_loop()
+        try:
+            self.total, self.available = await loop.run_in_executor(
+                self.executor, _read_resources
+            )
+            self.healthy = True
+        except Exception as e:  # pylint: disable=broad-except
+            if self.healthy:
+                print(f"Ray cluster {self.address or 'default'} is unavailable:", e)
+            self.healthy = False
+        self.checked_at = time.time()
+
+    def fits(self, requirements: dict) -> bool:
+        """Check the cluster can ever run a call, unknown resources are assumed."""
+        if not self.total:
+            return True
+        return all(self.total.get(k, 0) >= v for k, v in requirements.items())
+
+    def capacity(self, requirements: dict) -> float:
+        """Return how many calls the cluster can run at once."""
+        if not self.total or not requirements:
+            return float("inf")
+        return min(self.total.get(k, 0) / v for k, v in requirements.items())
+
+    def has_available(self, requirements: dict) -> bool:
+        """Check the resources of a call were available at the last refresh."""
+        return all(self.available.get(k, 0) >= v for k, v in requirements.items())
+
+    def status(self) -> dict:
+        """Report the health, load and resources of the cluster."""
+        return {
+            "address": self.address,
+            "healthy": self.healthy,
+            "in_flight": self.in_flight,
+            "total": self.total,
+            "available": self.available,
+            "checked_at": self.checked_at,
+        }
+
+
+def connect_clusters(addresses) -> list:
+    """Connect to Ray clusters given as a list or a comma separated string.
+
+    The first address is the default connection, the objects put by the
+    launcher live there. The others must be Ray client (ray://) addresses.
+    """
+    if isinstance(addresses, str):
+        addresses = [a.strip() for a in addresses.split(",") if a.strip()]
+    if not addresses:
+        return [RayCluster()]
+    ray.init(address=addresses[0])
+    clusters = [RayCluster(addresses[0])]
+    for address in addresses[1:]:
+        if not address.startswith("ray://"):
+            raise ValueError(f"Expected a ray:// address for {address}")
+        clusters.append(RayCluster(address, ray.init(address, allow_multiple=True)))
+    return clusters
+
+
+class LocalFunction:
+    """Run a deployed function in threads of the launcher process.
+
+    For tiny functions the Ray scheduling overhead dominates, and it is
+    also the fallback when no Ray cluster can take a call. The function and
+    its init hook must be runnable in the launcher environment.
+    """
+
+    def __init__(
+        self, function_id: str, f, init=None, max_workers: int = LOCAL_MAX_WORKERS
+    ):
+        self.function_id = function_id
+        self.f = f
+        self.init = init
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix=f"local-{function_id}"
+        )
+        self._state = None
+        self._state_lock = threading.Lock()
+
+    def remote(self, *args, **kwargs):
+        """Run the function in a thread."""
+        return self._run(args, kwargs)
+
+    async def remote_to_object(self, *args, **kwargs):
+        """Run the function in a thread, put its result into the object store."""
+        return ray.put(await self._run(args, kwargs))
+
+    async def ready(self):
+        """Run the init hook."""
+        await asyncio.get_running_loop().run_in_executor(self.executor, self._bind)
+
+    async def stream(self, *args, **kwargs):
+        """Run a generator function in a thread, yielding its items."""
+        loop = asyncio.get_running_loop()
+        f = await loop.run_in_executor(self.executor, self._bind)
+        async for item in iterate_in_executor(
+            iter(f(*args, **kwargs)), executor=self.executor
+        ):
+            yield item
+
+    def close(self):
+        """Stop the threads once their calls are done."""
+        self.executor.shutdown(wait=False)
+
+    def _bind(self):
+        # Run the init hook once, on the first call
+        if self.init is None:
+            return self.f
+        with self._state_lock:
+            if self._state is None:
+                self._state = (self.init(),)
+        return lambda *args, **kwargs: self.f(self._state[0], *args, **kwargs)
+
+    def _call(self, args, kwargs):
+        start = time.perf_counter()
+        result = self._bind()(*args, **kwargs)
+        return result, time.perf_counter() - start
+
+    async def _run(self, args, kwargs):
+        start = time.perf_counter()
+        result, exec_time = await asyncio.get_running_loop().run_in_executor(
+            self.executor, self._call, args, kwargs
+        )
+        _record_timing(self.function_id, time.perf_counter() - start, exec_time)
+        return result
+
+
+class ClusterRouter:
+    """Route the calls of a deployed function across Ray clusters.
+
+    A call goes to the healthy cluster with the resources it needs available
+    and the fewest calls in flight for its capacity. The calls passing
+    object refs always go to the default cluster holding them. With a `local`
+    function, the calls run in the launcher when no cluster has capacity.
+    """
+
+    def __init__(self, function_id: str, targets: list, requirements: dict, local=None):
+        self.function_id = function_id
+        self.targets = targets
+        self.requirements = requirements
+        self.local = local
+
+    def remote(self, *args, **kwargs):
+        """Run the function on the least-loaded cluster."""
+        return self._run(args, kwargs)
+
+    def remote_to_object(self, *args, **kwargs):
+        """Run the function on the least-loaded cluster, return the ref of its result.
+
+        The results computed elsewhere than on the default cluster are put
+        into its object store, where the launcher objects live.
+        """
+        return self._run(args, kwargs, to_object=True)
+
+    async def ready(self):
+        """Wait until the function is ready on every cluster."""
+        await asyncio.gather(*(f_remote.ready() for _, f_remote in self.targets))
+
+    async def stream(self, *args, **kwargs):
+        """Run a generator function on the least-loaded cluster."""
+        cluster, f_remote = self._choose(args, kwargs)
+        if cluster is not None:
+            cluster.in_flight += 1
+        items = f_remote.stream(*args, **kwargs)
+        try:
+            async for item in items:
+                yield item
+        except ConnectionError:
+            if cluster is not None:
+                cluster.healthy = False
+            raise
+        finally:
+            await items.aclose()
+            if cluster is not None:
+                cluster.in_flight -= 1
+
+    def stats(self) -> dict:
+        """Report the calls in flight on each cluster."""
+        return {
+            "clusters": {
+                cluster.address: cluster.in_flight for cluster, _ in self.targets
+            }
+        }
+
+    def close(self):
+        """Release the resources held on every cluster."""
+        for _, f_remote in self.targets + [(None, self.local)]:
+            if hasattr(f_remote, "close"):
+                f_remote.close()
+
+    def _choose(self, args, kwargs):
+        if any(isinstance(a, ray.ObjectRef) for a in [*args, *kwargs.values()]):
+            # Neither the other clusters nor the launcher can read the objects
+            target = next((t for t in self.targets if t[0].default), None)
+            if target is None:
+                raise RuntimeError(
+                    f"{self.function_id} is called with object refs but is not "
+                    "deployed on the default Ray cluster holding them"
+                )
+            if not target[0].healthy:
+                raise RuntimeError(
+                    f"{self.function_id} is called with object refs but the "
+                    "default Ray cluster holding them is unavailable"
+                )
+            return target
+        targets = [t for t in self.targets if t[0].healthy]
+        if targets:
+            requirements = self.requirements
+            cluster, f_remote = min(
+                targets,
+                key=lambda t: (
+                    not t[0].has_available(requirements),
+                    t[0].in_flight / max(t[0].capacity(requirements), 1e-9),
+                ),
+            )
+            if self.local is None or cluster.in_flight < cluster.capacity(requirements):
+                return cluster, f_remote
+        if self.local is not None:
+            return None, self.local
+        raise RuntimeError(f"No Ray cluster is available to run {self.function_id}")
+
+    async def _run(self, args, kwargs, to_object=False):
+        cluster, f_remote = self._choose(args, kwargs)
+        if not to_object:
+            return await self._call(cluster, f_remote.remote, args, kwargs)
+        if cluster is not None and cluster.default:
+            return await self._call(cluster, f_remote.remote_to_object, args, kwargs)
+        # The refs handed out by the launcher are those of the default cluster
+        return ray.put(await self._call(cluster, f_remote.remote, args, kwargs))
+
+    async def _call(self, cluster, call, args, kwargs):
+        if cluster is None:
+            return await call(*args, **kwargs)
+        cluster.in_flight += 1
+        try:
+            return await call(*args, **kwargs)
+        except ConnectionError:
+            # Skip the cluster until a refresh finds it up again
+            cluster.healthy = False
+            raise
+        finally:
+            cluster.in_flight -= 1
+
+
+class FunctionDeployment:
+    """Hold a deployed function together with its per-deployment state."""
+
+    def __init__(
+        self,
+        function_id: str,
+        f_remote,
+        cache: ResultCache = None,
+        batch_queue: BatchQueue = None,
+        spec: dict = None,
+        limit: ConcurrencyLimit = None,
+        timeout: float = None,
+    ):
+        self.function_id = function_id
+        self.f_remote = f_remote
+        self.cache = cache
+        self.batch_queue = batch_queue
+        self.spec = spec
+        self.limit = limit
+        self.timeout = timeout
+        self.state = "ready"
+        self.error = None
+        self.timings = {"deployed_at": time.time()}
+        self._warming = None
+
+    def start_warm_up(self, loop, args=None, kwargs=None):
+        """Build the runtime environment and warm the function up in the background.
+
+        The calls wait until the warm-up has completed. Returns a
+        concurrent future resolved once the deployment is ready or failed.
+        """
+        self.state = "building"
+        self._warming = asyncio.run_coroutine_threadsafe(
+            self._warm_up(args, kwargs), loop
+        )
+        return self._warming
+
+    async def _warm_up(self, args, kwargs):
+        began = start = time.time()
+        try:
+            await self.f_remote.ready()
+            self.timings["build_time"] = time.time() - start
+            if args is not None or kwargs is not None:
+                self.state = "warming"
+                start = time.time()
+                await self._call(list(args or []), kwargs or {})
+                self.timings["warmup_time"] = time.time() - start
+            self.state = "ready"
+            print(f"{self.function_id} is ready after {time.time() - began:.1f}s")
+        except Exception as e:
+            self.state = "failed"
+            self.error = str(e)
+            print(f"Failed to warm up {self.function_id}:", e)
+            raise
+
+    def status(self) -> dict:
+        """Report the readiness of the deployment and the time it took."""
+        return {
+            "function_id": self.function_id,
+            "function_hash": self.spec and self.spec["function_hash"],
+            "status": self.state,
+            "error": self.error,
+            **self.timings,
+            **({"calls": self.limit.stats()} if self.limit is not None else {}),
+        }
+
+    async def run(self, args, kwargs):
+        """Run the function, from the result cache if it is enabled.
+
+        The call fails with a TimeoutError and its Ray task is cancelled if
+        it has not completed within the timeout of the deployment, which
+        includes the time spent waiting for a concurrency slot.
+        """
+        return await self._with_timeout(self._run(args, kwargs))
+
+    async def run_to_object(self, args, kwargs):
+        """Run the function, keeping its result in the object store.
+
+        Returns the ref of the object returned by the Ray task or actor. The
+        results of the cached and batched calls are assembled by the
+        launcher, they are put into the object store. The timeout and the
+        concurrency limit apply as for `run`.
+        """
+        if self.cache is not None or self.batch_queue is not None:
+            return ray.put(await self.run(args, kwargs))
+        return await self._with_timeout(self._run(args, kwargs, to_object=True))
+
+    async def _with_timeout(self, call):
+        if self.timeout is None:
+            return await call
+        try:
+            return await asyncio.wait_for(call, self.timeout)
+        except asyncio.TimeoutError:
+            registry.inc("hypha_function_timeouts_total", function=self.function_id)
+            raise TimeoutError(
+                f"{self.function_id} did not complete within {self.timeout}s"
+            ) from None
+
+    async def _run(self, args, kwargs, to_object=False):
+        await self._wait_ready()
+        if self.limit is not None:
+            await self.limit.acquire()
+        try:
+            if to_object:
+                args, kwargs = resolve_object_handles(args, kwargs)
+                return await self.f_remote.remote_to_object(*args, **kwargs)
+            if self.cache is None:
+                return await self._call(args, kwargs)
+            loop = asyncio.get_running_loop()
+            key = await loop.run_in_executor(None, hash_arguments, args, kwargs)
+            return await self.cache.get_or_call(key, lambda: self._call(args, kwargs))
+        finally:
+            if self.limit is not None:
+                self.limit.release()
+
+    async def stream(self, args, kwargs):
+        """Run a generator function, yielding its items as the workers produce them.
+
+        The streamed calls bypass the result cache and the batching, and a
+        stream holds its concurrency slot until it ends or is closed.
+        """
+        await self._wait_ready()
+        if self.limit is not None:
+            await self.limit.acquire()
+        try:
+            args, kwargs = resolve_object_handles(args, kwargs)
+            items = self.f_remote.stream(*args, **kwargs)
+            try:
+                async for item in items:
+                    yield item
+            finally:
+                await items.aclose()
+        finally:
+            if self.limit is not None:
+                self.limit.release()
+
+    def close(self):
+        """Release the resources held by the deployment."""
+        if hasattr(self.f_remote, "close"):
+            self.f_remote.close()
+
+    async def _wait_ready(self):
+        if self._warming is not None:
+            await asyncio.wrap_future(self._warming)
+            self._warming = None
+
+    def _call(self, args, kwargs):
+        args, kwargs = resolve_object_handles(args, kwargs)
+        if self.batch_queue is not None and args:
+            return self._submit_batch(args, kwargs)
+        return self.f_remote.remote(*args, **kwargs)
+
+    async def _submit_batch(self, args, kwargs):
+        if isinstance(args[0], ray.ObjectRef):
+            # The items of the batched calls are concatenated by the launcher
+            args[0] = await args[0]
+        return await self.batch_queue.submit(args, kwargs)
+
+
+class FunctionStore:
+    """Store serialized functions by content hash, and the deployments using them.
+
+    The payloads are kept as `objects/<sha256>` files and the deployment
+    specs in `deployments.json`, so the deployments survive a restart. The
+    payloads no stored deployment uses are kept to deploy them again by
+    hash, up to the `max_unused` most recently stored ones.
+    """
+
+    def __init__(
+        self,
+        path: str = FUNCTION_STORE_DIR,
+        max_unused: int = FUNCTION_STORE_MAX_UNUSED,
+    ):
+        self.path = path
+        self.max_unused = max_unused
+        self._lock = threading.Lock()
+        os.makedirs(os.path.join(path, "objects"), exist_ok=True)
+
+    def put(self, payload: bytes) -> str:
+        """Store a payload, return its content hash."""
+        content_hash = hashlib.sha256(payload).hexdigest()
+        path = self._object_path(content_hash)
+        try:
+            # Storing a payload again makes it the most recent one
+            os.utime(path)
+        except FileNotFoundError:
+            self._write(path, payload)
+        return content_hash
+
+    def has(self, content_hash: str) -> bool:
+        """Check if a payload is stored."""
+        return os.path.exists(self._object_path(content_hash))
+
+    def get(self, content_hash: str) -> bytes:
+        """Return a stored payload."""
+        try:
+            with open(self._object_path(content_hash), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            raise KeyError(f"Function {content_hash} is not in the registry")
+
+    def deployments(self) -> dict:
+        """Return the stored deployment specs by function id."""
+        try:
+            with open(os.path.join(self.path, "deployments.json")) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except ValueError as e:
+            print("Ignoring the corrupted function registry:", e)
+            return {}
+
+    def save_deployment(self, function_id: str, spec: dict):
+        """Store the spec of a deployment."""
+        with self._lock:
+            deployments = self.deployments()
+            deployments[function_id] = spec
+            self._write(
+                os.path.join(self.path, "deployments.json"),
+                json.dumps(deployments, indent=1).encode(),
+            )
+            self._collect(deployments)
+
+    def _collect(self, deployments: dict):
+        # Remove the oldest payloads which are not used by any deployment
+        used = set()
+        for spec in deployments.values():
+            used.update((spec.get("function_hash"), spec.get("init_hash")))
+        objects = os.path.join(self.path, "objects")
+        unused = []
+        for name in os.listdir(objects):
+            if name in used or name.endswith(".tmp"):
+                continue
+            try:
+                unused.append((os.path.getmtime(os.path.join(objects, name)), name))
+            except FileNotFoundError:
+                continue
+        unused.sort(reverse=True)
+        for _, name in unused[self.max_unused :]:
+            try:
+                os.remove(os.path.join(objects, name))
+            except FileNotFoundError:
+                pass
+
+    def _object_path(self, content_hash: str) -> str:
+        # The hashes are sha256 hex digests, anything else could escape the store
+        if (
+            not isinstance(content_hash, str)
+            or len(content_hash) != 64
+            or not all(c in "0123456789abcdef" for c in content_hash)
+        ):
+            raise ValueError(f"Invalid function hash: {content_hash!r}")
+        return os.path.join(self.path, "objects", content_hash)
+
+    @staticmethod
+    def _write(path: str, data: bytes):
+        # Write atomically so a crash never leaves a truncated file behind
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+
+def create_deployment(
+    function_id: str,
+    spec: dict,
+    store: FunctionStore,
+    clusters: list = None,
+    allow_local: bool = False,
+):
+    """Create the deployment of a function from its spec.
+
+    With several clusters, or a local fallback, the function is deployed on
+    every cluster which has the resources it needs and routed per call.
+    The functions only run in the launcher process with `allow_local`.
+    """
+    options = spec["options"]
+    runs_locally = options["mode"] == "local" or options.get("local_fallback")
+    if runs_locally and not allow_local:
+        raise ValueError(
+            "Running functions in the launcher is not allowed, "
+            "register the launcher with allow_local=True"
+        )
+    f = cloudpickle.loads(store.get(spec["function_hash"]))
+    init_hash = spec.get("init_hash")
+    init = cloudpickle.loads(store.get(init_hash)) if init_hash else None
+
+    def deploy_on(cluster):
+        if options["mode"] == "actor":
+            return ActorPool(
+                function_id,
+                ray.remote(FunctionActor).options(**spec["ray_options"]),
+                f,
+                init=init,
+                min_actors=options["min_actors"],
+                max_actors=options["max_actors"],
+                queue_depth=options["actor_queue_depth"],
+                idle_timeout=options["actor_idle_timeout"],
+                cluster=cluster,
+            )
+        return RemoteTask(function_id, f, cluster=cluster, **spec["ray_options"])
+
+    clusters = clusters or [None]
+    if options["mode"] == "local":
+        f_remote = LocalFunction(function_id, f, init=init)
+    elif options["mode"] not in ("actor", "task"):
+        raise ValueError(f"Unsupported deployment mode: {options['mode']}")
+    elif len(clusters) == 1 and not options.get("local_fallback"):
+        f_remote = deploy_on(clusters[0])
+    else:
+        requirements = _requirements(spec["ray_options"])
+        targets = [
+            (cluster, deploy_on(cluster))
+            for cluster in clusters
+            if cluster is not None and cluster.fits(requirements)
+        ]
+        local = (
+            LocalFunction(function_id, f, init=init)
+            if options.get("local_fallback")
+            else None
+        )
+        if not targets and local is None:
+            raise ValueError(f"No Ray cluster has the resources {requirements}")
+        f_remote = ClusterRouter(function_id, targets, requirements, local=local)
+    cache = (
+        ResultCache(max_size=options["cache_size"], ttl=options["cache_ttl"])
+        if options["cache_size"]
+        else None
+    )
+    batch_queue = (
+        BatchQueue(f_remote, options["max_batch_size"], max_wait=options["batch_wait"])
+        if options["max_batch_size"]
+        else None
+    )
+    # The specs stored before the limits were added do not have them
+    limit = (
+        ConcurrencyLimit(
+            function_id, options["max_in_flight"], max_queue=options.get("max_queue")
+        )
+        if options.get("max_in_flight")
+        else None
+    )
+    return FunctionDeployment(
+        function_id,
+        f_remote,
+        cache=cache,
+        batch_queue=batch_queue,
+        spec=spec,
+        limit=limit,
+        timeout=options.get("timeout"),
+    )
+
+
+async def register_function_launcher(
+    server, ray_address=None, store_dir=FUNCTION_STORE_DIR, allow_local=False
+):
+    """Register the function launcher service.
+
+    `ray_address` can be a list (or a comma separated string) of Ray
+    cluster addresses, the calls are then routed across the clusters.
+    Set `allow_local` to let the clients deploy functions running in the
+    launcher process (mode="local" and local_fallback).
+    """
+    clusters = connect_clusters(ray_address)
 
     print(server.config)
+    loop = asyncio.get_running_loop()
+
+    async def refresh_clusters():
+        await asyncio.gather(*(cluster.refresh() for cluster in clusters))
 
-    def deploy_function(function_id, serialized_function, context=None, **kwargs):
-        f = cloudpickle.loads(serialized_function)
-        f_remote = ray.remote(**kwargs)(f)
-        function_registry[function_id] = f_remote
+    async def watch_clusters():
+        while True:
+            await asyncio.sleep(RAY_RESOURCE_REFRESH)
+            await refresh_clusters()
+
+    await refresh_clusters()
+    asyncio.ensure_future(watch_clusters())
+    store = FunctionStore(store_dir)
+    # The stored deployments are only created when they are first used
+    pending_deployments = store.deployments()
+    # Warming deployments replacing one which keeps serving until they are ready
+    staging = {}
+    # Status of the last replacement of a deployment which failed to warm up
+    failed_updates = {}
+    restore_lock = threading.Lock()
+
+    def activate(function_id, deployment, persistent=False):
+        # Create a deployment, warming it up first if its spec asks for it.
+        # A replacement is only stored once it is ready
+        failed_updates.pop(function_id, None)
+        current = function_registry.get(function_id)
+        warmup = deployment.spec.get("warmup") or {}
+        if not warmup.get("enabled"):
+            function_registry[function_id] = deployment
+            save(function_id, deployment, persistent)
+            return current
+        future = deployment.start_warm_up(
+            loop, warmup.get("args"), warmup.get("kwargs")
+        )
+        if current is None:
+            function_registry[function_id] = deployment
+            save(function_id, deployment, persistent)
+            return None
+        replaced = staging.pop(function_id, None)
+        staging[function_id] = deployment
+        # Swap in a thread, the warm-up may finish while the lock is held
+        future.add_done_callback(
+            lambda f: loop.call_soon_threadsafe(
+                loop.run_in_executor,
+                None,
+                promote,
+                function_id,
+                deployment,
+                persistent,
+            )
+        )
+        return replaced
+
+    def promote(function_id, deployment, persistent):
+        # Route the calls to a warmed-up deployment, or drop it if it failed
+        with restore_lock:
+            if staging.get(function_id) is not deployment:
+                return
+            del staging[function_id]
+            if deployment.state == "ready":
+                previous = function_registry.get(function_id)
+                function_registry[function_id] = deployment
+                save(function_id, deployment, persistent)
+            else:
+                failed_updates[function_id] = deployment.status()
+                previous = deployment
+        if previous is not None:
+            previous.close()
+
+    def save(function_id, deployment, persistent):
+        if persistent:
+            store.save_deployment(function_id, deployment.spec)
+        elif persistent is None:
+            print(f"The options of {function_id} cannot be stored, it is not persisted")
+
+    def deploy_function(
+        function_id,
+        serialized_function=None,
+        context=None,
+        cache_size=0,
+        cache_ttl=None,
+        max_batch_size=0,
+        batch_wait=0.01,
+        mode="task",
+        serialized_init=None,
+        min_actors=1,
+        max_actors=1,
+        actor_queue_depth=1,
+        actor_idle_timeout=300,
+        timeout=None,
+        max_in_flight=0,
+        max_queue=None,
+        local_fallback=False,
+        function_hash=None,
+        init_hash=None,
+        warmup=False,
+        warmup_args=None,
+        warmup_kwargs=None,
+        **kwargs,
+    ):
+        """Deploy a function.
+
+        Set cache_size to cache its results, and max_batch_size to coalesce
+        concurrent calls into batches collected for up to batch_wait seconds.
+        With mode="actor" the function runs in a pool of min_actors to
+        max_actors Ray actors, and the value returned by the optional init
+        hook is passed as its first argument. With mode="local" it runs in
+        threads of the launcher, for tiny functions where the Ray overhead
+        dominates.
+
+        The calls are routed to the least-loaded of the Ray clusters with
+        the resources they need, set local_fallback to run them in the
+        launcher when no cluster has capacity left or is reachable. Both
+        options are rejected unless the launcher allows local execution.
+
+        Each call is cancelled after `timeout` seconds. Set max_in_flight to
+        bound the calls running at once, the others wait in a queue of up
+        to max_queue calls and are rejected when it is full.
+
+        The payloads are stored by content hash and the returned
+        `function_hash` (and `init_hash`) can be passed instead of the
+        payloads to deploy the same function again. Deploying the same
+        function with the same options is a no-op.
+
+        With warmup=True the runtime environment is built (and the actors
+        started) in the background, and the function is called once with
+        warmup_args/warmup_kwargs if given. A function replacing a deployed
+        one only gets the calls once it is ready, see `status`.
+        """
+        if serialized_function is not None:
+            function_hash = store.put(serialized_function)
+        elif function_hash is None:
+            raise ValueError("Either serialized_function or function_hash is required")
+        elif not store.has(function_hash):
+            raise KeyError(f"Function {function_hash} is not in the registry")
+        if serialized_init is not None:
+            init_hash = store.put(serialized_init)
+        elif init_hash is not None and not store.has(init_hash):
+            raise KeyError(f"Function {init_hash} is not in the registry")
+        spec = {
+            "function_hash": function_hash,
+            "init_hash": init_hash,
+            "options": {
+                "mode": mode,
+                "cache_size": cache_size,
+                "cache_ttl": cache_ttl,
+                "max_batch_size": max_batch_size,
+                "batch_wait": batch_wait,
+                "min_actors": min_actors,
+                "max_actors": max_actors,
+                "actor_queue_depth": actor_queue_depth,
+                "actor_idle_timeout": actor_idle_timeout,
+                "timeout": timeout,
+                "max_in_flight": max_in_flight,
+                "max_queue": max_queue,
+                "local_fallback": local_fallback,
+            },
+            "ray_options": kwargs,
+            "warmup": {
+                "enabled": warmup,
+                "args": warmup_args,
+                "kwargs": warmup_kwargs,
+            },
+        }
+        try:
+            # Compare the specs in the form they are stored in
+            spec = json.loads(json.dumps(spec))
+            persistent = True
+        except (TypeError, ValueError):
+            persistent = None
+        result = {
+            "function_id": function_id,
+            "function_hash": function_hash,
+            "init_hash": init_hash,
+            "changed": False,
+        }
+        with restore_lock:
+            latest = staging.get(function_id) or function_registry.get(function_id)
+            if latest is not None and latest.spec == spec:
+                return result
+            if latest is None and pending_deployments.get(function_id) == spec:
+                return result
+            # Replacing the deployment also drops the results of the old function
+            replaced = activate(
+                function_id,
+                create_deployment(function_id, spec, store, clusters, allow_local),
+                persistent,
+            )
+            pending_deployments.pop(function_id, None)
+        if replaced is not None:
+            replaced.close()
         print("deployed op: ", function_id)
         print("Available function: ", function_registry.keys())
-        return
-    
+        result["changed"] = True
+        return result
+
+    def restore_deployment(function_id):
+        with restore_lock:
+            deployment = function_registry.get(function_id)
+            if deployment is None:
+                spec = pending_deployments.get(function_id)
+                if spec is None:
+                    raise KeyError(f"Function {function_id} is not deployed")
+                deployment = create_deployment(
+                    function_id, spec, store, clusters, allow_local
+                )
+                activate(function_id, deployment)
+                del pending_deployments[function_id]
+                print("restored op: ", function_id)
+            return deployment
+
+    def function_status(function_id=None, context=None):
+        """Report whether a deployed function is building, warming, ready or failed.
+
+        `serving` tells whether the calls go to this deployment, a replaced
+        deployment keeps serving until its replacement is ready.
+        """
+
+        def report(function_id):
+            deployment = staging.get(function_id) or function_registry.get(function_id)
+            if deployment is None:
+                if function_id in pending_deployments:
+                    return {"function_id": function_id, "status": "stored"}
+                raise KeyError(f"Function {function_id} is not deployed")
+            status = {
+                **deployment.status(),
+                "serving": function_registry.get(function_id) is deployment,
+            }
+            if function_id in failed_updates:
+                status["failed_update"] = failed_updates[function_id]
+            return status
+
+        if function_id is not None:
+            return report(function_id)
+        with restore_lock:
+            function_ids = set(function_registry) | set(pending_deployments)
+        return [report(function_id) for function_id in sorted(function_ids)]
+
+    def cluster_status(context=None) -> list:
+        """Report the health, load and resources of the Ray clusters."""
+        return [cluster.status() for cluster in clusters]
+
+    def has_function(function_hash, context=None) -> bool:
+        """Check if a function payload is in the registry."""
+        return store.has(function_hash)
+
     async def deploy_service(service_id, serialized_service, context=None, **kwargs):
         await server.register_service(
             {
@@ -35,14 +1774,41 @@ async def register_function_launcher(server, ray_address=None):
             }
         )
 
+    async def get_deployment(function_id):
+        deployment = function_registry.get(function_id)
+        if deployment is None:
+            deployment = await asyncio.get_running_loop().run_in_executor(
+                None, restore_deployment, function_id
+            )
+        return deployment
+
     async def run_function(function_id, *args, context=None, **kwargs):
-        f_remote = function_registry[function_id]
+        deployment = await get_deployment(function_id)
         print("running op: ", function_id)
-        result = await f_remote.remote(*args, **kwargs)
+        result = await deployment.run(args, kwargs)
         print("op finished: ", function_id)
         return result
 
-    await server.register_service(
+    async def start_stream(function_id, *args, context=None, **kwargs) -> str:
+        """Run a generator function and return a stream to read with `read_stream`.
+
+        Every item yielded by the function is a "result" event, and a dict
+        with the `__progress__` key a "progress" event. The function runs
+        at most a few items ahead of the reader.
+        """
+        deployment = await get_deployment(function_id)
+        print("streaming op: ", function_id)
+        return _register_stream(deployment.stream(args, kwargs))
+
+    async def run_function_to_object(function_id, *args, context=None, **kwargs):
+        """Run a function and keep its result in the object store."""
+        deployment = await get_deployment(function_id)
+        print("running op: ", function_id)
+        ref = await deployment.run_to_object(args, kwargs)
+        print("op finished: ", function_id)
+        return _register_object(ref)
+
+    service = registry.instrument_service(
         {
             "name": "Function Launcher",
             "id": "function-launcher",
@@ -52,14 +1818,41 @@ async def register_function_launcher(server, ray_address=None):
                 "run_in_executor": True,
             },
             "deploy": deploy_function,
+            "has_function": has_function,
+            "status": function_status,
+            "clusters": cluster_status,
             "run": run_function,
+            "run_to_object": run_function_to_object,
+            "start_stream": start_stream,
+            "read_stream": read_stream,
+            "close_stream": close_stream,
+            "put_object": put_object,
+            "get_object": get_object,
+            "release_object": release_object,
+            "start_upload": start_upload,
+            "upload_chunk": upload_chunk,
+            "finish_upload": finish_upload,
+            "object_info": object_info,
+            "download_chunk": download_chunk,
         }
     )
+    # Warm the stored deployments which ask for it up now instead of on first use
+    for function_id, spec in list(pending_deployments.items()):
+        if (spec.get("warmup") or {}).get("enabled"):
+            try:
+                restore_deployment(function_id)
+            except Exception as e:  # pylint: disable=broad-except
+                print(f"Failed to restore {function_id}:", e)
+    service["get_metrics"] = registry.get_metrics
+    service["get_prometheus_metrics"] = registry.get_prometheus_metrics
+    await server.register_service(service)
     print("Function Launcher is ready to receive request!")
     # print("workspace: ", server.config['workspace'], "\ntoken:", await server.generate_token())
 
 
-async def start_function_launcher(server_url, workspace, token, ray_address):
+async def start_function_launcher(
+    server_url, workspace, token, ray_address, store_dir=FUNCTION_STORE_DIR
+):
     server = await connect_to_server(
         {
             "name": "function client",
@@ -68,7 +1861,9 @@ async def start_function_launcher(server_url, workspace, token, ray_address):
             "workspace": workspace,
         }
     )
-    await register_function_launcher(server, ray_address=ray_address)
+    await register_function_launcher(
+        server, ray_address=ray_address, store_dir=store_dir
+    )
 
 
 if __name__ == "__main__":
@@ -77,6 +1872,7 @@ if __name__ == "__main__":
     parser.add_argument("--workspace", default=None)
     parser.add_argument("--token", default=None)
     parser.add_argument("--ray-server", default="auto")
+    parser.add_argument("--store-dir", default=FUNCTION_STORE_DIR)
     opts = parser.parse_args()
 
     loop = asyncio.get_event_loop()
@@ -86,6 +1882,7 @@ if __name__ == "__main__":
             server_url=opts.server_url,
             token=opts.token,
             workspace=opts.workspace,
+            store_dir=opts.store_dir,
         )
     )
     loop.run_forever()
@@ -0,0 +1,239 @@
+"""Admit container launches against the resources committed on the host."""
+import asyncio
+import inspect
+import itertools
+import random
+import string
+import time
+
+from hypha_services.metrics import registry
+from hypha_services.utils import parse_bytes, run_batch_async
+
+RESOURCES = ("cpu", "gpu", "memory")
+# Resources accounted for a launch which does not request them explicitly
+DEFAULT_REQUEST = {"cpu": 1, "gpu": 0, "memory": 0}
+# Container statuses (docker) and pod phases (kubernetes) which free resources
+TERMINAL_STATUSES = (None, "exited", "dead", "Succeeded", "Failed")
+
+
+class ContainerScheduler:
+    """Queue container launches until the resources they request are free.
+
+    The scheduler tracks the CPU, GPU and memory committed by the containers
+    it launched. Queued requests are admitted by priority first, then by the
+    dominant resource share of their user so that every user gets a fair
+    share, and finally in arrival order. While the first request in that
+    order does not fit, the others may only use the resources it leaves free
+    so they cannot delay it. Resources are released as soon as the backend
+    reports that a container exited or was removed. Only the resources in
+    `capacity` are tracked, the others are not limited.
+    """
+
+    def __init__(self, run, capacity: dict, default_request: dict = None):
+        self._run = run
+        self.capacity = {
+            k: parse_bytes(capacity[k]) for k in RESOURCES if k in capacity
+        }
+        self.default_request = default_request or DEFAULT_REQUEST
+        self.committed = {k: 0 for k in self.capacity}
+        self._allocations = {}
+        self._queue = []
+        self._counter = itertools.count()
+        self._loop = None
+        self.launched = 0
+        self.total_wait_time = 0.0
+
+    async def run(
+        self,
+        image: str,
+        command: str,
+        cpu_count: int = None,
+        gpu_count: int = None,
+        name: str = None,
+        memory=None,
+        priority: int = 0,
+        user: str = None,
+        detach=False,
+        **kwargs,
+    ):
+        """Launch a container once its resources are available.
+
+        Requests with a higher priority are admitted first, `user` is used to
+        share the resources fairly between the users.
+        """
+        self._loop = asyncio.get_running_loop()
+        request = dict(self.default_request)
+        if cpu_count is not None:
+            request["cpu"] = cpu_count
+        if gpu_count is not None:
+            request["gpu"] = gpu_count
+        if memory is not None:
+            request["memory"] = parse_bytes(memory)
+        for key in self.capacity:
+            if request[key] > self.capacity[key]:
+                raise Exception(
+                    f"The request exceeds the {key} capacity: "
+                    f"{request[key]} > {self.capacity[key]}"
+                )
+        # Name the container up front so its position in the queue can be queried
+        name = name or "".join(
+            random.choices(string.ascii_lowercase + string.digits, k=24)
+        )
+        if name in self._allocations or any(e["name"] == name for e in self._queue):
+            raise RuntimeError(f"Container {name} already exists")
+        entry = {
+            "name": name,
+            "user": user,
+            "priority": priority,
+            "request": request,
+            "order": next(self._counter),
+            "queued_at": time.time(),
+            "admitted": self._loop.create_future(),
+        }
+        self._queue.append(entry)
+        self._dispatch()
+        try:
+            wait_time = await entry["admitted"]
+        except asyncio.CancelledError:
+            if entry in self._queue:
+                self._queue.remove(entry)
+            else:
+                self.release(name)
+            raise
+        self.launched += 1
+        self.total_wait_time += wait_time
+        registry.observe("hypha_container_queue_seconds", wait_time)
+        if wait_time > 0.1:
+            print(f"Container {name} waited {wait_time:.1f}s for resources")
+
+        kwargs.update(
+            cpu_count=cpu_count,
+            gpu_count=gpu_count,
+            name=name,
+            memory=memory,
+            detach=detach,
+        )
+        try:
+            if inspect.iscoroutinefunction(self._run):
+                result = await self._run(image, command, **kwargs)
+            else:
+                result = await self._loop.run_in_executor(
+                    None, lambda: self._run(image, command, **kwargs)
+                )
+        except BaseException:
+            self.release(name)
+            raise
+        if not detach:
+            # The container has already exited
+            self.release(name)
+        return result
+
+    async def run_many(self, specs: list) -> list:
+        """Queue a batch of launches, each spec holds the arguments of `run`.
+
+        Every launch is admitted on its own as resources become available,
+        returns the `name`, `success` and `error` of every spec.
+        """
+        existing = list(self._allocations) + [e["name"] for e in self._queue]
+        return await run_batch_async(self.run, specs, existing, max(len(specs), 1))
+
+    def release(self, name: str):
+        """Release the resources committed to a container."""
+        allocation = self._allocations.pop(name, None)
+        if allocation is None:
+            return
+        for key in self.capacity:
+            self.committed[key] -= allocation["request"][key]
+        self._dispatch()
+
+    def container_changed(self, name: str, status: str):
+        """Release the resources of a container which exited, thread-safe."""
+        if status in TERMINAL_STATUSES and self._loop is not None:
+            self._loop.call_soon_threadsafe(self.release, name)
+
+    def queue_status(self, name: str = None):
+        """Report the queued launches, or the position of a single one."""
+        now = time.time()
+        queue = [
+            {
+                "name": entry["name"],
+                "user": entry["user"],
+                "priority": entry["priority"],
+                "request": entry["request"],
+                "position": position,
+                "wait_time": now - entry["queued_at"],
+            }
+            for position, entry in enumerate(sorted(self._queue, key=self._rank))
+        ]
+        if name is None:
+            return queue
+        for entry in queue:
+            if entry["name"] == name:
+                return entry
+        if name in self._allocations:
+            return {"name": name, "position": None, "wait_time": 0}
+        raise Exception(f"Container {name} is not queued")
+
+    def stats(self) -> dict:
+        """Report the capacity, the committed resources and the queue length."""
+        return {
+            "capacity": dict(self.capacity),
+            "committed": dict(self.committed),
+            "queued": len(self._queue),
+            "running": len(self._allocations),
+            "mean_wait_time": self.total_wait_time / self.launched
+            if self.launched
+            else 0,
+        }
+
+    def _share(self, user: str) -> float:
+        # Dominant resource share of the allocations of a user
+        usage = {k: 0 for k in self.capacity}
+        for allocation in self._allocations.values():
+            if allocation["user"] == user:
+                for key in self.capacity:
+                    usage[key] += allocation["request"][key]
+        return max(
+            (usage[k] / self.capacity[k] for k in self.capacity if self.capacity[k]),
+            default=0,
+        )
+
+    def _rank(self, entry):
+        return (-entry["priority"], self._share(entry["user"]), entry["order"])
+
+    def _fits(self, request: dict, reserved: dict = None) -> bool:
+        # A request which uses a resource must also leave the reserved amount
+        # of it free, the resources it does not use are not affected
+        return all(
+            self.committed[k]
+            + request[k]
+            + (reserved[k] if reserved and request[k] else 0)
+            <= self.capacity[k]
+            for k in self.capacity
+        )
+
+    def _admit(self, entry):
+        self._queue.remove(entry)
+        for key in self.capacity:
+            self.committed[key] += entry["request"][key]
+        self._allocations[entry["name"]] = entry
+        entry["admitted"].set_result(time.time() - entry["queued_at"])
+
+    def _dispatch(self):
+        # Drop the launches which were cancelled while queued
+        self._queue = [e for e in self._queue if not e["admitted"].done()]
+        while self._queue:
+            queue = sorted(self._queue, key=self._rank)
+            head = queue[0]
+            if self._fits(head["request"]):
+                self._admit(head)
+                continue
+            # Backfill with the requests which leave the resources of the head
+            # of the queue free, it gets the resources it waits for first
+            entry = next(
+                (e for e in queue[1:] if self._fits(e["request"], head["request"])),
+                None,
+            )
+            if entry is None:
+                return
+            self._admit(entry)
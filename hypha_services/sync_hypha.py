@@ -0,0 +1,233 @@
+"""Provide a synchronous hypha client which runs blocking service handlers."""
+import asyncio
+import copy
+import inspect
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from imjoy_rpc.hypha import connect_to_server
+
+# Threads running the sync handlers of the services, shared by default
+HYPHA_SYNC_MAX_WORKERS = 16
+HYPHA_SYNC_CONNECT_TIMEOUT = 60  # seconds to wait for the connection
+
+# Attribute of a callable caching its wrappers
+_WRAPPERS_ATTR = "__hypha_sync_wrappers__"
+# Values which never contain callables, skipped without inspecting them
+_LEAF_TYPES = frozenset(
+    (str, bytes, bytearray, memoryview, int, float, complex, bool, type(None))
+)
+
+
+def _cached_wrapper(func, key, make):
+    # Cache the wrappers on the callable itself, so they live as long as it.
+    # Bound methods share the attributes of their function, they are not cached
+    attributes = getattr(func, "__dict__", None)
+    if inspect.ismethod(func) or not isinstance(attributes, dict):
+        return make()
+    wrappers = attributes.get(_WRAPPERS_ATTR)
+    if wrappers is None:
+        wrappers = attributes[_WRAPPERS_ATTR] = {}
+    wrapper = wrappers.get(key)
+    if wrapper is None:
+        wrapper = wrappers[key] = make()
+    return wrapper
+
+
+def convert_sync_to_async(sync_func, loop, executor):
+    """Wrap a blocking function to run it in an executor of the loop."""
+    if inspect.iscoroutinefunction(sync_func):
+        return sync_func
+
+    def make():
+        async def wrapped_async(*args, **kwargs):
+            # The callbacks passed by the caller are called from the executor
+            args = _encode_callables(args, convert_async_to_sync, loop, executor)
+            kwargs = _encode_callables(kwargs, convert_async_to_sync, loop, executor)
+            result = await loop.run_in_executor(
+                executor, lambda: sync_func(*args, **kwargs)
+            )
+            return _encode_callables(result, convert_sync_to_async, loop, executor)
+
+        return wrapped_async
+
+    return _cached_wrapper(sync_func, (convert_sync_to_async, loop, executor), make)
+
+
+def convert_async_to_sync(async_func, loop, executor):
+    """Wrap an async (or remote) function to call it from any other thread."""
+
+    def make():
+        def wrapped_sync(*args, **kwargs):
+            args = _encode_callables(args, convert_sync_to_async, loop, executor)
+            kwargs = _encode_callables(kwargs, convert_sync_to_async, loop, executor)
+
+            async def func_async():
+                result = async_func(*args, **kwargs)
+                if inspect.isawaitable(result):
+                    result = await result
+                return result
+
+            result = asyncio.run_coroutine_threadsafe(func_async(), loop).result()
+            return _encode_callables(result, convert_async_to_sync, loop, executor)
+
+        return wrapped_sync
+
+    return _cached_wrapper(async_func, (convert_async_to_sync, loop, executor), make)
+
+
+def _encode_callables(obj, wrap, loop, executor):
+    """Wrap the callables nested in an object with `wrap`.
+
+    Only the containers holding callables are copied, keeping their type, the
+    others (and buffers or arrays) are returned as they are.
+    """
+    if type(obj) in _LEAF_TYPES:
+        return obj
+    return _encode(obj, wrap, loop, executor, set(), {})
+
+
+def _encode(obj, wrap, loop, executor, path: set, memo: dict):
+    if type(obj) in _LEAF_TYPES:
+        return obj
+    if isinstance(obj, (dict, list, tuple)):
+        key = id(obj)
+        if key in memo:
+            return memo[key]
+        if key in path:
+            # A reference cycle, the container is already being encoded
+            return obj
+        path.add(key)
+        try:
+            encoded = _encode_container(obj, wrap, loop, executor, path, memo)
+        finally:
+            path.discard(key)
+        if encoded is not obj:
+            memo[key] = encoded
+        return encoded
+    if callable(obj):
+        return wrap(obj, loop, executor)
+    return obj
+
+
+def _encode_container(obj, wrap, loop, executor, path: set, memo: dict):
+    if isinstance(obj, dict):
+        changed = None
+        for k, v in obj.items():
+            if type(v) in _LEAF_TYPES:
+                continue
+            encoded = _encode(v, wrap, loop, executor, path, memo)
+            if encoded is not v:
+                if changed is None:
+                    changed = {}
+                changed[k] = encoded
+        if changed is None:
+            return obj
+        new = dict(obj) if type(obj) is dict else copy.copy(obj)
+        for k, v in changed.items():
+            new[k] = v
+        return new
+
+    items = None
+    for i, item in enumerate(obj):
+        if type(item) in _LEAF_TYPES:
+            continue
+        encoded = _encode(item, wrap, loop, executor, path, memo)
+        if encoded is not item:
+            if items is None:
+                items = list(obj)
+            items[i] = encoded
+    if items is None:
+        return obj
+    if type(obj) in (list, tuple):
+        return type(obj)(items)
+    if isinstance(obj, tuple):
+        # Named tuples take their fields as arguments
+        return type(obj)(*items) if hasattr(obj, "_fields") else type(obj)(items)
+    new = copy.copy(obj)
+    new[:] = items
+    return new
+
+
+class SyncHyphaServer:
+    """Expose a hypha server connection to synchronous code.
+
+    The connection runs in an event loop on a background thread. The sync
+    handlers of the registered services run in a pool of `max_workers`
+    threads, so concurrent calls are handled in parallel.
+    """
+
+    def __init__(self, max_workers: int = HYPHA_SYNC_MAX_WORKERS):
+        self.loop = None
+        self.thread = None
+        self.server = None
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="hypha-sync"
+        )
+        self._service_executors = []
+        self._ready = threading.Event()
+
+    def start(self, config: dict, timeout: float = HYPHA_SYNC_CONNECT_TIMEOUT):
+        """Start the event loop and connect to the server."""
+        self.thread = threading.Thread(target=self._start_loop, daemon=True)
+        self.thread.start()
+        if not self._ready.wait(timeout):
+            raise TimeoutError("The event loop of the hypha client did not start")
+        future = asyncio.run_coroutine_threadsafe(
+            self._connect_to_server(config), self.loop
+        )
+        future.result(timeout)
+
+    def register_service(self, service: dict, max_workers: int = None, **kwargs):
+        """Register a service, its sync handlers run in the executor threads.
+
+        With `max_workers`, the handlers of the service get their own pool of
+        threads instead of sharing the default one.
+        """
+        executor = self.executor
+        if max_workers is not None:
+            executor = ThreadPoolExecutor(
+                max_workers=max_workers,
+                thread_name_prefix=f"hypha-{service.get('id', 'service')}",
+            )
+            self._service_executors.append(executor)
+        service = _encode_callables(service, convert_sync_to_async, self.loop, executor)
+        return asyncio.run_coroutine_threadsafe(
+            self.server.register_service(service, **kwargs), self.loop
+        ).result()
+
+    def close(self):
+        """Disconnect from the server and stop the event loop."""
+        if self.server is not None and self.server.get("disconnect"):
+            asyncio.run_coroutine_threadsafe(
+                self.server.disconnect(), self.loop
+            ).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        for executor in [self.executor] + self._service_executors:
+            executor.shutdown(wait=False)
+
+    async def _connect_to_server(self, config):
+        self.server = await connect_to_server(config)
+        print(f"Services registered at workspace: {self.server.config.workspace}")
+        obj = _encode_callables(
+            self.server, convert_async_to_sync, self.loop, self.executor
+        )
+        # for every key in obj, set it as an attribute of self
+        assert isinstance(obj, dict), "The server object must be a dict"
+        for k, v in obj.items():
+            if k != "register_service":
+                setattr(self, k, v)
+
+    def _start_loop(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.loop.call_soon(self._ready.set)
+        self.loop.run_forever()
+
+
+def connect_to_server_sync(config: dict, max_workers: int = HYPHA_SYNC_MAX_WORKERS):
+    """Connect to a hypha server from synchronous code."""
+    server = SyncHyphaServer(max_workers=max_workers)
+    server.start(config)
+    return server
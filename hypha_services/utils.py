@@ -1,8 +1,29 @@
+import asyncio
+import calendar
+import codecs
+import collections
+import random
+import string
 import subprocess
 import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
+try:
+    from importlib import metadata
+except ImportError:  # pragma: no cover
+    # Python 3.7
+    import importlib_metadata as metadata
 
-def pip_install(package):
+try:
+    from packaging.requirements import Requirement
+except ImportError:  # pragma: no cover
+    from pip._vendor.packaging.requirements import Requirement
+
+
+def pip_install(*packages):
+    """Install packages with a single pip call."""
     process = subprocess.Popen(
         [
             sys.executable,
@@ -12,7 +33,7 @@ def pip_install(package):
             "--no-cache-dir",
             "--disable-pip-version-check",
             "--no-warn-script-location",
-            package,
+            *packages,
         ],
         stdout=subprocess.PIPE,
         stderr=subprocess.PIPE,
@@ -22,8 +43,370 @@ def pip_install(package):
 
     if process.returncode != 0:
         raise Exception(
-            f"Failed to install package {package}. {stderr.decode().strip()}"
+            f"Failed to install package {' '.join(packages)}. "
+            f"{stderr.decode().strip()}"
         )
 
     print(stdout.decode().strip())
-    print(f"Successfully installed package {package}")
+    print(f"Successfully installed package {' '.join(packages)}")
+
+
+def is_installed(requirement: str) -> bool:
+    """Check from the installed metadata if a requirement is satisfied."""
+    req = Requirement(requirement)
+    try:
+        version = metadata.version(req.name)
+    except metadata.PackageNotFoundError:
+        return False
+    if req.specifier and not req.specifier.contains(version, prereleases=True):
+        return False
+    # The dependencies of the requested extras must be installed too
+    for extra in req.extras:
+        for dependency in metadata.requires(req.name) or []:
+            dep = Requirement(dependency)
+            if dep.marker is None or not dep.marker.evaluate({"extra": extra}):
+                continue
+            extras = f"[{','.join(sorted(dep.extras))}]" if dep.extras else ""
+            if not is_installed(f"{dep.name}{extras}{dep.specifier}"):
+                return False
+    return True
+
+
+def install_requirements(requirements, background=False):
+    """Install the requirements which are not satisfied yet.
+
+    The missing requirements are installed with a single pip call, in a
+    background thread if `background` is set. Returns the missing requirements.
+    """
+    missing = [r for r in requirements if not is_installed(r)]
+    if missing:
+        if background:
+            threading.Thread(target=pip_install, args=missing, daemon=True).start()
+        else:
+            pip_install(*missing)
+    return missing
+
+
+_BYTE_UNITS = {"b": 1, "k": 1024, "m": 1024**2, "g": 1024**3, "t": 1024**4}
+
+
+def parse_bytes(size) -> int:
+    """Convert a size like 64M or 2g into a number of bytes."""
+    if size is None or isinstance(size, (int, float)):
+        return size
+    size = size.strip().lower().rstrip("bi") or "0"
+    if size[-1] in _BYTE_UNITS:
+        return int(float(size[:-1]) * _BYTE_UNITS[size[-1]])
+    return int(size)
+
+
+class LogCursor:
+    """Decode log bytes into text chunks while tracking a byte-offset cursor.
+
+    The first `offset` bytes fed to the cursor are skipped, `feed` returns a
+    dict with the decoded `logs` and the `offset` to resume from, or None if
+    there is nothing new to decode yet.
+    """
+
+    def __init__(self, offset: int = 0):
+        self.offset = offset
+        self._decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        self._position = 0
+
+    def feed(self, chunk):
+        """Decode the next chunk of the log stream."""
+        if isinstance(chunk, str):
+            chunk = chunk.encode("utf-8")
+        end = self._position + len(chunk)
+        if end <= self.offset:
+            self._position = end
+            return None
+        if self._position < self.offset:
+            chunk = chunk[self.offset - self._position :]
+        self._position = end
+        text = self._decoder.decode(chunk)
+        if not text:
+            return None
+        # Bytes of an incomplete character are only counted once decoded
+        pending = len(self._decoder.getstate()[0])
+        return {"logs": text, "offset": self._position - pending}
+
+
+def iter_log_chunks(chunks, offset: int = 0):
+    """Decode a stream of log bytes into text chunks with a byte-offset cursor."""
+    cursor = LogCursor(offset)
+    for chunk in chunks:
+        decoded = cursor.feed(chunk)
+        if decoded is not None:
+            yield decoded
+
+
+def read_log_chunks(chunks, offset: int = 0, max_bytes: int = 1024 * 1024) -> dict:
+    """Read decoded logs from a stream of log bytes, starting at a byte offset."""
+    logs = []
+    size = 0
+    for chunk in iter_log_chunks(chunks, offset):
+        logs.append(chunk["logs"])
+        size = chunk["offset"] - offset
+        if size >= max_bytes:
+            return {"logs": "".join(logs), "offset": offset + size, "complete": False}
+    return {"logs": "".join(logs), "offset": offset + size, "complete": True}
+
+
+def _split_timestamp(line: bytes):
+    # Split "2024-01-02T03:04:05.123456789Z content" into ((seconds, nanoseconds),
+    # content), the timestamp is None if the line does not start with one
+    stamp, _, content = line.partition(b" ")
+    try:
+        date, _, fraction = stamp.decode("ascii").rstrip("Z").partition(".")
+        seconds = calendar.timegm(time.strptime(date, "%Y-%m-%dT%H:%M:%S"))
+        return (seconds, int((fraction + "000000000")[:9])), content
+    except ValueError:
+        return None, line
+
+
+class TimestampedLogReader:
+    """Read logs requested with timestamps from a byte offset, up to `max_bytes`.
+
+    The offsets count the bytes of the logs without the timestamps. Without
+    a `position`, the first `offset` bytes of the logs are skipped. Otherwise
+    the logs were requested from the timestamp of a position returned by a
+    previous read which ended at `offset`, and the lines it has already
+    returned are skipped. The reading stops at the end of a line once
+    `max_bytes` are read, `feed` then returns True.
+    """
+
+    def __init__(self, offset: int = 0, max_bytes: int = 1024 * 1024, position=None):
+        self.offset = offset
+        self.max_bytes = max_bytes
+        self.full = False
+        self._skip = 0 if position is not None else offset
+        self._resume = position
+        # The timestamp of the last line read, how many complete lines with
+        # this timestamp were read, and the bytes read of the next one
+        self._position = tuple(position) if position is not None else (None, 0, 0)
+        self._logs = []
+        self._size = 0
+        self._buffer = b""
+
+    def feed(self, chunk) -> bool:
+        """Read the next chunk of the log stream, return True once full."""
+        if isinstance(chunk, str):
+            chunk = chunk.encode("utf-8")
+        self._buffer += chunk
+        while not self.full:
+            end = self._buffer.find(b"\n")
+            if end < 0:
+                break
+            line, self._buffer = self._buffer[: end + 1], self._buffer[end + 1 :]
+            self._read_line(line, complete=True)
+        return self.full
+
+    def result(self):
+        """Return the logs read, the offset to resume from and whether the end
+        of the logs was reached, and the position of the end of the read."""
+        if not self.full and self._buffer:
+            # The last line is not terminated (yet)
+            self._read_line(self._buffer, complete=False)
+            self._buffer = b""
+        size = self._size
+        result = {
+            "logs": b"".join(self._logs).decode("utf-8", "replace"),
+            "offset": self.offset + size,
+            "complete": not self.full,
+        }
+        position = self._position if self._position[0] is not None else None
+        return result, position
+
+    def _read_line(self, line: bytes, complete: bool):
+        timestamp, content = _split_timestamp(line)
+        last, lines, partial = self._position
+        if self._resume is not None and timestamp is not None:
+            resume_timestamp, resume_lines, resume_partial = self._resume
+            if timestamp < tuple(resume_timestamp):
+                return
+            if timestamp == tuple(resume_timestamp):
+                if resume_lines > 0:
+                    self._resume = (resume_timestamp, resume_lines - 1, resume_partial)
+                    return
+                # Skip the part of the line returned by the previous read
+                content = content[resume_partial:]
+            self._resume = None
+        if timestamp is None or timestamp != last:
+            last, lines, partial = timestamp, 0, 0
+        read = len(content)
+        if self._skip:
+            skipped = min(self._skip, len(content))
+            self._skip -= skipped
+            content = content[skipped:]
+        if content:
+            self._logs.append(content)
+            self._size += len(content)
+        if complete:
+            self._position = (last, lines + 1, 0)
+        else:
+            self._position = (last, lines, partial + read)
+        if complete and self._size >= self.max_bytes:
+            self.full = True
+
+
+def read_timestamped_logs(
+    chunks, offset: int = 0, max_bytes: int = 1024 * 1024, position=None
+):
+    """Read a stream of logs with timestamps, see `TimestampedLogReader`."""
+    reader = TimestampedLogReader(offset, max_bytes, position)
+    for chunk in chunks:
+        if reader.feed(chunk):
+            break
+    return reader.result()
+
+
+class LogPositions:
+    """Remember where the reads of logs ended, to resume them with `since`.
+
+    A read continuing from the offset where a previous one ended only asks
+    the daemon for the logs written since the timestamp of its last line.
+    """
+
+    def __init__(self, max_size: int = 1024):
+        self.max_size = max_size
+        self._positions = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return the position stored for a key, or None."""
+        with self._lock:
+            return self._positions.get(key)
+
+    def put(self, key, position):
+        """Store a position, dropping the least recently stored ones."""
+        if position is None:
+            return
+        with self._lock:
+            self._positions[key] = position
+            self._positions.move_to_end(key)
+            while len(self._positions) > self.max_size:
+                self._positions.popitem(last=False)
+
+    @staticmethod
+    def since(position) -> float:
+        """Return a UNIX time at or just before the timestamp of a position."""
+        (seconds, nanoseconds), _, _ = position
+        # Float timestamps are not precise to the nanosecond, the lines read
+        # already are skipped by the reader
+        return seconds + nanoseconds / 1e9 - 1e-6
+
+
+async def iterate_in_executor(iterator, close=None, executor=None):
+    """Iterate over a blocking iterator without blocking the event loop.
+
+    `close` is called when the iteration ends or is cancelled, it should
+    release the underlying stream so a pending read in the executor returns.
+    """
+    loop = asyncio.get_running_loop()
+    done = object()
+    try:
+        while True:
+            item = await loop.run_in_executor(executor, next, iterator, done)
+            if item is done:
+                break
+            yield item
+    finally:
+        if close is not None:
+            close()
+
+
+async def iterate_stream(launcher, function_id: str, *args, max_events=1, **kwargs):
+    """Iterate over the events of a generator function run by the function launcher.
+
+    The events are read `max_events` at a time. Close the iterator (with
+    `aclose()`) to stop the function before its end.
+    """
+    stream_id = await launcher.start_stream(function_id, *args, **kwargs)
+    done = False
+    try:
+        while not done:
+            for event in await launcher.read_stream(stream_id, max_events):
+                done = event["type"] == "done"
+                yield event
+    finally:
+        if not done:
+            await launcher.close_stream(stream_id)
+
+
+def prepare_batch(specs: list, existing) -> list:
+    """Name the launch specs of a batch and validate the names.
+
+    The names are checked against `existing` (a single listing of the
+    containers) and against each other. Returns a list of `(spec, error)`,
+    the containers are launched detached unless the spec sets `detach`.
+    """
+    existing = set(existing)
+    batch = []
+    for spec in specs:
+        spec = {"detach": True, **spec}
+        spec["name"] = spec.get("name") or "".join(
+            random.choices(string.ascii_lowercase + string.digits, k=24)
+        )
+        error = None
+        if spec["name"] == "all":
+            error = "Container name cannot be 'all'"
+        elif spec["name"] in existing:
+            error = f"Container {spec['name']} already exists"
+        elif "image" not in spec or "command" not in spec:
+            error = "The image and the command are required"
+        existing.add(spec["name"])
+        batch.append((spec, error))
+    return batch
+
+
+def _batch_result(spec: dict, output=None, error=None) -> dict:
+    result = {"name": spec["name"], "success": error is None, "error": error}
+    if not spec["detach"] and error is None:
+        result["output"] = output
+    return result
+
+
+def run_batch(run, specs: list, existing, max_workers: int) -> list:
+    """Launch a batch of containers with up to `max_workers` threads.
+
+    `run(**spec)` launches a single container. A failed launch does not
+    abort the batch, the name and error of every spec are reported in order.
+    """
+
+    def launch(item):
+        spec, error = item
+        if error is not None:
+            return _batch_result(spec, error=error)
+        try:
+            return _batch_result(spec, output=run(**spec))
+        except Exception as e:  # pylint: disable=broad-except
+            return _batch_result(spec, error=str(e))
+
+    batch = prepare_batch(specs, existing)
+    if not batch:
+        return []
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(batch)))) as pool:
+        return list(pool.map(launch, batch))
+
+
+async def run_batch_async(run, specs: list, existing, concurrency: int) -> list:
+    """Launch a batch of containers with up to `concurrency` coroutines.
+
+    The same as `run_batch`, for a coroutine function `run`.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def launch(item):
+        spec, error = item
+        if error is not None:
+            return _batch_result(spec, error=error)
+        try:
+            async with semaphore:
+                return _batch_result(spec, output=await run(**spec))
+        except Exception as e:  # pylint: disable=broad-except
+            return _batch_result(spec, error=str(e))
+
+    return await asyncio.gather(
+        *(launch(item) for item in prepare_batch(specs, existing))
+    )
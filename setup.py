@@ -12,7 +12,7 @@ LONG_DESCRIPTION = README_FILE.read_text(encoding="utf-8")
 VERSION_FILE = ROOT_DIR / "hypha_services" / "VERSION"
 VERSION = json.loads(VERSION_FILE.read_text())["version"]
 
-REQUIRES = []
+REQUIRES = ['importlib_metadata; python_version < "3.8"']
 
 setup(
     name="hypha_services",
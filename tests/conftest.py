@@ -0,0 +1,11 @@
+"""Provide the fixtures shared by the tests."""
+import pytest
+import ray
+
+
+@pytest.fixture(name="ray_cluster", scope="session")
+def fixture_ray_cluster():
+    """Start a local Ray instance for the tests which need one."""
+    ray.init(num_cpus=2, include_dashboard=False, log_to_driver=False)
+    yield
+    ray.shutdown()
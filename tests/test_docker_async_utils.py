@@ -0,0 +1,108 @@
+"""Test the log reads and the pull retries of the asyncio docker backend."""
+import asyncio
+import struct
+
+from hypha_services.docker_async_utils import (
+    DockerAPIError,
+    _demux,
+    read_logs,
+    run_container,
+)
+
+
+def _frame(stream_type: int, payload: bytes) -> bytes:
+    return bytes([stream_type, 0, 0, 0]) + struct.pack(">L", len(payload)) + payload
+
+
+class _FakeLimit:
+    def __init__(self, calls):
+        self.calls = calls
+
+    async def __aenter__(self):
+        self.calls.append("limit")
+
+    async def __aexit__(self, *exc_info):
+        self.calls.append("release")
+
+
+class _FakeAsyncClient:
+    """Stand in for the asyncio docker client without a daemon."""
+
+    sync_client = None
+    index = None
+
+    def __init__(self, payloads=(), missing_image=False):
+        self.payloads = list(payloads)
+        self.missing_image = missing_image
+        self.calls = []
+        self.stream_params = []
+
+    def limit(self, kind):
+        return _FakeLimit(self.calls)
+
+    async def request(self, method, path, params=None, body=None, timeout=None):
+        self.calls.append(path)
+        if path == "/containers/json":
+            return []
+        if path == "/containers/create":
+            if self.missing_image:
+                raise DockerAPIError(404, "No such image: image:latest")
+            return {"Id": "created"}
+        if path == "/images/create":
+            self.missing_image = False
+        return None
+
+    async def stream(self, path, params=None):
+        self.stream_params.append(params)
+        for payload in self.payloads:
+            yield payload
+
+
+def test_demux_selects_the_streams():
+    """Test that the stdout and stderr frames are extracted in order."""
+    data = _frame(1, b"out\n") + _frame(2, b"err\n") + _frame(1, b"more")
+    assert _demux(data) == b"out\nerr\nmore"
+    assert _demux(data, stderr=False) == b"out\nmore"
+    assert _demux(data, stdout=False) == b"err\n"
+
+
+def test_read_logs_resumes_from_the_last_line():
+    """Test that a read continuing from its offset only asks for new logs."""
+
+    async def main():
+        client = _FakeAsyncClient(
+            [
+                b"2024-01-01T00:00:00.000000001Z first\n",
+                b"2024-01-01T00:00:01.5Z second\n",
+            ]
+        )
+        result = await read_logs(client, "name")
+        assert result == {"logs": "first\nsecond\n", "offset": 13, "complete": True}
+        client.payloads = [
+            b"2024-01-01T00:00:01.5Z second\n",
+            b"2024-01-01T00:00:02Z third\n",
+        ]
+        result = await read_logs(client, "name", offset=13)
+        assert result == {"logs": "third\n", "offset": 19, "complete": True}
+        assert client.stream_params[1]["since"] == "1704067201.500000000"
+        assert await read_logs(client, "name", tail=0) == {
+            "logs": "",
+            "offset": 0,
+            "complete": True,
+        }
+
+    asyncio.run(main())
+
+
+def test_run_container_pulls_outside_the_run_limit():
+    """Test that a missing image is pulled without holding a run slot."""
+
+    async def main():
+        client = _FakeAsyncClient(missing_image=True)
+        assert await run_container(client, "image", "true", detach=True, name="a")
+        pull = client.calls.index("/images/create")
+        assert client.calls[pull - 1] == "release"
+        assert client.calls[pull + 1] == "limit"
+        assert client.calls.count("/containers/create") == 2
+
+    asyncio.run(main())
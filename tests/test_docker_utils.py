@@ -0,0 +1,263 @@
+"""Test the container index, the teardown, the warm pools and the images."""
+import threading
+import time
+from types import SimpleNamespace
+
+import docker
+import pytest
+
+from hypha_services import docker_utils
+from hypha_services.docker_utils import (
+    DOCKER_CONTAINER_PREFIX,
+    ContainerIndex,
+    ImageManager,
+)
+
+
+class _FakeEvents:
+    """Stand in for a docker events stream without any event."""
+
+    def __init__(self):
+        self._closed = threading.Event()
+
+    def __iter__(self):
+        self._closed.wait()
+        return iter([])
+
+    def close(self):
+        self._closed.set()
+
+
+class _FakeAPI:
+    """Stand in for the low-level docker client listing the containers."""
+
+    def __init__(self):
+        self.listing = []
+        self.during_listing = None
+        self.failing = set()
+        self.removed = []
+        self.started = []
+        self.images = set()
+        self.pulls = []
+
+    def containers(self, all=False, filters=None):  # pylint: disable=redefined-builtin
+        if self.during_listing is not None:
+            self.during_listing()
+        return [
+            {"Names": [f"/{DOCKER_CONTAINER_PREFIX}{name}"], "Id": name, "State": state}
+            for name, state in self.listing
+        ]
+
+    def stop(self, container_id, timeout=None):
+        if container_id in self.failing:
+            raise RuntimeError(f"Cannot stop {container_id}")
+
+    def remove_container(self, container_id, force=False):
+        self.removed.append(container_id)
+
+    def inspect_image(self, image):
+        if image not in self.images:
+            raise docker.errors.ImageNotFound(image)
+        return {"Size": 0}
+
+    def pull(self, repository, tag=None, stream=False, decode=False):
+        self.images.add(f"{repository}:{tag}")
+        self.pulls.append(f"{repository}:{tag}")
+        return iter([])
+
+    def rename(self, container_id, name):
+        pass
+
+    def start(self, container_id):
+        if container_id in self.failing:
+            raise RuntimeError(f"Cannot start {container_id}")
+        self.started.append(container_id)
+
+
+class _FakeContainers:
+    """Stand in for the docker client creating containers."""
+
+    def __init__(self):
+        self.created = []
+        self.missing_image = False
+
+    def create(self, image, command, name, **options):
+        if self.missing_image:
+            raise docker.errors.ImageNotFound(image)
+        self.created.append(name)
+        return SimpleNamespace(id=name)
+
+
+class _FakeClient:
+    """Stand in for a docker client."""
+
+    def __init__(self):
+        self.api = _FakeAPI()
+        self.containers = _FakeContainers()
+        self.events_stream = _FakeEvents()
+
+    def events(self, **kwargs):
+        return self.events_stream
+
+
+def _wait_for(condition, timeout=5):
+    deadline = time.time() + timeout
+    while not condition():
+        assert time.time() < deadline, "Timed out"
+        time.sleep(0.01)
+
+
+def test_resync_rebuilds_the_index():
+    """Test that a resync adds and removes the entries listed by the daemon."""
+    client = _FakeClient()
+    client.api.listing = [("a", "running")]
+    index = ContainerIndex(client, resync_interval=3600)
+    try:
+        assert index.names() == ["a"]
+        client.api.listing = [("b", "exited")]
+        index.resync()
+        assert index.get("a") is None
+        assert index.get("b") == {"id": "b", "status": "exited"}
+    finally:
+        index.close()
+
+
+def test_resync_keeps_changes_made_during_the_listing():
+    """Test that the updates and discards racing a resync are not undone."""
+    client = _FakeClient()
+    client.api.listing = [("a", "running"), ("b", "running")]
+    index = ContainerIndex(client, resync_interval=3600)
+    try:
+
+        def change_index():
+            index.update("a", "a", "exited")
+            index.discard("b")
+            index.update("c", "c", "running")
+
+        client.api.during_listing = change_index
+        index.resync()
+        assert index.get("a") == {"id": "a", "status": "exited"}
+        assert index.get("b") is None
+        assert index.get("c") == {"id": "c", "status": "running"}
+        # The next listing is authoritative again
+        client.api.during_listing = None
+        index.resync()
+        assert index.get("a") == {"id": "a", "status": "running"}
+        assert index.get("b") == {"id": "b", "status": "running"}
+        assert index.get("c") is None
+    finally:
+        index.close()
+
+
+@pytest.fixture(name="client")
+def fixture_client():
+    """Return a fake client with its own container index and image manager."""
+    client = _FakeClient()
+    yield client
+    index = docker_utils._container_indexes.pop(  # pylint: disable=protected-access
+        id(client), None
+    )
+    if index is not None:
+        index.close()
+    docker_utils._image_managers.pop(  # pylint: disable=protected-access
+        id(client), None
+    )
+
+
+def test_stop_all_reports_each_container(client):
+    """Test that a failed teardown is reported and kept in the index."""
+    client.api.listing = [("a", "running"), ("b", "running"), ("c", "exited")]
+    client.api.failing = {"b"}
+    report = docker_utils.stop_container(client, "all", max_workers=2)
+    results = {result["name"]: result for result in report["containers"]}
+    assert sorted(results) == ["a", "b", "c"]
+    assert results["a"]["success"] and results["c"]["success"]
+    assert not results["b"]["success"]
+    assert "Cannot stop b" in results["b"]["error"]
+    assert sorted(client.api.removed) == ["a", "c"]
+    assert docker_utils.list_containers(client) == ["b"]
+    with pytest.raises(Exception, match="Failed to stop container b"):
+        docker_utils.stop_container(client, "b")
+    assert docker_utils.exists_container(client, "b")
+
+
+def test_warm_pool_refills_after_claims(client):
+    """Test that a claimed container is replaced and idle ones are removed."""
+    pool = docker_utils.WarmPool(client, "image", "command", {}, size=2)
+    try:
+        _wait_for(lambda: len(client.containers.created) == 2)
+        claimed = pool.claim()
+        assert claimed in client.containers.created
+        _wait_for(lambda: len(client.containers.created) == 3)
+        assert pool.stats()["idle"] == 2
+    finally:
+        pool.close()
+    assert sorted(client.api.removed) == sorted(client.containers.created[1:])
+
+
+def test_warm_pool_pulls_a_missing_image_once(client):
+    """Test that a container is not created forever when the image is missing."""
+    client.containers.missing_image = True
+    pool = docker_utils.WarmPool(client, "image", "command", {}, size=0)
+    try:
+        with pytest.raises(docker.errors.ImageNotFound):
+            pool._create()  # pylint: disable=protected-access
+        assert client.api.pulls == ["image:latest"]
+    finally:
+        pool.close()
+
+
+def test_failed_claim_removes_the_container(client):
+    """Test that a claimed container is removed when it cannot be started."""
+    pool = docker_utils.WarmPool(client, "image", "command", {}, size=0)
+    client.api.failing = {"pooled"}
+    try:
+        with pytest.raises(RuntimeError, match="Cannot start"):
+            docker_utils._run_pooled_container(  # pylint: disable=protected-access
+                client, pool, "pooled", "name", detach=True
+            )
+        assert client.api.removed == ["pooled"]
+        assert pool.stats()["hits"] == 0
+    finally:
+        pool.close()
+
+
+class _FakeImageAPI:
+    """Stand in for the low-level docker client managing images."""
+
+    def __init__(self):
+        self.local = set()
+        self.removed = []
+
+    def inspect_image(self, image):
+        if image not in self.local:
+            raise docker.errors.ImageNotFound(image)
+        return {"Size": 60}
+
+    def pull(self, repository, tag=None, stream=False, decode=False):
+        self.local.add(f"{repository}:{tag}")
+        return iter([{"status": "Pull complete"}])
+
+    def remove_image(self, image):
+        self.local.discard(image)
+        self.removed.append(image)
+
+
+def test_image_manager_keeps_images_in_use():
+    """Test that the images ensured recently or in flight are not evicted."""
+    client = SimpleNamespace(api=_FakeImageAPI())
+    manager = ImageManager(client, disk_budget=100, min_age=3600)
+    manager.ensure("a")
+    manager.ensure("b")
+    assert client.api.removed == []
+    manager.min_age = 0
+    ensuring = manager._ensuring  # pylint: disable=protected-access
+    ensuring["b:latest"] += 1
+    manager.ensure("c")
+    assert client.api.removed == ["a:latest"]
+    manager.ensure("d")
+    assert client.api.removed == ["a:latest", "c:latest"]
+    ensuring["b:latest"] -= 1
+    manager.ensure("a")
+    assert client.api.removed == ["a:latest", "c:latest", "b:latest", "d:latest"]
+    assert [image["image"] for image in manager.status()["images"]] == ["a:latest"]
@@ -0,0 +1,44 @@
+"""Test the background health probes."""
+import asyncio
+import time
+
+from hypha_services.health import HealthMonitor
+
+
+def _fail():
+    raise ConnectionError("unreachable")
+
+
+def test_health_monitor_status():
+    """Test that the probes are reported as starting, ready or degraded."""
+
+    async def main():
+        monitor = HealthMonitor(timeout=0.05)
+        monitor.add_probe("ok", lambda: True)
+        assert monitor.status()["status"] == "starting"
+        assert (await monitor.check())["status"] == "ready"
+        monitor.add_probe("failing", _fail)
+        monitor.add_probe("slow", lambda: time.sleep(0.2))
+        status = await monitor.check()
+        assert status["status"] == "degraded"
+        assert status["probes"]["ok"]["ok"]
+        assert status["probes"]["failing"]["error"] == "unreachable"
+        assert status["probes"]["slow"]["error"] == "Timed out after 0.05s"
+
+    asyncio.run(main())
+
+
+def test_health_monitor_runs_in_background():
+    """Test that the probes run periodically once started."""
+
+    async def main():
+        calls = []
+        monitor = HealthMonitor(interval=0.01)
+        monitor.add_probe("count", lambda: calls.append(1))
+        monitor.start()
+        await asyncio.sleep(0.1)
+        monitor.stop()
+        assert len(calls) > 1
+        assert monitor.status()["status"] == "ready"
+
+    asyncio.run(main())
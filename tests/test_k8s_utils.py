@@ -0,0 +1,78 @@
+"""Test the pod informer of the kubernetes backend."""
+from types import SimpleNamespace
+
+import pytest
+from kubernetes import client
+from kubernetes.client.models import V1ObjectMeta, V1Pod
+
+from hypha_services import k8s_utils
+from hypha_services.k8s_utils import K8S_POD_PREFIX
+
+
+class _FakeCoreApi:
+    """Stand in for a kubernetes client listing and deleting pods."""
+
+    def __init__(self, names, delete_status=None):
+        self.names = names
+        self.delete_status = delete_status or {}
+        self.created = []
+
+    def list_namespaced_pod(self, namespace, label_selector, **kwargs):
+        pods = [
+            V1Pod(metadata=V1ObjectMeta(name=f"{K8S_POD_PREFIX}{name}"))
+            for name in self.names
+        ]
+        return SimpleNamespace(
+            items=pods, metadata=SimpleNamespace(resource_version="1")
+        )
+
+    def create_namespaced_pod(self, namespace, body):
+        self.created.append(body)
+        return body
+
+    def delete_namespaced_pod(self, name, namespace, grace_period_seconds):
+        status = self.delete_status.get(name[len(K8S_POD_PREFIX) :])
+        if status is not None:
+            raise client.exceptions.ApiException(status=status)
+
+
+@pytest.fixture(name="client_api")
+def fixture_client_api(monkeypatch):
+    """Return a fake client whose informer does not watch the pods."""
+    monkeypatch.setattr(k8s_utils.PodInformer, "_watch_pods", lambda self: None)
+    client_api = _FakeCoreApi(
+        ["failing", "missing", "pod"], {"failing": 500, "missing": 404}
+    )
+    yield client_api
+    k8s_utils.get_pod_informer(client_api).close()
+    k8s_utils._pod_informers.pop(  # pylint: disable=protected-access
+        id(client_api), None
+    )
+
+
+def test_stop_container_discards_stopped_pods(client_api):
+    """Test that a pod is dropped from the cache once it is deleted or gone."""
+    informer = k8s_utils.get_pod_informer(client_api)
+    k8s_utils.stop_container(client_api, "pod")
+    assert informer.get("pod") is None
+    with pytest.raises(Exception, match="does not exist"):
+        k8s_utils.stop_container(client_api, "missing")
+    assert informer.get("missing") is None
+
+
+def test_stop_container_keeps_pods_on_failure(client_api):
+    """Test that a pod whose deletion failed is still reported."""
+    informer = k8s_utils.get_pod_informer(client_api)
+    with pytest.raises(client.exceptions.ApiException):
+        k8s_utils.stop_container(client_api, "failing")
+    assert informer.get("failing") is not None
+    assert k8s_utils.exists_container(client_api, "failing")
+
+
+def test_run_container_sets_the_memory_in_bytes(client_api):
+    """Test that a docker size is converted into a kubernetes quantity."""
+    k8s_utils.run_container(client_api, "image", "true", name="a", memory="64g")
+    limits = client_api.created[0].spec.containers[0].resources.limits
+    assert limits == {"memory": str(64 * 1024**3)}
+    with pytest.raises(ValueError):
+        k8s_utils.run_container(client_api, "image", "true", name="b", memory="lots")
@@ -0,0 +1,99 @@
+"""Test the metrics registry and the instrumented services."""
+import asyncio
+
+import pytest
+
+from hypha_services.metrics import MetricsRegistry
+
+
+def _value(metrics, kind, name, **labels):
+    for metric in metrics[kind]:
+        if metric["name"] == name and metric["labels"] == labels:
+            return metric
+    return None
+
+
+def test_histogram_buckets():
+    """Test that the observations are counted in their buckets."""
+    registry = MetricsRegistry()
+    registry.observe("latency", 0.002, op="a")
+    registry.observe("latency", 100, op="a")
+    registry.observe("latency", 0.002, op="b")
+    histogram = _value(registry.get_metrics(), "histograms", "latency", op="a")
+    assert histogram["count"] == 2
+    assert histogram["sum"] == pytest.approx(100.002)
+    assert histogram["buckets"][0.005] == 1
+    assert histogram["buckets"][300] == 1
+    assert histogram["buckets"]["+Inf"] == 0
+
+
+def test_counters_and_gauges():
+    """Test that the counters and gauges are keyed by their labels."""
+    registry = MetricsRegistry()
+    registry.inc("calls", op="a")
+    registry.inc("calls", 2, op="a")
+    registry.add("in_flight", 1)
+    registry.add("in_flight", -1)
+    metrics = registry.get_metrics()
+    assert _value(metrics, "counters", "calls", op="a")["value"] == 3
+    assert _value(metrics, "gauges", "in_flight")["value"] == 0
+
+
+def test_prometheus_format():
+    """Test the exposition format, with cumulative buckets and escaped labels."""
+    registry = MetricsRegistry()
+    registry.observe("latency", 0.002)
+    registry.observe("latency", 0.02)
+    registry.inc("errors", op='say "hi"')
+    text = registry.get_prometheus_metrics()
+    lines = text.splitlines()
+    assert "# TYPE latency histogram" in lines
+    assert 'latency_bucket{le="0.005"} 1' in lines
+    assert 'latency_bucket{le="+Inf"} 2' in lines
+    assert "latency_count 2" in lines
+    assert "# TYPE errors counter" in lines
+    assert 'errors{op="say \\"hi\\""} 1' in lines
+    assert text.endswith("\n")
+
+
+def test_instrument_service():
+    """Test that sync, async and generator functions are instrumented."""
+    registry = MetricsRegistry()
+
+    def fail():
+        raise ValueError("failed")
+
+    async def double(x):
+        return 2 * x
+
+    async def count(n):
+        for i in range(n):
+            yield i
+
+    service = registry.instrument_service(
+        {"id": "svc", "config": {}, "fail": fail, "double": double, "count": count}
+    )
+    assert service["config"] == {}
+    with pytest.raises(ValueError):
+        service["fail"]()
+
+    async def main():
+        assert await service["double"](2) == 4
+        assert [i async for i in service["count"](3)] == [0, 1, 2]
+
+    asyncio.run(main())
+    metrics = registry.get_metrics()
+    for operation in ("fail", "double", "count"):
+        labels = {"service": "svc", "operation": operation}
+        calls = _value(metrics, "histograms", "hypha_service_call_seconds", **labels)
+        assert calls["count"] == 1
+        in_flight = _value(metrics, "gauges", "hypha_service_calls_in_flight", **labels)
+        assert in_flight["value"] == 0
+    errors = _value(
+        metrics,
+        "counters",
+        "hypha_service_call_errors_total",
+        service="svc",
+        operation="fail",
+    )
+    assert errors["value"] == 1
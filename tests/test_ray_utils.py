@@ -0,0 +1,556 @@
+"""Test the caches, batches, actor pools, objects, streams, routing and store."""
+import asyncio
+import os
+import threading
+import time
+
+import cloudpickle
+import numpy as np
+import pytest
+import ray
+
+from hypha_services.metrics import registry
+from hypha_services.ray_utils import (
+    ActorPool,
+    BatchQueue,
+    ClusterRouter,
+    ConcurrencyLimit,
+    FunctionActor,
+    FunctionDeployment,
+    FunctionStore,
+    RayCluster,
+    RemoteTask,
+    ResultCache,
+    _call,
+    _register_stream,
+    create_deployment,
+    download_chunk,
+    finish_upload,
+    get_object,
+    hash_arguments,
+    object_info,
+    put_object,
+    read_stream,
+    release_object,
+    start_upload,
+    upload_chunk,
+)
+
+
+def test_hash_arguments():
+    """Test that the hash depends on the values and names of the arguments."""
+    assert hash_arguments((1, "a"), {"b": [1, 2]}) == hash_arguments(
+        (1, "a"), {"b": [1, 2]}
+    )
+    assert hash_arguments((1,), {}) != hash_arguments((2,), {})
+    assert hash_arguments((), {"a": 1}) != hash_arguments((), {"b": 1})
+
+
+def test_result_cache_lru_and_ttl():
+    """Test that the least recently used and the expired results are dropped."""
+    cache = ResultCache(max_size=2)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    assert cache.get("a") == (1, True)
+    cache.put("c", 3)
+    assert cache.get("b") == (None, False)
+    assert cache.get("a") == (1, True)
+    expiring = ResultCache(ttl=-1)
+    expiring.put("a", 1)
+    assert expiring.get("a") == (None, False)
+
+
+def test_result_cache_single_flight():
+    """Test that identical calls in flight share a single call."""
+
+    async def main():
+        cache = ResultCache()
+        calls = []
+
+        async def call():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            return 42
+
+        results = await asyncio.gather(
+            *(cache.get_or_call("k", call) for _ in range(5))
+        )
+        assert results == [42] * 5
+        assert len(calls) == 1
+        assert await cache.get_or_call("k", call) == 42
+        assert len(calls) == 1
+        assert cache.stats() == {"size": 1, "hits": 5, "misses": 1}
+
+    asyncio.run(main())
+
+
+def test_result_cache_cancelled_caller():
+    """Test that a cancelled caller does not fail the others."""
+
+    async def main():
+        cache = ResultCache()
+
+        async def call():
+            await asyncio.sleep(0.05)
+            return 42
+
+        first = asyncio.ensure_future(cache.get_or_call("k", call))
+        second = asyncio.ensure_future(cache.get_or_call("k", call))
+        await asyncio.sleep(0.01)
+        first.cancel()
+        assert await second == 42
+        assert first.cancelled()
+        assert cache.get("k") == (42, True)
+
+    asyncio.run(main())
+
+
+def test_result_cache_all_callers_cancelled():
+    """Test that the call is cancelled once nobody waits for it."""
+
+    async def main():
+        cache = ResultCache()
+        cancelled = asyncio.Event()
+
+        async def call():
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                cancelled.set()
+                raise
+
+        caller = asyncio.ensure_future(cache.get_or_call("k", call))
+        await asyncio.sleep(0.01)
+        caller.cancel()
+        await asyncio.wait_for(cancelled.wait(), 1)
+        assert cache.get("k") == (None, False)
+
+    asyncio.run(main())
+
+
+def test_result_cache_error_is_not_cached():
+    """Test that a failed call is reported to every caller and not cached."""
+
+    async def main():
+        cache = ResultCache()
+
+        async def fail():
+            await asyncio.sleep(0.01)
+            raise ValueError("failed")
+
+        results = await asyncio.gather(
+            cache.get_or_call("k", fail),
+            cache.get_or_call("k", fail),
+            return_exceptions=True,
+        )
+        assert all(isinstance(r, ValueError) for r in results)
+        assert cache.get("k") == (None, False)
+
+    asyncio.run(main())
+
+
+def test_concurrency_limit_queue_and_reject():
+    """Test that the calls beyond the limit are queued, then rejected."""
+
+    async def main():
+        limit = ConcurrencyLimit("f", max_in_flight=1, max_queue=1)
+        await limit.acquire()
+        waiter = asyncio.ensure_future(limit.acquire())
+        await asyncio.sleep(0)
+        assert limit.stats() == {"in_flight": 1, "queued": 1, "rejected": 0}
+        with pytest.raises(RuntimeError, match="Too many calls"):
+            await limit.acquire()
+        limit.release()
+        await waiter
+        assert limit.stats() == {"in_flight": 1, "queued": 0, "rejected": 1}
+        limit.release()
+        assert limit.stats()["in_flight"] == 0
+
+    asyncio.run(main())
+
+
+def test_concurrency_limit_cancelled_waiter():
+    """Test that a cancelled waiter gives up its place in the queue."""
+
+    async def main():
+        limit = ConcurrencyLimit("f", max_in_flight=1)
+        await limit.acquire()
+        cancelled = asyncio.ensure_future(limit.acquire())
+        waiter = asyncio.ensure_future(limit.acquire())
+        await asyncio.sleep(0)
+        cancelled.cancel()
+        await asyncio.sleep(0)
+        assert limit.stats()["queued"] == 1
+        limit.release()
+        await waiter
+        limit.release()
+        assert limit.stats() == {"in_flight": 0, "queued": 0, "rejected": 0}
+
+    asyncio.run(main())
+
+
+class _Doubler:
+    """Stand in for a deployed function taking a list of items."""
+
+    def __init__(self, results=None):
+        self.calls = []
+        self.results = results
+
+    async def remote(self, items, *args, **kwargs):
+        self.calls.append((list(items), args, kwargs))
+        return self.results if self.results is not None else [2 * i for i in items]
+
+
+def test_batch_queue_coalesces_calls():
+    """Test that concurrent calls with the same arguments share a batch."""
+
+    async def main():
+        f_remote = _Doubler()
+        queue = BatchQueue(f_remote, max_batch_size=4, max_wait=0.01)
+        results = await asyncio.gather(
+            queue.submit(([1, 2], "x"), {}),
+            queue.submit(([3],), {}),
+            queue.submit(([4], "x"), {}),
+        )
+        assert results == [[2, 4], [6], [8]]
+        assert sorted(f_remote.calls) == [([1, 2, 4], ("x",), {}), ([3], (), {})]
+        assert queue.stats() == {"batches": 2, "mean_batch_size": 2}
+
+    asyncio.run(main())
+
+
+def test_batch_queue_flushes_full_batches():
+    """Test that a batch is sent as soon as it is full."""
+
+    async def main():
+        f_remote = _Doubler()
+        queue = BatchQueue(f_remote, max_batch_size=2, max_wait=10)
+        results = await asyncio.wait_for(
+            asyncio.gather(queue.submit(([1],), {}), queue.submit(([2],), {})), 1
+        )
+        assert results == [[2], [4]]
+        assert f_remote.calls == [([1, 2], (), {})]
+
+    asyncio.run(main())
+
+
+def test_batch_queue_wrong_result_length():
+    """Test that every caller fails when the results do not match the items."""
+
+    async def main():
+        queue = BatchQueue(_Doubler(results=[1]), max_batch_size=2, max_wait=0.01)
+        results = await asyncio.gather(
+            queue.submit(([1],), {}), queue.submit(([2],), {}), return_exceptions=True
+        )
+        assert all(isinstance(r, ValueError) for r in results)
+
+    asyncio.run(main())
+
+
+def _count_calls():
+    # The functions sent to the workers are local to be pickled by value
+    def count_calls(state, x):
+        state["calls"] += 1
+        return x, state["calls"]
+
+    return count_calls
+
+
+def test_actor_pool_scales_up_on_demand(ray_cluster):
+    """Test that the actors are started when the busy ones are saturated."""
+
+    async def main():
+        pool = ActorPool(
+            "count_calls",
+            ray.remote(FunctionActor),
+            _count_calls(),
+            init=lambda: {"calls": 0},
+            min_actors=0,
+            max_actors=2,
+        )
+        try:
+            assert pool.stats()["actors"] == 0
+            assert await asyncio.gather(pool.remote(1), pool.remote(2)) == [
+                (1, 1),
+                (2, 1),
+            ]
+            assert pool.stats() == {"actors": 2, "in_flight": [0, 0]}
+            # The state returned by the init hook is kept between the calls
+            assert await pool.remote(3) == (3, 2)
+        finally:
+            pool.close()
+
+    asyncio.run(main())
+
+
+def test_actor_pool_replaces_dead_actors(ray_cluster):
+    """Test that an actor which died is replaced by a new one."""
+
+    async def main():
+        pool = ActorPool(
+            "count_calls",
+            ray.remote(FunctionActor),
+            _count_calls(),
+            init=lambda: {"calls": 0},
+        )
+        try:
+            assert await pool.remote(1) == (1, 1)
+            actors = pool._actors  # pylint: disable=protected-access
+            dead = actors[0]["handle"]
+            ray.kill(dead)
+            with pytest.raises(ray.exceptions.RayActorError):
+                await pool.remote(2)
+            assert len(actors) == 1 and actors[0]["handle"] is not dead
+            assert await pool.remote(3) == (3, 1)
+        finally:
+            pool.close()
+
+    asyncio.run(main())
+
+
+def test_object_handles(ray_cluster):
+    """Test the upload, download and release of the object handles."""
+    array = np.arange(12, dtype="float32").reshape(3, 4)
+    data = array.tobytes()
+    upload_id = start_upload(len(data), dtype=array.dtype.str, shape=array.shape)
+    upload_chunk(upload_id, 0, data[:20])
+    upload_chunk(upload_id, 20, data[20:])
+    handle = finish_upload(upload_id)
+    np.testing.assert_array_equal(get_object(handle), array)
+    info = object_info(handle)
+    assert info["nbytes"] == len(data) and info["shape"] == [3, 4]
+    assert download_chunk(handle, 8, 16) == data[8:24]
+    release_object(handle)
+    with pytest.raises(KeyError):
+        get_object(handle)
+
+
+def test_run_to_object_keeps_the_result_ref(ray_cluster):
+    """Test that the ref returned by the task or actor is kept as is."""
+
+    def double(x):
+        if x < 0:
+            raise ValueError("negative")
+        return 2 * x
+
+    async def main():
+        task = FunctionDeployment("double", RemoteTask("double", double))
+        ref = await task.run_to_object([put_object(2)], {})
+        assert isinstance(ref, ray.ObjectRef) and await ref == 4
+        with pytest.raises(ValueError, match="negative"):
+            await task.run_to_object([-1], {})
+        pool = ActorPool("double", ray.remote(FunctionActor), double)
+        try:
+            ref = await FunctionDeployment("double", pool).run_to_object([3], {})
+            assert isinstance(ref, ray.ObjectRef) and await ref == 6
+        finally:
+            pool.close()
+
+    asyncio.run(main())
+
+
+def test_remote_calls_record_their_timings(ray_cluster):
+    """Test that the queue and execution time of the calls are recorded."""
+
+    def add(x, y):
+        return x + y
+
+    async def main():
+        assert await RemoteTask("timed_add", add).remote(1, 2) == 3
+        pool = ActorPool("timed_add", ray.remote(FunctionActor), add)
+        try:
+            ref = await pool.remote_to_object(3, 4)
+            assert await ref == 7
+        finally:
+            pool.close()
+
+    asyncio.run(main())
+    for name in ("hypha_ray_queue_seconds", "hypha_ray_exec_seconds"):
+        histograms = [
+            histogram
+            for histogram in registry.get_metrics()["histograms"]
+            if histogram["name"] == name
+            and histogram["labels"] == {"function": "timed_add"}
+        ]
+        assert histograms[0]["count"] == 2
+
+
+def test_batched_call_with_object_handle(ray_cluster):
+    """Test that a handle passed as the batched argument is resolved first."""
+
+    def double_all(items):
+        return [2 * i for i in items]
+
+    async def main():
+        f_remote = RemoteTask("double_all", double_all)
+        deployment = FunctionDeployment(
+            "double_all", f_remote, batch_queue=BatchQueue(f_remote, 4)
+        )
+        handle = put_object([1, 2])
+        assert await asyncio.gather(
+            deployment.run([handle], {}), deployment.run([[3]], {})
+        ) == [[2, 4], [6]]
+        ref = await deployment.run_to_object([handle], {})
+        assert await ref == [2, 4]
+
+    asyncio.run(main())
+
+
+def test_warm_up_before_the_calls(ray_cluster):
+    """Test that the calls wait for the warm-up of a deployment."""
+
+    def double(x):
+        return 2 * x
+
+    async def main():
+        deployment = FunctionDeployment("double", RemoteTask("double", double))
+        future = deployment.start_warm_up(asyncio.get_running_loop(), args=[1])
+        assert deployment.status()["status"] == "building"
+        ref = await deployment.run_to_object([2], {})
+        assert future.done() and deployment.status()["status"] == "ready"
+        assert await ref == 4
+        assert "warmup_time" in deployment.status()
+
+    asyncio.run(main())
+
+
+def test_stream_results_and_progress(ray_cluster):
+    """Test that the items of a generator are streamed as events."""
+
+    def count(n):
+        for i in range(n):
+            yield {"__progress__": i / n}
+            yield i
+
+    async def main():
+        for f_remote in (
+            RemoteTask("count", count),
+            ActorPool("count", ray.remote(FunctionActor), count),
+        ):
+            deployment = FunctionDeployment("count", f_remote)
+            stream_id = _register_stream(deployment.stream([2], {}))
+            events = await read_stream(stream_id, max_events=10)
+            assert [(e["type"], e.get("value")) for e in events] == [
+                ("progress", None),
+                ("result", 0),
+                ("progress", None),
+                ("result", 1),
+                ("done", None),
+            ]
+            with pytest.raises(KeyError):
+                await read_stream(stream_id)
+            deployment.close()
+
+    asyncio.run(main())
+
+
+def test_timeout_cancels_the_call(ray_cluster):
+    """Test that a call past the timeout fails and releases its slot."""
+
+    def wait(seconds):
+        time.sleep(seconds)
+        return seconds
+
+    async def main():
+        limit = ConcurrencyLimit("wait", max_in_flight=1)
+        deployment = FunctionDeployment(
+            "wait", RemoteTask("wait", wait), limit=limit, timeout=0.5
+        )
+        with pytest.raises(TimeoutError, match="did not complete within"):
+            await deployment.run_to_object([30], {})
+        assert limit.stats()["in_flight"] == 0
+        # Leave the time to start a worker to the next call
+        deployment.timeout = 60
+        assert await deployment.run([0], {}) == 0
+
+    asyncio.run(main())
+
+
+def test_function_store_keeps_the_used_payloads(tmp_path):
+    """Test that only the oldest payloads no deployment uses are removed."""
+    store = FunctionStore(str(tmp_path), max_unused=1)
+    used = store.put(b"used")
+    old = store.put(b"old")
+    os.utime(os.path.join(str(tmp_path), "objects", old), (0, 0))
+    recent = store.put(b"recent")
+    store.save_deployment("f", {"function_hash": used, "init_hash": None})
+    assert store.has(used) and store.has(recent)
+    assert not store.has(old)
+    assert store.deployments() == {"f": {"function_hash": used, "init_hash": None}}
+    with pytest.raises(ValueError):
+        store.has("../deployments.json")
+
+
+def test_local_execution_is_opt_in(ray_cluster, tmp_path):
+    """Test that the functions only run in the launcher when it is allowed."""
+
+    def add(x, y):
+        return x + y
+
+    store = FunctionStore(str(tmp_path))
+    spec = {
+        "function_hash": store.put(cloudpickle.dumps(add)),
+        "init_hash": None,
+        "options": {"mode": "local", "cache_size": 0, "max_batch_size": 0},
+        "ray_options": {},
+    }
+    with pytest.raises(ValueError, match="allow_local=True"):
+        create_deployment("add", spec, store)
+    deployment = create_deployment("add", spec, store, allow_local=True)
+
+    async def main():
+        assert await deployment.run([1, 2], {}) == 3
+        ref = await deployment.run_to_object([3, 4], {})
+        assert await ref == 7
+
+    try:
+        asyncio.run(main())
+    finally:
+        deployment.close()
+
+
+class _FakeClientContext:
+    """Stand in for the context of a Ray client, its calls use the default one."""
+
+    def __enter__(self):
+        return self
+
+
+def test_router_keeps_object_refs_on_the_default_cluster(ray_cluster):
+    """Test that the calls passing refs go to the default cluster."""
+
+    def on_default(x):
+        return "default"
+
+    def on_client(x):
+        return "client"
+
+    default = RayCluster("default")
+    client = RayCluster("ray://client", _FakeClientContext())
+    router = ClusterRouter(
+        "where",
+        [
+            (default, RemoteTask("where", on_default, cluster=default)),
+            (client, RemoteTask("where", on_client, cluster=client)),
+        ],
+        {"CPU": 1},
+    )
+    client.available = {"CPU": 2}
+
+    async def main():
+        thread = await _call(client, threading.current_thread)
+        assert thread.name.startswith("ray-client")
+        assert await router.remote(1) == "client"
+        assert await router.remote(ray.put(1)) == "default"
+        # The results computed on another cluster are put into the default one
+        ref = await router.remote_to_object(1)
+        assert isinstance(ref, ray.ObjectRef) and await ref == "client"
+        default.healthy = False
+        with pytest.raises(RuntimeError, match="default Ray cluster"):
+            await router.remote(ray.put(1))
+
+    try:
+        asyncio.run(main())
+    finally:
+        router.close()
+        client.executor.shutdown()
@@ -0,0 +1,140 @@
+"""Test the admission order of the container scheduler."""
+import asyncio
+
+import pytest
+
+from hypha_services.scheduler import ContainerScheduler
+
+
+def make_scheduler(capacity):
+    """Create a scheduler recording the launched containers."""
+    launched = []
+
+    async def run(image, command, name=None, **kwargs):
+        launched.append(name)
+        return name
+
+    return ContainerScheduler(run, capacity), launched
+
+
+async def settle():
+    """Let the admitted launches run."""
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+def test_priority_order():
+    """Test that the launches are admitted by priority, then in arrival order."""
+
+    async def main():
+        scheduler, launched = make_scheduler({"cpu": 1})
+        await scheduler.run("image", "cmd", name="running", detach=True)
+        tasks = [
+            asyncio.ensure_future(
+                scheduler.run("image", "cmd", name=name, priority=priority)
+            )
+            for name, priority in [("low", 0), ("high", 5), ("low2", 0)]
+        ]
+        await settle()
+        assert [e["name"] for e in scheduler.queue_status()] == ["high", "low", "low2"]
+        scheduler.release("running")
+        await asyncio.gather(*tasks)
+        assert launched == ["running", "high", "low", "low2"]
+
+    asyncio.run(main())
+
+
+def test_backfill_with_other_resources():
+    """Test that a smaller launch runs next to a blocked head of the queue."""
+
+    async def main():
+        scheduler, launched = make_scheduler({"cpu": 4, "gpu": 1})
+        await scheduler.run("image", "cmd", name="gpu", gpu_count=1, detach=True)
+        head = asyncio.ensure_future(
+            scheduler.run("image", "cmd", name="head", gpu_count=1, priority=1)
+        )
+        small = asyncio.ensure_future(scheduler.run("image", "cmd", name="small"))
+        await small
+        assert not head.done()
+        assert launched == ["gpu", "small"]
+        scheduler.release("gpu")
+        await head
+        assert launched == ["gpu", "small", "head"]
+
+    asyncio.run(main())
+
+
+def test_head_is_not_starved():
+    """Test that backfill cannot take the resources the head waits for."""
+
+    async def main():
+        scheduler, launched = make_scheduler({"cpu": 2})
+        await scheduler.run("image", "cmd", name="first", detach=True)
+        head = asyncio.ensure_future(
+            scheduler.run("image", "cmd", name="head", cpu_count=2, priority=1)
+        )
+        small = asyncio.ensure_future(
+            scheduler.run("image", "cmd", name="small", detach=True)
+        )
+        await settle()
+        # The free CPU is kept for the head instead of being backfilled
+        assert launched == ["first"]
+        scheduler.release("first")
+        await head
+        await small
+        assert launched == ["first", "head", "small"]
+
+    asyncio.run(main())
+
+
+def test_missing_resources_are_untracked():
+    """Test that the resources missing from the capacity are not limited."""
+
+    async def main():
+        scheduler, launched = make_scheduler({"gpu": 1})
+        for index in range(3):
+            await scheduler.run(
+                "image", "cmd", name=f"c{index}", cpu_count=8, detach=True
+            )
+        assert launched == ["c0", "c1", "c2"]
+        assert scheduler.stats()["committed"] == {"gpu": 0}
+
+    asyncio.run(main())
+
+
+def test_rejection():
+    """Test that impossible and duplicate launches are rejected."""
+
+    async def main():
+        scheduler, launched = make_scheduler({"cpu": 2, "memory": "1g"})
+        with pytest.raises(Exception, match="cpu capacity"):
+            await scheduler.run("image", "cmd", cpu_count=4)
+        with pytest.raises(Exception, match="memory capacity"):
+            await scheduler.run("image", "cmd", memory="2g")
+        await scheduler.run("image", "cmd", name="c", detach=True)
+        with pytest.raises(RuntimeError, match="already exists"):
+            await scheduler.run("image", "cmd", name="c")
+        assert launched == ["c"]
+
+    asyncio.run(main())
+
+
+def test_cancelled_launch_leaves_the_queue():
+    """Test that a cancelled launch does not block the ones behind it."""
+
+    async def main():
+        scheduler, launched = make_scheduler({"cpu": 1})
+        await scheduler.run("image", "cmd", name="running", detach=True)
+        cancelled = asyncio.ensure_future(
+            scheduler.run("image", "cmd", name="cancelled", priority=1)
+        )
+        waiting = asyncio.ensure_future(scheduler.run("image", "cmd", name="next"))
+        await settle()
+        cancelled.cancel()
+        await settle()
+        assert [e["name"] for e in scheduler.queue_status()] == ["next"]
+        scheduler.release("running")
+        await waiting
+        assert launched == ["running", "next"]
+
+    asyncio.run(main())
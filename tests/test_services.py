@@ -35,6 +35,9 @@ async def hypha_startup(server):
         detach=True,
     )
     assert "hello world" in await launcher.logs(name)
+    chunk = await launcher.read_logs(name)
+    assert "hello world" in chunk["logs"]
+    assert (await launcher.read_logs(name, offset=chunk["offset"]))["logs"] == ""
     await launcher.stop(name)
 
     print("Container launcher tests passed!")
@@ -0,0 +1,151 @@
+"""Test the synchronous hypha client and the wrapping of the callables."""
+import asyncio
+import collections
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+import pytest
+
+from hypha_services import sync_hypha
+from hypha_services.sync_hypha import (
+    SyncHyphaServer,
+    _encode_callables,
+    convert_sync_to_async,
+)
+
+
+class _FakeServer(dict):
+    """Stand in for a hypha server connection calling the registered services."""
+
+    def __init__(self):
+        super().__init__(
+            register_service=self._register_service, echo=self._echo, disconnect=None
+        )
+        self.config = SimpleNamespace(workspace="workspace")
+        self.services = {}
+
+    def __getattr__(self, name):
+        # The connection exposes its functions as items and attributes
+        try:
+            return self[name]
+        except KeyError as e:
+            raise AttributeError(name) from e
+
+    async def _register_service(self, service, **kwargs):
+        self.services[service["id"]] = service
+        return {"id": service["id"]}
+
+    async def _echo(self, value):
+        return value
+
+
+@pytest.fixture(name="server")
+def fixture_server(monkeypatch):
+    """Return a sync client connected to a fake server."""
+    connection = _FakeServer()
+
+    async def connect_to_server(config):
+        return connection
+
+    monkeypatch.setattr(sync_hypha, "connect_to_server", connect_to_server)
+    server = SyncHyphaServer(max_workers=2)
+    server.start({"server_url": "http://localhost"})
+    server.connection = connection
+    yield server
+    server.close()
+
+
+def test_sync_handlers_run_in_the_executor():
+    """Test that a blocking handler runs in a thread and its wrapper is reused."""
+    executor = ThreadPoolExecutor(max_workers=1)
+
+    def handler(x):
+        return x, threading.current_thread().name
+
+    async def main():
+        loop = asyncio.get_running_loop()
+        wrapper = convert_sync_to_async(handler, loop, executor)
+        assert convert_sync_to_async(handler, loop, executor) is wrapper
+        result, thread = await wrapper(1)
+        assert result == 1 and thread != threading.current_thread().name
+
+    try:
+        asyncio.run(main())
+    finally:
+        executor.shutdown()
+
+
+def test_server_functions_are_sync(server):
+    """Test that the functions of the server are called synchronously."""
+    assert server.echo([1, "a"]) == [1, "a"]
+
+
+def test_service_handlers_run_in_parallel(server):
+    """Test that the calls of a service with its own workers run concurrently."""
+
+    def slow(x):
+        time.sleep(0.2)
+        return x
+
+    server.register_service({"id": "slow", "slow": slow}, max_workers=4)
+    handler = server.connection.services["slow"]["slow"]
+
+    async def call_all():
+        return await asyncio.gather(*(handler(i) for i in range(4)))
+
+    start = time.time()
+    results = asyncio.run_coroutine_threadsafe(call_all(), server.loop).result()
+    assert results == [0, 1, 2, 3]
+    assert time.time() - start < 0.6
+
+
+def _wrap(func, loop, executor):
+    return ("wrapped", func)
+
+
+def _hello():
+    return "hello"
+
+
+def test_leaves_are_returned_as_is():
+    """Test that the values without callables are not copied."""
+    data = {"a": [1, 2, (3, "b")], "c": b"bytes"}
+    assert _encode_callables(data, _wrap, None, None) is data
+    assert _encode_callables("text", _wrap, None, None) == "text"
+
+
+def test_nested_callables_are_wrapped():
+    """Test that only the containers holding callables are copied."""
+    inner = [1, 2]
+    data = {"f": _hello, "nested": [{"g": _hello}], "inner": inner}
+    encoded = _encode_callables(data, _wrap, None, None)
+    assert encoded is not data
+    assert encoded["f"] == ("wrapped", _hello)
+    assert encoded["nested"][0]["g"] == ("wrapped", _hello)
+    assert encoded["inner"] is inner
+    assert data["f"] is _hello
+
+
+def test_container_types_are_kept():
+    """Test that tuples, named tuples and dict subclasses keep their type."""
+    Pair = collections.namedtuple("Pair", ["first", "second"])
+    ordered = collections.OrderedDict(f=_hello)
+    encoded = _encode_callables((Pair(_hello, 1), ordered, [_hello]), _wrap, None, None)
+    assert isinstance(encoded, tuple)
+    assert isinstance(encoded[0], Pair)
+    assert encoded[0] == Pair(("wrapped", _hello), 1)
+    assert type(encoded[1]) is collections.OrderedDict
+    assert encoded[2] == [("wrapped", _hello)]
+
+
+def test_shared_and_cyclic_containers():
+    """Test that shared containers are encoded once and cycles terminate."""
+    shared = [_hello]
+    encoded = _encode_callables([shared, shared], _wrap, None, None)
+    assert encoded[0] is encoded[1]
+    cyclic = {"f": _hello}
+    cyclic["self"] = cyclic
+    encoded = _encode_callables(cyclic, _wrap, None, None)
+    assert encoded["f"] == ("wrapped", _hello)
@@ -0,0 +1,178 @@
+"""Test the log cursors, the sizes, the batches and the requirement checks."""
+from hypha_services import utils
+from hypha_services.utils import (
+    LogCursor,
+    LogPositions,
+    is_installed,
+    iter_log_chunks,
+    parse_bytes,
+    prepare_batch,
+    read_log_chunks,
+    read_timestamped_logs,
+    run_batch,
+)
+
+
+def test_is_installed():
+    """Test that the requirements are checked against the installed versions."""
+    assert is_installed("pytest")
+    assert is_installed("pytest>=1.0")
+    assert not is_installed("pytest<1.0")
+    assert not is_installed("hypha-services-missing-package")
+
+
+def test_install_requirements_only_missing(monkeypatch):
+    """Test that pip is only called for the missing requirements."""
+    calls = []
+    monkeypatch.setattr(utils, "pip_install", lambda *packages: calls.append(packages))
+    assert utils.install_requirements(["pytest"]) == []
+    assert calls == []
+    missing = ["hypha-services-missing-package", "pytest<1.0"]
+    assert utils.install_requirements(["pytest"] + missing) == missing
+    assert calls == [tuple(missing)]
+
+
+def test_parse_bytes():
+    """Test the parsing of sizes with units."""
+    assert parse_bytes(None) is None
+    assert parse_bytes(42) == 42
+    assert parse_bytes("1024") == 1024
+    assert parse_bytes("2k") == 2048
+    assert parse_bytes("64Mi") == 64 * 1024**2
+    assert parse_bytes(" 1.5g ") == int(1.5 * 1024**3)
+
+
+def test_log_cursor_skips_offset():
+    """Test that the bytes before the offset are skipped across chunks."""
+    cursor = LogCursor(offset=4)
+    assert cursor.feed(b"abc") is None
+    assert cursor.feed(b"defg") == {"logs": "efg", "offset": 7}
+    assert cursor.feed("hi") == {"logs": "hi", "offset": 9}
+
+
+def test_log_cursor_split_character():
+    """Test that a multi-byte character split across chunks is decoded once."""
+    data = "aéb".encode("utf-8")
+    cursor = LogCursor()
+    assert cursor.feed(data[:2]) == {"logs": "a", "offset": 1}
+    assert cursor.feed(data[2:]) == {"logs": "éb", "offset": len(data)}
+
+
+def test_iter_log_chunks_resumes_at_offset():
+    """Test that resuming at a returned offset continues where it stopped."""
+    data = "héllo wörld\n".encode("utf-8")
+    chunks = [data[i : i + 3] for i in range(0, len(data), 3)]
+    first = next(iter_log_chunks(chunks))
+    rest = "".join(c["logs"] for c in iter_log_chunks(chunks, first["offset"]))
+    assert first["logs"] + rest == data.decode("utf-8")
+
+
+def test_read_log_chunks_max_bytes():
+    """Test that a read stops after max_bytes and reports where to resume."""
+    chunks = [b"one\n", b"two\n", b"three\n"]
+    first = read_log_chunks(chunks, max_bytes=5)
+    assert first == {"logs": "one\ntwo\n", "offset": 8, "complete": False}
+    second = read_log_chunks(chunks, offset=first["offset"])
+    assert second == {"logs": "three\n", "offset": 14, "complete": True}
+    assert read_log_chunks([], offset=3) == {"logs": "", "offset": 3, "complete": True}
+
+
+def _timestamped(lines):
+    return [
+        f"2024-01-02T03:04:{seconds:02d}.{nanos:09d}Z {text}".encode("utf-8")
+        for seconds, nanos, text in lines
+    ]
+
+
+def test_read_timestamped_logs_resume():
+    """Test that a read resumed from its position skips the lines read."""
+    lines = [(5, 1, "a\n"), (5, 1, "b\n"), (6, 0, "c\n")]
+    first, position = read_timestamped_logs(_timestamped(lines), max_bytes=1)
+    assert first == {"logs": "a\n", "offset": 2, "complete": False}
+    # The daemon sends the logs since the timestamp of the position again
+    second, position = read_timestamped_logs(
+        _timestamped(lines), offset=first["offset"], position=position
+    )
+    assert second == {"logs": "b\nc\n", "offset": 6, "complete": True}
+    lines.append((7, 0, "d\n"))
+    third, _ = read_timestamped_logs(
+        _timestamped(lines[2:]), offset=second["offset"], position=position
+    )
+    assert third == {"logs": "d\n", "offset": 8, "complete": True}
+
+
+def test_read_timestamped_logs_partial_line():
+    """Test that the rest of an unterminated line is returned once."""
+    first, position = read_timestamped_logs(_timestamped([(1, 0, "abc")]))
+    assert first == {"logs": "abc", "offset": 3, "complete": True}
+    second, _ = read_timestamped_logs(
+        _timestamped([(1, 0, "abcdef\n")]), offset=3, position=position
+    )
+    assert second == {"logs": "def\n", "offset": 7, "complete": True}
+
+
+def test_read_timestamped_logs_offset_without_position():
+    """Test that an offset without position skips bytes of the content."""
+    logs, _ = read_timestamped_logs(_timestamped([(1, 0, "abc\n"), (2, 0, "de\n")]), 2)
+    assert logs == {"logs": "c\nde\n", "offset": 7, "complete": True}
+
+
+def test_log_positions_lru():
+    """Test that the least recently stored positions are dropped."""
+    positions = LogPositions(max_size=2)
+    for key in "abc":
+        positions.put(key, ((1, 0), 1, 0))
+    positions.put("d", None)
+    assert positions.get("a") is None
+    assert positions.get("c") == ((1, 0), 1, 0)
+    assert positions.get("d") is None
+    assert LogPositions.since(((10, 500000000), 0, 0)) < 10.5
+
+
+def test_prepare_batch():
+    """Test that the batch names are generated and validated."""
+    batch = prepare_batch(
+        [
+            {"image": "i", "command": "c"},
+            {"image": "i", "command": "c", "name": "taken"},
+            {"image": "i", "command": "c", "name": "dup"},
+            {"image": "i", "command": "c", "name": "dup", "detach": False},
+            {"image": "i", "name": "nocommand"},
+            {"image": "i", "command": "c", "name": "all"},
+        ],
+        ["taken"],
+    )
+    errors = [error for _, error in batch]
+    assert errors[0] is None and len(batch[0][0]["name"]) == 24
+    assert batch[0][0]["detach"] is True
+    assert errors[1] == "Container taken already exists"
+    assert errors[2] is None
+    assert errors[3] == "Container dup already exists"
+    assert batch[3][0]["detach"] is False
+    assert errors[4] == "The image and the command are required"
+    assert errors[5] == "Container name cannot be 'all'"
+
+
+def test_run_batch_reports_each_launch():
+    """Test that a failed launch does not abort the rest of the batch."""
+
+    def run(image, command, name, detach):
+        if image == "missing":
+            raise RuntimeError("No such image")
+        return f"{name} done"
+
+    results = run_batch(
+        run,
+        [
+            {"image": "i", "command": "c", "name": "a", "detach": False},
+            {"image": "missing", "command": "c", "name": "b"},
+            {"image": "i", "command": "c", "name": "c"},
+        ],
+        [],
+        max_workers=2,
+    )
+    assert results == [
+        {"name": "a", "success": True, "error": None, "output": "a done"},
+        {"name": "b", "success": False, "error": "No such image"},
+        {"name": "c", "success": True, "error": None},
+    ]